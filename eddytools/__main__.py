@@ -2,10 +2,11 @@
 
 Usage:
   eddytools schema list-schemas <db_url>
-  eddytools schema list-classes <db_url> [--details] [--o=OUTPUT_FILE]
-  eddytools schema discover <db_url> <output_dir> [--classes=CLASSES_FILE] [--max-fields=K] [--sampling=SAMPLES] [--resume]
+  eddytools schema list-classes <db_url> [--details] [--o=OUTPUT_FILE] [--metadata-jobs=N] [--metadata-cache=DIR]
+  eddytools schema discover <db_url> <output_dir> [--classes=CLASSES_FILE] [--max-fields=K] [--sampling=SAMPLES] [--resume] [--in-memory] [--unary-inds] [--metadata-jobs=N] [--metadata-cache=DIR]
   eddytools schema stats <metadata_file>
-  eddytools extract <db_url> <output_dir> [<schema_dir>] [--classes=CLASSES_FILE]
+  eddytools extract <db_url> <output_dir> [<schema_dir>] [--classes=CLASSES_FILE] [--batch-size=N] [--index-memory=MB] [--single-pass] [--jobs=N] [--partitions=N] [--resume] [--watermarks=FILE] [--incremental] [--filters=FILE [--fk-closure]] [--sample=N [--sample-roots=CLASSES_FILE]] [--dictionary] [--staged-relations | --merge-relations] [--metadata-jobs=N] [--metadata-cache=DIR] [--bulk-load] [--report]
+  eddytools mm index <input_db>
   eddytools events <input_db> <output_dir> [--build-events]
   eddytools cases <input_db> <output_dir> [--build-logs --topk=K] [--print_cn=CN_ID --o=OUTPUT_FILE [--show]]
   eddytools logs <input_db> (--list | --info_log=LOG_ID | --export_log=LOG_ID --o=OUTPUT_FILE | --print_cn_log=LOG_ID --o=OUTPUT_FILE [--show])
@@ -28,6 +29,27 @@ Options:
   --classes=CLASSES_FILE    File in Json format with a list of class names to extract. If omitted, all will be extracted
   --max-fields=K              Maximum length of keys to discover [default: 4]
   --sampling=SAMPLES        Number of rows per table to sample for schema discovery [default: 0]
+  --in-memory               Read every table (or its sample) once and discover its primary keys in memory. Strings are compared exactly, whatever the collation of the db
+  --unary-inds              Check all single-column foreign key candidates in one merge of sorted column values. Strings are compared exactly, whatever the collation of the db
+  --batch-size=N            Number of rows buffered before writing them to the OpenSLEX mm [default: 10000]
+  --index-memory=MB         Memory for the object key index before spilling it to disk [default: 1024]
+  --single-pass             Read each source table only once, resolving relations at the end of the extraction
+  --jobs=N                  Number of source tables read in parallel during extraction (implies --single-pass) [default: 1]
+  --resume                  Resume a schema discovery, or an extraction from the classes it had not completed
+  --partitions=N            Number of primary key ranges each source table is split into, to be read in parallel by the --jobs [default: 1]
+  --watermarks=FILE         File in Json format mapping class names to the column (an update timestamp or an increasing key) used to find their changed rows
+  --incremental             Update an extracted OpenSLEX mm with the rows changed since the last extraction, found with the --watermarks, or the ones stored in the mm if omitted
+  --filters=FILE            File in Yaml or Json format mapping class names to the rows to extract: a SQL condition (where) and/or a time window (column, start, end)
+  --fk-closure              Also extract the rows referred to by the foreign keys of the filtered rows
+  --sample=N                Extract only N rows of every root class and the rows related to them through foreign keys
+  --sample-roots=CLASSES_FILE  File in Json format with a list of the root class names of the --sample. If omitted, all classes are roots
+  --dictionary              Store the string attribute values of the OpenSLEX mm once per attribute, in a value dictionary
+  --staged-relations        Stage the keys of the objects in the OpenSLEX mm and resolve the relations there with one join per foreign key
+  --metadata-jobs=N         Number of connections reflecting the tables of the source db in parallel [default: 1]
+  --metadata-cache=DIR      Directory where the reflected tables of the source db are saved, and loaded from while its catalog does not change
+  --merge-relations         Resolve the relations with a sort-merge join on the object keys, for key indexes bigger than the --index-memory (implies --single-pass)
+  --bulk-load               Load the OpenSLEX mm without syncing it to disk and create its indexes at the end. The mm may be corrupted if the system crashes during the load
+  --report                  Save statistics of the extraction (rows and bytes read, rows written and time spent per class and stage) in Json format next to the OpenSLEX mm
 
 """
 
@@ -44,6 +66,7 @@ import shutil
 from pathlib import Path
 from docopt import docopt
 import json
+import yaml
 from pprint import pprint
 import pandas as pd
 from graphviz import Digraph
@@ -318,7 +341,8 @@ def dump_cn_dot(mm_engine, mm_meta, case_notion: cn.CaseNotion, output_file, vie
     graph.render(view=view)
 
 
-def discover_schema(db_url, output_dir, classes_file, max_fields_key=4, resume=False, sampling=0):
+def discover_schema(db_url, output_dir, classes_file, max_fields_key=4, resume=False, sampling=0,
+                    metadata_jobs=1, metadata_cache=None, in_memory=False, unary_inds=False):
     db_engine: Engine = ex.create_db_engine_from_url(db_url)
     if classes_file:
         classes = json.load(open(classes_file, 'rt'))
@@ -326,10 +350,16 @@ def discover_schema(db_url, output_dir, classes_file, max_fields_key=4, resume=F
         classes = None
     es.full_discovery_from_engine(db_engine, dump_dir=output_dir, classes=classes,
                                   max_fields_key=max_fields_key,
-                                  resume=resume, sampling=sampling)
+                                  resume=resume, sampling=sampling,
+                                  metadata_jobs=metadata_jobs, metadata_cache=metadata_cache,
+                                  in_memory=in_memory, unary_inds=unary_inds)
 
 
-def extract_data(db_url, output_dir, schema_dir=None, classes_file=None):
+def extract_data(db_url, output_dir, schema_dir=None, classes_file=None, batch_size=ex.DEFAULT_BATCH_SIZE,
+                 index_memory=ex.DEFAULT_MEMORY_BUDGET, single_pass=False, jobs=1, partitions=1, resume=False,
+                 watermarks_file=None, incremental=False, filters_file=None, fk_closure=False, sample=None,
+                 sample_roots_file=None, dictionary=False, staged_relations=False, merge_relations=False,
+                 metadata_jobs=1, metadata_cache=None, bulk_load=False, report=False):
     db_engine: Engine = ex.create_db_engine_from_url(db_url)
     if schema_dir:
         metadata = pickle.load(open(Path(schema_dir,'metadata_filtered.pickle'), mode='rb'))
@@ -340,17 +370,51 @@ def extract_data(db_url, output_dir, schema_dir=None, classes_file=None):
         db_meta = es.create_custom_metadata(db_engine, None,
                                             discovered_pks, discovered_fks, metadata=metadata)
     else:
-        db_meta: MetaData = ex.get_metadata(db_engine)
+        db_meta: MetaData = ex.get_metadata(db_engine, jobs=metadata_jobs, cache_dir=metadata_cache)
 
     if classes_file:
         classes = json.load(open(classes_file, 'rt'))
     else:
         classes = None
 
+    if watermarks_file:
+        watermarks = json.load(open(watermarks_file, 'rt'))
+    else:
+        watermarks = None
+
+    if filters_file:
+        filters = yaml.safe_load(open(filters_file, 'rt'))
+    else:
+        filters = None
+
+    if sample_roots_file:
+        sample_roots = json.load(open(sample_roots_file, 'rt'))
+    else:
+        sample_roots = None
+
     db_engine.dispose()
+    if incremental:
+        ex.incremental_extraction_from_db(Path(output_dir, 'mm-extracted.slexmm'), output_dir,
+                                          db_engine, db_meta, watermarks, batch_size=batch_size,
+                                          index_memory=index_memory, filters=filters, fk_closure=fk_closure)
+        return
     ex.extraction_from_db(Path(output_dir, 'mm-extracted.slexmm'), output_dir,
                           db_engine, overwrite=True, classes=classes,
-                          metadata=db_meta)
+                          metadata=db_meta, batch_size=batch_size, index_memory=index_memory,
+                          single_pass=single_pass, jobs=jobs, partitions=partitions, resume=resume,
+                          watermarks=watermarks, filters=filters, fk_closure=fk_closure, sample=sample,
+                          sample_roots=sample_roots, dictionary=dictionary, staged_relations=staged_relations,
+                          merge_relations=merge_relations, bulk_load=bulk_load, report=report)
+
+
+def mm_index(mm_path):
+    mm_engine = ex.create_mm_engine(mm_path)
+    created = ex.create_mm_indexes(mm_engine)
+    mm_engine.dispose()
+    if created:
+        print('Created indexes: {}'.format(', '.join(created)))
+    else:
+        print('All indexes already exist')
 
 
 def schema_list_schemas(db_url):
@@ -361,9 +425,9 @@ def schema_list_schemas(db_url):
     print(schemas_json)
 
 
-def schema_list_classes(db_url, details=False, output_file=False):
+def schema_list_classes(db_url, details=False, output_file=False, metadata_jobs=1, metadata_cache=None):
     db_engine: Engine = ex.create_db_engine_from_url(db_url)
-    metadata: MetaData = ex.get_metadata(db_engine)
+    metadata: MetaData = ex.get_metadata(db_engine, jobs=metadata_jobs, cache_dir=metadata_cache)
     classes = es.retrieve_classes(metadata)
     if details:
         classes_details = []
@@ -412,6 +476,9 @@ if __name__ == '__main__':
 
     arguments = docopt(__doc__, version=eddytools.__version__)
 
+    metadata_jobs = int(arguments['--metadata-jobs'])
+    metadata_cache = arguments['--metadata-cache']
+
     if arguments['schema']:
         db_url = arguments['<db_url>']
         if arguments['list-schemas']:
@@ -419,15 +486,19 @@ if __name__ == '__main__':
         elif arguments['list-classes']:
             details = arguments['--details']
             output_file = arguments['--o']
-            schema_list_classes(db_url, details, output_file)
+            schema_list_classes(db_url, details, output_file, metadata_jobs=metadata_jobs,
+                                metadata_cache=metadata_cache)
         elif arguments['discover']:
             output_dir = arguments['<output_dir>']
             classes_file = arguments['--classes']
             max_fields = int(arguments['--max-fields'])
             resume = arguments['--resume']
             sampling = int(arguments['--sampling'])
+            in_memory = arguments['--in-memory']
+            unary_inds = arguments['--unary-inds']
             discover_schema(db_url, output_dir, classes_file, max_fields_key=max_fields,
-                            resume=resume, sampling=sampling)
+                            resume=resume, sampling=sampling, metadata_jobs=metadata_jobs,
+                            metadata_cache=metadata_cache, in_memory=in_memory, unary_inds=unary_inds)
         elif arguments['stats']:
             metadata_file = arguments['<metadata_file>']
             print_schema_stats(metadata_file)
@@ -436,7 +507,35 @@ if __name__ == '__main__':
         schema_dir = arguments['<schema_dir>']
         output_dir = arguments['<output_dir>']
         classes_file = arguments['--classes']
-        extract_data(db_url, output_dir, schema_dir, classes_file)
+        batch_size = int(arguments['--batch-size'])
+        index_memory = int(arguments['--index-memory']) * 1024 * 1024
+        single_pass = arguments['--single-pass']
+        jobs = int(arguments['--jobs'])
+        partitions = int(arguments['--partitions'])
+        resume = arguments['--resume']
+        watermarks_file = arguments['--watermarks']
+        incremental = arguments['--incremental']
+        filters_file = arguments['--filters']
+        fk_closure = arguments['--fk-closure']
+        sample = int(arguments['--sample']) if arguments['--sample'] else None
+        sample_roots_file = arguments['--sample-roots']
+        dictionary = arguments['--dictionary']
+        staged_relations = arguments['--staged-relations']
+        merge_relations = arguments['--merge-relations']
+        bulk_load = arguments['--bulk-load']
+        report = arguments['--report']
+        extract_data(db_url, output_dir, schema_dir, classes_file, batch_size=batch_size,
+                     index_memory=index_memory, single_pass=single_pass, jobs=jobs, partitions=partitions,
+                     resume=resume, watermarks_file=watermarks_file, incremental=incremental,
+                     filters_file=filters_file, fk_closure=fk_closure, sample=sample,
+                     sample_roots_file=sample_roots_file, dictionary=dictionary,
+                     staged_relations=staged_relations, merge_relations=merge_relations,
+                     metadata_jobs=metadata_jobs, metadata_cache=metadata_cache, bulk_load=bulk_load,
+                     report=report)
+    elif arguments['mm']:
+        input_mm = Path(arguments['<input_db>'])
+        if arguments['index']:
+            mm_index(input_mm)
     elif arguments['events']:
         input_mm = Path(arguments['<input_db>'])
         output_dir = Path(arguments['<output_dir>'])
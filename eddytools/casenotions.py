@@ -19,6 +19,7 @@ import yaml
 import pandas as pd
 import pickle
 import ciso8601
+from eddytools.extraction import check_mm_indexes
 
 
 class CaseNotion(dict):
@@ -99,6 +100,8 @@ def save_candidates(candidates, candidates_path):
 
 def compute_candidates(mm_engine: Engine, min_rel_threshold=0, max_length_path=5, cache_dir: str='.') -> dict:
 
+    check_mm_indexes(mm_engine)
+
     candidates = SqliteDict(
         flag='n',
         filename='{}/{}-{}'.format(cache_dir, 'candidates_filecache', datetime.now().timestamp()),
@@ -305,6 +308,7 @@ def get_all_classes(mm_engine: Engine, metadata: MetaData = None) -> list:
 
 def build_log_for_case_notion(mm_engine: Engine, case_notion: CaseNotion, proc_name: str,
                               log_name: str, metadata: MetaData = None) -> int:
+    check_mm_indexes(mm_engine)
     if not metadata:
         metadata = MetaData(bind=mm_engine)
         metadata.reflect()
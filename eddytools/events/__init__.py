@@ -3,6 +3,7 @@ from sqlalchemy.orm import scoped_session, sessionmaker, Session
 from sqlalchemy.schema import Table, MetaData, Column
 from sqlalchemy.sql import and_, select, or_, insert, literal_column
 from eddytools.casenotions import get_all_classes
+from eddytools.extraction import check_mm_indexes
 from eddytools.events.encoding import Candidate
 from eddytools.events.activity_identifier_discovery import ActivityIdentifierDiscoverer,\
     CT_TS_FIELD, CT_IN_TABLE, CT_LOOKUP
@@ -27,6 +28,8 @@ def discover_event_definitions(mm_engine: Engine, mm_meta: MetaData,
                                model='default',
                                model_path=None) -> (list, ActivityIdentifierDiscoverer):
 
+    check_mm_indexes(mm_engine)
+
     aid = ActivityIdentifierDiscoverer(engine=mm_engine, meta=mm_meta, model=model, model_path=model_path)
 
     timestamp_attrs = aid.get_timestamp_attributes(classes=classes)
@@ -163,7 +166,10 @@ def train_model(mm_engine: Engine, mm_meta: MetaData, y_true_path: str,
     return classifiers
 
 
-def ts_to_millis(ts: str):
+def ts_to_millis(ts):
+    # timestamps are stored in epoch millis by the extraction. Older OpenSLEX mms store them as strings
+    if isinstance(ts, int):
+        return ts
     # d: datetime = dateparser.parse(ts) took too long. ciso8601 is much faster
     d = ciso8601.parse_datetime(ts)
     return int(d.timestamp() * 1000)
@@ -171,6 +177,8 @@ def ts_to_millis(ts: str):
 
 def compute_events(mm_engine: Engine, mm_meta: MetaData, event_definitions: List[Candidate]):
 
+    check_mm_indexes(mm_engine)
+
     DBSession: scoped_session = scoped_session(sessionmaker(bind=mm_engine))
 
     conn: Connection = DBSession.connection()
@@ -287,7 +295,9 @@ def compute_events(mm_engine: Engine, mm_meta: MetaData, event_definitions: List
                     # i = 0
                     for r in tqdm(res, total=num_objs, desc='Events'):
                         ov_id = int(r['ov_id'])
-                        ts_v = str(r['ts_v'])
+                        ts_v = r['ts_v']
+                        # values as stored in the mm (see ATTRIBUTE_CONVERTERS): numbers without the scale of
+                        # their column, booleans as 1 or 0 and timestamps as epoch millis
                         an_v = str(r['an_v'])
                         at_n = r['at_n']
                         cl_v = str(r['cl_v'])
@@ -15,6 +15,53 @@ def _check_already_calculated(feature_name, feature_values):
     return True
 
 
+# get the table with the attribute values of the mm, and the dictionary of their string values if the mm
+# uses value-dictionary storage (then attribute_value is a view on these tables)
+def _attribute_value_tables(meta):
+    t_dict = meta.tables.get('attribute_value_dictionary')
+    if t_dict is not None:
+        return meta.tables.get('attribute_value_data'), t_dict
+    return meta.tables.get('attribute_value'), None
+
+
+# count the values of t and their distinct values. With value-dictionary storage, the values in the dictionary
+# are counted by their id. A string value is either always in the dictionary or never, so the distinct values in
+# the dictionary and out of it can be added up
+def _count_values(t, t_dict):
+    if t_dict is None:
+        return [func.count(t.c.value), func.count(distinct(t.c.value))]
+    return [func.count(t.c.id), func.count(distinct(t.c.value_id)) + func.count(distinct(t.c.value))]
+
+
+# get the number, sum and sum of squares of the lengths of the values of t2 in every group of group_cols
+# (labeled columns), {group: {'n', 'sum', 'sum_sq'}}. The lengths are computed once per distinct value,
+# or per entry of the dictionary with value-dictionary storage
+def _value_lengths(engine, t2, t_dict, group_cols, from_clause, where_clause):
+    value_cols = [t2.c.value_id, t2.c.value] if t_dict is not None else [t2.c.value]
+    values = (
+        select(group_cols + value_cols + [func.count().label('nr')])
+            .select_from(from_clause)
+            .where(where_clause)
+            .group_by(*(group_cols + value_cols))
+    ).alias()
+    if t_dict is not None:
+        from_values = values.outerjoin(t_dict, t_dict.c.id == values.c.value_id)
+        length = func.length(func.coalesce(t_dict.c.value, values.c.value))
+    else:
+        from_values = values
+        length = func.length(values.c.value)
+    keys = [values.c[col.name] for col in group_cols]
+    q = (
+        select(keys + [func.sum(values.c.nr).label('n'),
+                       func.sum(values.c.nr * length).label('sum'),
+                       func.sum(values.c.nr * length * length).label('sum_sq')])
+            .select_from(from_values)
+            .group_by(*keys)
+    )
+    return {tuple(row[col.name] for col in group_cols): {'n': row['n'], 'sum': row['sum'], 'sum_sq': row['sum_sq']}
+            for row in engine.execute(q)}
+
+
 # general
 
 
@@ -89,9 +136,11 @@ def nr_values_where_timestamp(candidates, feature_values, engine, meta):
         return
     # starttime = datetime.now()
 
-    t1 = meta.tables.get('attribute_value').alias()
-    t2 = meta.tables.get('attribute_value').alias()
+    t_attr_v, t_dict = _attribute_value_tables(meta)
+    t1 = t_attr_v.alias()
+    t2 = t_attr_v.alias()
     t_rels = meta.tables.get('relation')
+    nr_values, nr_unique_values = _count_values(t2, t_dict)
 
     for c, fv in zip(candidates, feature_values):
         if 'nr_timestamps' not in fv:
@@ -108,8 +157,8 @@ def nr_values_where_timestamp(candidates, feature_values, engine, meta):
     q = (
         select([t1.c.attribute_name_id.label('ts_id'),
                 t2.c.attribute_name_id.label('a_id_id'),
-                func.count(t2.c.value).label('nr_values_where_timestamp'),
-                func.count(distinct(t2.c.value)).label('nr_unique_values_where_timestamp')])
+                nr_values.label('nr_values_where_timestamp'),
+                nr_unique_values.label('nr_unique_values_where_timestamp')])
             .select_from(t1.join(t2, t1.c.object_version_id == t2.c.object_version_id))
             .where(and_(t1.c.attribute_name_id.in_(ts_ids),
                         t2.c.attribute_name_id.in_(a_id_ids),
@@ -133,8 +182,8 @@ def nr_values_where_timestamp(candidates, feature_values, engine, meta):
         select([t1.c.attribute_name_id.label('ts_id'),
                 t2.c.attribute_name_id.label('a_id_id'),
                 t_rels.c.relationship_id.label('rel_id'),
-                func.count(t2.c.value).label('nr_values_where_timestamp'),
-                func.count(distinct(t2.c.value)).label('nr_unique_values_where_timestamp')])
+                nr_values.label('nr_values_where_timestamp'),
+                nr_unique_values.label('nr_unique_values_where_timestamp')])
             .select_from(t1
                          .join(t_rels, t1.c.object_version_id == t_rels.c.source_object_version_id)
                          .join(t2, t_rels.c.target_object_version_id == t2.c.object_version_id))
@@ -421,8 +470,9 @@ def text_length_mean_std_cv(candidates, feature_values, engine, meta):
         if 'data_type' not in fv:
             data_type(candidates, feature_values, engine, meta)
 
-    t1 = meta.tables.get('attribute_value').alias()
-    t2 = meta.tables.get('attribute_value').alias()
+    t_attr_v, t_dict = _attribute_value_tables(meta)
+    t1 = t_attr_v.alias()
+    t2 = t_attr_v.alias()
     t_rels = meta.tables.get('relation')
 
     # in-table
@@ -432,27 +482,11 @@ def text_length_mean_std_cv(candidates, feature_values, engine, meta):
     a_id_ids = {c.activity_identifier_attribute_id for c, fv in zip(candidates, feature_values)
                 if (c.activity_identifier_attribute_id and not c.relationship_id)
                 and fv['data_type'] == 'string'}
-    q = (
-        select([t1.c.attribute_name_id.label('ts_id'),
-                t2.c.attribute_name_id.label('a_id_id'),
-                t2.c.value])
-            .select_from(t1.join(t2, t1.c.object_version_id == t2.c.object_version_id))
-            .where(and_(t1.c.attribute_name_id.in_(ts_ids),
-                        t2.c.attribute_name_id.in_(a_id_ids)))
-    )
-    result = engine.execute(q)
-    lengths = dict()
-    for row in result:
-        ts_id = row['ts_id']
-        a_id_id = row['a_id_id']
-        text = row['value']
-        length = lengths.get((ts_id, a_id_id))
-        if length:
-            length['n'] += 1
-            length['sum'] += len(text)
-            length['sum_sq'] += len(text)**2
-        else:
-            lengths[(ts_id, a_id_id)] = {'n': 1, 'sum': len(text), 'sum_sq': len(text)**2}
+    lengths = _value_lengths(engine, t2, t_dict,
+                             [t1.c.attribute_name_id.label('ts_id'), t2.c.attribute_name_id.label('a_id_id')],
+                             t1.join(t2, t1.c.object_version_id == t2.c.object_version_id),
+                             and_(t1.c.attribute_name_id.in_(ts_ids),
+                                  t2.c.attribute_name_id.in_(a_id_ids)))
     for c, fv in zip(candidates, feature_values):
         if (c.activity_identifier_attribute_id and not c.relationship_id) and fv['data_type'] == 'string':
             length = lengths.get((c.timestamp_attribute_id, c.activity_identifier_attribute_id))
@@ -474,32 +508,15 @@ def text_length_mean_std_cv(candidates, feature_values, engine, meta):
     ts_ids = {c.timestamp_attribute_id for c in candidates if c.relationship_id}
     a_id_ids = {c.activity_identifier_attribute_id for c in candidates if c.relationship_id}
     rel_ids = {c.relationship_id for c in candidates if c.relationship_id}
-    q = (
-        select([t1.c.attribute_name_id.label('ts_id'),
-                t2.c.attribute_name_id.label('a_id_id'),
-                t_rels.c.relationship_id.label('rel_id'),
-                t2.c.value])
-            .select_from(t1
-                         .join(t_rels, t1.c.object_version_id == t_rels.c.source_object_version_id)
-                         .join(t2, t_rels.c.target_object_version_id == t2.c.object_version_id))
-            .where(and_(t1.c.attribute_name_id.in_(ts_ids),
-                        t_rels.c.relationship_id.in_(rel_ids),
-                        t2.c.attribute_name_id.in_(a_id_ids)))
-    )
-    result = engine.execute(q)
-    lengths = dict()
-    for row in result:
-        ts_id = row['ts_id']
-        a_id_id = row['a_id_id']
-        rel_id = row['rel_id']
-        text = row['value']
-        length = lengths.get((ts_id, a_id_id, rel_id))
-        if length:
-            length['n'] += 1
-            length['sum'] += len(text)
-            length['sum_sq'] += len(text)**2
-        else:
-            lengths[(ts_id, a_id_id, rel_id)] = {'n': 1, 'sum': len(text), 'sum_sq': len(text)**2}
+    lengths = _value_lengths(engine, t2, t_dict,
+                             [t1.c.attribute_name_id.label('ts_id'), t2.c.attribute_name_id.label('a_id_id'),
+                              t_rels.c.relationship_id.label('rel_id')],
+                             t1
+                             .join(t_rels, t1.c.object_version_id == t_rels.c.source_object_version_id)
+                             .join(t2, t_rels.c.target_object_version_id == t2.c.object_version_id),
+                             and_(t1.c.attribute_name_id.in_(ts_ids),
+                                  t_rels.c.relationship_id.in_(rel_ids),
+                                  t2.c.attribute_name_id.in_(a_id_ids)))
     for c, fv in zip(candidates, feature_values):
         if c.relationship_id:
             length = lengths.get((c.timestamp_attribute_id, c.activity_identifier_attribute_id, c.relationship_id))
@@ -578,9 +595,12 @@ def alphabetic_fraction(candidates, feature_values, engine, meta):
                 fv['alphabetic_fraction'] = fraction['sum'] / fraction['n']
 
     # lookup
-    ts_ids = {c.timestamp_attribute_id for c in candidates if c.relationship_id}
-    a_id_ids = {c.activity_identifier_attribute_id for c in candidates if c.relationship_id}
-    rel_ids = {c.relationship_id for c in candidates if c.relationship_id}
+    ts_ids = {c.timestamp_attribute_id for c, fv in zip(candidates, feature_values)
+              if c.relationship_id and fv['data_type'] == 'string'}
+    a_id_ids = {c.activity_identifier_attribute_id for c, fv in zip(candidates, feature_values)
+                if c.relationship_id and fv['data_type'] == 'string'}
+    rel_ids = {c.relationship_id for c, fv in zip(candidates, feature_values)
+               if c.relationship_id and fv['data_type'] == 'string'}
     q = (
         select([t1.c.attribute_name_id.label('ts_id'),
                 t2.c.attribute_name_id.label('a_id_id'),
@@ -606,7 +626,7 @@ def alphabetic_fraction(candidates, feature_values, engine, meta):
         else:
             fractions[(ts_id, a_id_id, rel_id)] = {'n': 1, 'sum': ab_frac(text)}
     for c, fv in zip(candidates, feature_values):
-        if c.relationship_id:
+        if c.relationship_id and fv['data_type'] == 'string':
             fraction = fractions.get((c.timestamp_attribute_id, c.activity_identifier_attribute_id, c.relationship_id))
             if fraction:
                 fv['alphabetic_fraction'] = fraction['sum'] / fraction['n']
@@ -1,27 +1,88 @@
 import os
+import gzip
 import time
+import shutil
+import pickle
+import tempfile
+import threading
+from array import array
+import math
+from datetime import date, datetime
+from decimal import Decimal
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
+from uuid import uuid4
+from hashlib import blake2b
 from pkg_resources import resource_stream
 
+import ciso8601
+import numpy as np
+
 # SQLAlchemy imports
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.engine import Engine, ResultProxy, Transaction, Connection
 from sqlalchemy.schema import MetaData, Table
 from sqlalchemy.schema import UniqueConstraint, PrimaryKeyConstraint
-from sqlalchemy.sql import func, select, text
+from sqlalchemy.sql import func, select, text, and_, or_, exists, literal_column, false
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy import types
 from sqlalchemy import inspect
 from tqdm import tqdm
-from datetime import datetime
-from sqlitedict import SqliteDict
+from eddytools.keyindex import KeyIndex, DEFAULT_MEMORY_BUDGET, encode_key, key_digest, key_positions
+from eddytools.report import ExtractionReport, NO_REPORT
 
 
 # OpenSLEX parameters
 _OPENSLEX_SCRIPT_PATH = 'resources/metamodel.sql'
 
+# number of source rows buffered before flushing them to the OpenSLEX mm
+DEFAULT_BATCH_SIZE = 10000
+
+# pragmas of every connection to an OpenSLEX mm engine in bulk load mode. They trade durability for speed:
+# if the system crashes or loses power during the load, the mm may be corrupted and must be created again.
+# An extraction that fails can still be resumed: the indexes it dropped are recorded in the mm
+MM_BULK_LOAD_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA foreign_keys = OFF',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -{}'.format(512 * 1024),  # in KiB
+    'PRAGMA mmap_size = {}'.format(1 << 30),
+]
+
+# pragmas restored at the end of a bulk load
+MM_DURABLE_PRAGMAS = [
+    'PRAGMA journal_mode = DELETE',
+    'PRAGMA synchronous = FULL',
+]
+
+
+# value-dictionary storage of attribute values: the string values of every attribute are stored once in
+# attribute_value_dictionary and referred to by value_id in attribute_value_data. The view attribute_value
+# has the columns of the attribute_value table of the OpenSLEX mm, for the code reading attribute values
+_DICTIONARY_SCRIPT = """
+DROP TABLE attribute_value;
+CREATE TABLE attribute_value_dictionary (id INTEGER PRIMARY KEY AUTOINCREMENT, attribute_name_id INTEGER REFERENCES attribute_name (id), value);
+CREATE TABLE attribute_value_data (id INTEGER PRIMARY KEY AUTOINCREMENT, object_version_id INTEGER REFERENCES object_version (id), attribute_name_id INTEGER REFERENCES attribute_name (id), value, value_id INTEGER REFERENCES attribute_value_dictionary (id), type TEXT);
+CREATE VIEW attribute_value AS SELECT AV.id AS id, AV.object_version_id AS object_version_id, AV.attribute_name_id AS attribute_name_id, coalesce(D.value, AV.value) AS value, AV.type AS type FROM attribute_value_data AS AV LEFT JOIN attribute_value_dictionary AS D ON D.id = AV.value_id;
+"""
+
+# maximum number of distinct values of an attribute in the dictionary. Further values are stored in attribute_value_data
+DICTIONARY_MAX_VALUES = 1 << 16
+
+
+# get the table storing the attribute values of the OpenSLEX mm: attribute_value, or attribute_value_data
+# if it uses value-dictionary storage
+def get_attribute_value_table(mm_conn):
+    if mm_conn.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' "
+                       "AND name = 'attribute_value_data'").fetchall()[0][0]:
+        return 'attribute_value_data'
+    return 'attribute_value'
+
 
 # create a SQLite database file for the OpenSLEX mm and run the script to create all tables
-def create_mm(mm_file_path, overwrite=False):
+def create_mm(mm_file_path, overwrite=False, dictionary=False):
     is_success = False
 
     # check if file already exists
@@ -55,6 +116,8 @@ def create_mm(mm_file_path, overwrite=False):
 
         print("Running script")
         cursor.executescript(script)
+        if dictionary:
+            cursor.executescript(_DICTIONARY_SCRIPT)
         conn.commit()
         conn.close()
         mm_engine.dispose()
@@ -70,13 +133,130 @@ def create_mm(mm_file_path, overwrite=False):
         raise e
 
 
-# create engine for the OpenSLEX mm using SQLAlchemy
-def create_mm_engine(openslex_file_path):
+# create engine for the OpenSLEX mm using SQLAlchemy. With bulk_load, every connection of the engine
+# is set up for fast loading with MM_BULK_LOAD_PRAGMAS (see begin_mm_bulk_load and end_mm_bulk_load)
+def create_mm_engine(openslex_file_path, bulk_load=False):
     mm_url = 'sqlite:///{path}'.format(path=openslex_file_path)
     engine = create_engine(mm_url)
+    if bulk_load:
+        event.listen(engine, 'connect', _set_bulk_load_pragmas)
     return engine
 
 
+def _set_bulk_load_pragmas(dbapi_conn, connection_record):
+    cursor = dbapi_conn.cursor()
+    for pragma in MM_BULK_LOAD_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+# secondary indexes of the OpenSLEX mm dropped by begin_mm_bulk_load and not created again yet, stored in
+# the mm itself so an extraction resumed after a failed bulk load creates them again
+_DEFERRED_INDEX_TABLE = 'extraction_deferred_index'
+
+
+# get the statements to create the indexes dropped by a bulk load of the OpenSLEX mm that did not finish
+def get_deferred_indexes(mm_engine: Engine):
+    if not mm_engine.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?",
+                             _DEFERRED_INDEX_TABLE).scalar():
+        return []
+    return [sql for sql, in mm_engine.execute('SELECT sql FROM {} ORDER BY name'.format(_DEFERRED_INDEX_TABLE))]
+
+
+# drop the secondary indexes of the OpenSLEX mm, so they are not updated row by row during a load.
+# Returns the statements to create them again with end_mm_bulk_load, including the ones dropped by
+# a previous bulk load that did not finish
+def begin_mm_bulk_load(mm_engine: Engine):
+    mm_engine.execute('CREATE TABLE IF NOT EXISTS {} (name TEXT PRIMARY KEY, sql TEXT NOT NULL)'
+                      .format(_DEFERRED_INDEX_TABLE))
+    indexes = mm_engine.execute("SELECT name, sql FROM sqlite_master "
+                                "WHERE type = 'index' AND sql IS NOT NULL").fetchall()
+    for name, sql in indexes:
+        with mm_engine.begin() as conn:
+            conn.execute('INSERT OR REPLACE INTO {} (name, sql) VALUES (?, ?)'.format(_DEFERRED_INDEX_TABLE),
+                         name, sql)
+            conn.execute('DROP INDEX "{}"'.format(name))
+    return get_deferred_indexes(mm_engine)
+
+
+# create the indexes deferred by begin_mm_bulk_load, update the statistics of the query planner and
+# make the OpenSLEX mm durable again. No other connection to the mm may be open
+def end_mm_bulk_load(mm_engine: Engine, deferred_indexes=None):
+    conn = mm_engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        for sql in deferred_indexes or []:
+            cursor.execute(sql)
+        cursor.execute('DROP TABLE IF EXISTS {}'.format(_DEFERRED_INDEX_TABLE))
+        conn.commit()
+        cursor.execute('ANALYZE')
+        conn.commit()
+        for pragma in MM_DURABLE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+    finally:
+        conn.close()
+
+
+# secondary indexes of the OpenSLEX mm used by the event and case notion discovery: name, table and columns.
+# The trailing columns make them covering for the joins on attribute values, relations and events
+MM_INDEXES = [
+    ('attribute_value_an_ov', 'attribute_value', ('attribute_name_id', 'object_version_id', 'value')),
+    ('attribute_value_ov_an', 'attribute_value', ('object_version_id', 'attribute_name_id', 'value')),
+    ('relation_rs_source', 'relation', ('relationship_id', 'source_object_version_id', 'target_object_version_id')),
+    ('relation_rs_target', 'relation', ('relationship_id', 'target_object_version_id', 'source_object_version_id')),
+    ('event_to_object_version_ov', 'event_to_object_version', ('object_version_id', 'event_id')),
+    ('object_version_object', 'object_version', ('object_id',)),
+    ('object_class', 'object', ('class_id',)),
+]
+
+
+# get the indexes of MM_INDEXES for the OpenSLEX mm. With value-dictionary storage, the indexes of
+# attribute_value are on attribute_value_data and cover the value ids as well
+def _get_mm_indexes(mm_engine: Engine):
+    if get_attribute_value_table(mm_engine) == 'attribute_value':
+        return MM_INDEXES
+    return [(name, 'attribute_value_data', tuple(c for col in columns for c in (('value_id', 'value') if col == 'value'
+                                                                                else (col,))))
+            if table == 'attribute_value' else (name, table, columns) for name, table, columns in MM_INDEXES]
+
+
+# get the names of the indexes of MM_INDEXES missing in the OpenSLEX mm
+def get_missing_mm_indexes(mm_engine: Engine):
+    existing = {r[0] for r in mm_engine.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    return [name for name, _, _ in MM_INDEXES if name not in existing]
+
+
+# create the indexes of MM_INDEXES missing in the OpenSLEX mm and update the statistics of the query planner.
+# Returns the names of the indexes created
+def create_mm_indexes(mm_engine: Engine):
+    missing = get_missing_mm_indexes(mm_engine)
+    if not missing:
+        return missing
+    conn = mm_engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        for name, table, columns in tqdm([i for i in _get_mm_indexes(mm_engine) if i[0] in missing],
+                                         desc='Creating indexes'):
+            cursor.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(name, table, ', '.join(columns)))
+        conn.commit()
+        cursor.execute('ANALYZE')
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+    return missing
+
+
+# make sure the OpenSLEX mm has the indexes of MM_INDEXES before querying it, creating them if needed.
+# Run `eddytools mm index` after the extraction to create them only once
+def check_mm_indexes(mm_engine: Engine):
+    missing = get_missing_mm_indexes(mm_engine)
+    if missing:
+        print('OpenSLEX MM is missing indexes: {}. Creating them'.format(', '.join(missing)))
+        create_mm_indexes(mm_engine)
+
+
 # create engine for the source database using SQLAlchemy
 def create_db_engine(dialect=None, host=None, username=None, password=None, port=None,
                            database=None, trusted_conn=False, **params):
@@ -102,24 +282,108 @@ def create_db_engine_from_url(db_url, **params):
     return engine
 
 
-def get_metadata(db_engine: Engine, schemas=None) -> MetaData:
-    metadata = MetaData(bind=db_engine)
-    metadata.tables = dict()
+# queries of the catalog of every dialect whose results change when the tables of a schema change:
+# their names, columns and constraints, or the time of their last change. Other dialects use information_schema
+_CATALOG_QUERIES = {
+    'sqlite': ['SELECT type, name, tbl_name, sql FROM "{schema}".sqlite_master ORDER BY type, name'],
+    'postgresql': ['SELECT table_name, column_name, data_type, is_nullable FROM information_schema.columns '
+                   'WHERE table_schema = :schema ORDER BY table_name, ordinal_position',
+                   'SELECT C.conrelid::regclass::text, C.conname, pg_get_constraintdef(C.oid) '
+                   'FROM pg_constraint AS C, pg_namespace AS N WHERE C.connamespace = N.oid AND N.nspname = :schema '
+                   'ORDER BY 1, 2'],
+    'oracle': ['SELECT object_name, object_type, last_ddl_time FROM all_objects WHERE owner = :schema '
+               "AND object_type IN ('TABLE', 'VIEW') ORDER BY object_name, object_type",
+               'SELECT table_name, count(*) FROM all_tab_columns WHERE owner = :schema '
+               'GROUP BY table_name ORDER BY table_name'],
+    None: ['SELECT table_name, column_name, data_type, is_nullable FROM information_schema.columns '
+           'WHERE table_schema = :schema ORDER BY table_name, ordinal_position',
+           'SELECT table_name, constraint_name, column_name FROM information_schema.key_column_usage '
+           'WHERE table_schema = :schema ORDER BY table_name, constraint_name, ordinal_position'],
+}
+
+# number of tables of a schema reflected by every job of a parallel reflection
+_REFLECTION_BATCH_SIZE = 100
+
+
+# get a fingerprint of the catalog of the schemas of the db, which changes when their tables change
+def get_catalog_fingerprint(db_engine: Engine, schemas):
+    url = db_engine.url
+    h = blake2b(digest_size=16)
+    h.update(repr((url.drivername, url.host, url.port, url.database, sorted(schemas))).encode('utf-8'))
+    queries = _CATALOG_QUERIES.get(db_engine.dialect.name, _CATALOG_QUERIES[None])
+    with db_engine.connect() as conn:
+        for schema in sorted(schemas):
+            for query in queries:
+                for row in conn.execute(text(query.format(schema=schema.replace('"', '""'))).bindparams(
+                        **({'schema': schema} if ':schema' in query else {}))):
+                    h.update(repr(tuple(row)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _reflect_tables(db_engine: Engine, schema, table_names=None):
+    m = MetaData(bind=db_engine)
+    m.reflect(schema=schema, only=table_names)
+    return m
+
+
+# reflect the tables of the schemas of the db (all if None). With jobs > 1, schemas are reflected in batches of
+# tables by a pool of jobs. With cache_dir, the metadata is saved there in a snapshot named after the fingerprint
+# of the catalog (get_catalog_fingerprint), and loaded from it while the catalog does not change
+def get_metadata(db_engine: Engine, schemas=None, jobs=1, cache_dir=None) -> MetaData:
+    insp = inspect(db_engine)
     if not schemas:
-        insp = inspect(db_engine)
         schemas = insp.get_schema_names()
-    for schema in schemas:
-        m = MetaData(bind=db_engine)
-        m.reflect(schema=schema)
-        for t in m.tables.values():
-            metadata.tables[t.fullname] = t
+    snapshot_path = None
+    if cache_dir:
+        snapshot_path = os.path.join(cache_dir, 'metadata-{}.pickle.gz'.format(
+            get_catalog_fingerprint(db_engine, schemas)))
+        if os.path.exists(snapshot_path):
+            with gzip.open(snapshot_path, 'rb') as f:
+                metadata = pickle.load(f)
+            # the bind of a MetaData is not pickled
+            for m in {t.metadata for t in metadata.tables.values()} | {metadata}:
+                m.bind = db_engine
+            return metadata
+
+    metadata = MetaData(bind=db_engine)
+    metadata.tables = dict()
+    if jobs > 1:
+        units = []
+        for schema in schemas:
+            table_names = insp.get_table_names(schema=schema)
+            batch_size = max(1, min(_REFLECTION_BATCH_SIZE, math.ceil(table_names.__len__() / jobs)))
+            units.extend((schema, table_names[i:i + batch_size]) for i in range(0, table_names.__len__(), batch_size))
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            reflected = list(executor.map(lambda unit: _reflect_tables(db_engine, *unit), units))
+        referred = dict()
+        for (schema, table_names), m in zip(units, reflected):
+            for t in m.tables.values():
+                if t.schema == schema and t.name in table_names:
+                    metadata.tables[t.fullname] = t
+                else:
+                    # tables referred to by foreign keys, reflected by their own batch unless in another schema
+                    referred.setdefault(t.fullname, t)
+        for fullname, t in referred.items():
+            metadata.tables.setdefault(fullname, t)
+    else:
+        for schema in schemas:
+            m = _reflect_tables(db_engine, schema)
+            for t in m.tables.values():
+                metadata.tables[t.fullname] = t
+
+    if snapshot_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        with gzip.open(snapshot_path + '.tmp', 'wb') as f:
+            pickle.dump(metadata, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(snapshot_path + '.tmp', snapshot_path)
     return metadata
 
 
 # reflect the metadata of the OpenSLEX mm into a SQLAlchemy MetaData object
 def get_mm_meta(mm_engine):
     mm_meta = MetaData()
-    mm_meta.reflect(bind=mm_engine)
+    # with value-dictionary storage, attribute_value is a view
+    mm_meta.reflect(bind=mm_engine, views=True)
     return mm_meta
 
 
@@ -151,6 +415,74 @@ def get_data_type(col):
         return 'timestamp'
 
 
+# range of the integers stored by SQLite
+_MIN_INTEGER = -(1 << 63)
+_MAX_INTEGER = (1 << 63) - 1
+
+
+def _to_integer(value):
+    number = None
+    if isinstance(value, int) and not isinstance(value, bool):
+        number = value
+    elif isinstance(value, float) and value.is_integer():
+        number = int(value)
+    elif isinstance(value, str):
+        try:
+            number = int(value)
+        except ValueError:
+            pass
+    if number is not None and _MIN_INTEGER <= number <= _MAX_INTEGER:
+        return number, None
+    return str(value), 'string'
+
+
+def _to_numeric(value):
+    if isinstance(value, int) and not isinstance(value, bool) and _MIN_INTEGER <= value <= _MAX_INTEGER:
+        return value, None
+    if isinstance(value, (float, Decimal, str)):
+        try:
+            number = float(value)
+        except ValueError:
+            number = None
+        # SQLite stores NaN as NULL
+        if number is not None and math.isfinite(number):
+            return number, None
+    return str(value), 'string'
+
+
+def _to_boolean(value):
+    if isinstance(value, bool) or (isinstance(value, int) and value in (0, 1)):
+        return int(value), None
+    return str(value), 'string'
+
+
+def _to_timestamp(value):
+    try:
+        if isinstance(value, datetime):
+            return int(value.timestamp() * 1000), None
+        if isinstance(value, date):
+            return int(datetime(value.year, value.month, value.day).timestamp() * 1000), None
+        if isinstance(value, str):
+            return int(ciso8601.parse_datetime(value).timestamp() * 1000), None
+    except (ValueError, OverflowError, OSError):
+        pass
+    return str(value), 'string'
+
+
+# converters of the values of the source db to the values stored in the OpenSLEX mm for the data types of
+# get_data_type, returning (value, type). Numbers are stored as SQLite numbers and timestamps as epoch millis
+# (in local time if they have no time zone), so they are not parsed again by every consumer of the mm.
+# The type of a value is NULL when it is the type of its attribute. Values that cannot be converted are stored
+# as strings with type 'string'
+ATTRIBUTE_CONVERTERS = {
+    'integer': _to_integer,
+    'numeric': _to_numeric,
+    'boolean': _to_boolean,
+    'timestamp': _to_timestamp,
+    'string': lambda value: (str(value), None),
+}
+
+
 '''
 insert the metadata of the source database (classes, attributes and relationships) into the OpenSLEX mm
 returns:
@@ -212,9 +544,135 @@ def insert_metadata(mm_conn, mm_meta: MetaData, db_meta: MetaData, dm_name, clas
     return class_map, attr_map, rel_map
 
 
+# read the maps of classes, attributes and relationships of a datamodel already in the OpenSLEX mm
+def get_metadata_maps(mm_conn, classes):
+    class_map = {name: id for id, name in mm_conn.execute('SELECT id, name FROM class')}
+    attr_map = {(c_name, a_name): id for id, c_name, a_name in mm_conn.execute(
+        'SELECT AN.id, CL.name, AN.name FROM attribute_name AS AN, class AS CL WHERE AN.class_id = CL.id')}
+    rel_map = {(c_name, rs_name): id for id, c_name, rs_name in mm_conn.execute(
+        'SELECT RS.id, CL.name, RS.name FROM relationship AS RS, class AS CL WHERE RS.source = CL.id')}
+    for c in classes:
+        if c not in class_map:
+            raise Exception('Class {} is not in the OpenSLEX mm to resume'.format(c))
+    return class_map, attr_map, rel_map
+
+
+# progress of an extraction, stored in the OpenSLEX mm itself: the classes whose objects ('objects') or
+# objects and relations ('relations') are committed
+_CHECKPOINT_TABLE = 'extraction_checkpoint'
+
+
+def create_checkpoint_table(mm_conn):
+    mm_conn.execute('CREATE TABLE IF NOT EXISTS {} (class_name TEXT PRIMARY KEY, phase TEXT NOT NULL)'
+                    .format(_CHECKPOINT_TABLE))
+
+
+def get_checkpoints(mm_conn):
+    return {c: phase for c, phase in mm_conn.execute('SELECT class_name, phase FROM {}'.format(_CHECKPOINT_TABLE))}
+
+
+# record the phase completed for the classes, in the transaction that commits their data
+def set_checkpoint(mm_conn, class_names, phase):
+    cursor = mm_conn.connection.cursor()
+    cursor.executemany('INSERT OR REPLACE INTO {} (class_name, phase) VALUES (?, ?)'.format(_CHECKPOINT_TABLE),
+                       [(c, phase) for c in class_names])
+    cursor.close()
+
+
+# delete the objects of classes whose extraction did not finish. Parallel extractions commit the objects
+# of several classes together, so some of them may be in the mm without a checkpoint
+def delete_class_objects(mm_conn, class_ids):
+    if not class_ids:
+        return
+    ids = ', '.join(str(int(i)) for i in class_ids)
+    attr_v_table = get_attribute_value_table(mm_conn)
+    trans = mm_conn.begin()
+    try:
+        mm_conn.execute('DELETE FROM {} WHERE object_version_id IN '
+                        '(SELECT OV.id FROM object_version AS OV, object AS O '
+                        'WHERE OV.object_id = O.id AND O.class_id IN ({}))'.format(attr_v_table, ids))
+        mm_conn.execute('DELETE FROM object_version WHERE object_id IN '
+                        '(SELECT id FROM object WHERE class_id IN ({}))'.format(ids))
+        mm_conn.execute('DELETE FROM object WHERE class_id IN ({})'.format(ids))
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+
+
+# watermarks of an incremental extraction, stored in the OpenSLEX mm: for every class, the column of its
+# source table that grows with every change (an update timestamp or an increasing key) and its greatest value
+# already extracted. Values are stored as text with the name of their type
+_WATERMARK_TABLE = 'extraction_watermark'
+
+_WATERMARK_PARSERS = {
+    'int': int,
+    'float': float,
+    'str': str,
+    'decimal': Decimal,
+    'datetime': ciso8601.parse_datetime,
+    'date': lambda v: ciso8601.parse_datetime(v).date(),
+}
+
+
+def _encode_watermark(value):
+    if isinstance(value, datetime):
+        return value.isoformat(), 'datetime'
+    if isinstance(value, date):
+        return value.isoformat(), 'date'
+    if isinstance(value, Decimal):
+        return str(value), 'decimal'
+    for type_name in ('int', 'float', 'str'):
+        if type(value).__name__ == type_name:
+            return str(value), type_name
+    raise Exception('Unsupported watermark value {!r} of type {}'.format(value, type(value).__name__))
+
+
+def create_watermark_table(mm_conn):
+    mm_conn.execute('CREATE TABLE IF NOT EXISTS {} (class_name TEXT PRIMARY KEY, column_name TEXT NOT NULL, '
+                    'value TEXT, value_type TEXT)'.format(_WATERMARK_TABLE))
+
+
+# get the watermarks stored in the OpenSLEX mm: {class_name: (column_name, value)}
+def get_watermarks(mm_conn):
+    create_watermark_table(mm_conn)
+    return {c: (col, _WATERMARK_PARSERS[value_type](value) if value is not None else None)
+            for c, col, value, value_type in mm_conn.execute(
+                'SELECT class_name, column_name, value, value_type FROM {}'.format(_WATERMARK_TABLE))}
+
+
+# store the watermarks {class_name: (column_name, value)}. With replace=False, the ones already stored are kept
+def set_watermarks(mm_conn, watermarks, replace=True):
+    create_watermark_table(mm_conn)
+    cursor = mm_conn.connection.cursor()
+    values = []
+    for c, (col, value) in watermarks.items():
+        value, value_type = _encode_watermark(value) if value is not None else (None, None)
+        values.append((c, col, value, value_type))
+    cursor.executemany('INSERT OR {} INTO {} (class_name, column_name, value, value_type) VALUES (?, ?, ?, ?)'
+                       .format('REPLACE' if replace else 'IGNORE', _WATERMARK_TABLE), values)
+    cursor.close()
+
+
+# get the greatest value of the watermark column of a source table, as returned by the DBAPI
+def get_watermark_value(db_engine, source_table: Table, column_name):
+    if column_name not in source_table.c:
+        raise Exception('Watermark column {} not found in {}'.format(column_name, source_table.fullname))
+    with SourceReader(db_engine, select([func.max(source_table.c[column_name])])) as reader:
+        for rows in reader.batches():
+            return rows[0][0]
+    return None
+
+
+# get the directory where the keys of the extracted classes are saved, to resume or update the extraction
+def get_keys_dir(openslex_file_path, cache_dir=None):
+    return os.path.join(cache_dir or os.path.dirname(str(openslex_file_path)),
+                        '{}.keys'.format(os.path.basename(str(openslex_file_path))))
+
+
 # insert object, object version, object attribute values into the OpenSLEX mm for one object in the source db
 def insert_object(mm_conn, obj, source_table, class_name, class_map, attr_map,
-                  rel_map, obj_v_map, obj_hash_map, mm_meta):
+                  rel_map, key_index: KeyIndex, mm_meta):
     trans = mm_conn.begin()
     try:
         # insert into object table
@@ -228,26 +686,9 @@ def insert_object(mm_conn, obj, source_table, class_name, class_map, attr_map,
         obj_v_values = {'object_id': obj_id, 'start_timestamp': -2, 'end_timestamp': -1}
         res_ins_obj_v = insert_values(mm_conn, obj_v_table, obj_v_values)
         obj_v_id = res_ins_obj_v.inserted_primary_key[0]
-        # pk_tuple = tuple(col.name for col in source_table.primary_key.columns)
-        # pk_values_tuple = tuple(obj[col] for col in pk_tuple)
-        # obj_v_map[(class_name, pk_tuple, pk_values_tuple)] = obj_v_id
-
-        unique_constraints = [uc for uc in source_table.constraints if isinstance(uc, (UniqueConstraint,
-                                                                                       PrimaryKeyConstraint))]
-        notunique = True
-        for uc in unique_constraints:
-            if uc.columns:
-                notunique = False
-                unique_tuple = tuple(col.name for col in uc)
-                unique_values_tuple = tuple(obj[col] for col in unique_tuple)
-                v_tuple = (class_name, unique_tuple, unique_values_tuple)
-                _set_v_id_for_values(obj_v_map, obj_hash_map, v_tuple, obj_v_id)
-
-        if notunique:
-            unique_tuple = tuple(col.name for col in source_table.columns)
-            unique_values_tuple = tuple(obj[col] for col in unique_tuple)
-            v_tuple = (class_name, unique_tuple, unique_values_tuple)
-            _set_v_id_for_values(obj_v_map, obj_hash_map, v_tuple, obj_v_id)
+
+        for unique_tuple in _get_unique_tuples(source_table):
+            key_index.add(class_name, unique_tuple, tuple(obj[col] for col in unique_tuple), obj_v_id)
 
         # insert into attribute_value table
         attr_v_table = mm_meta.tables.get('attribute_value')
@@ -255,10 +696,12 @@ def insert_object(mm_conn, obj, source_table, class_name, class_map, attr_map,
         attr_v_values = []
         for attr in obj.items():
             if ((class_name, attr[0]) in attr_map.keys()) and attr[1]:
+                 value, value_type = ATTRIBUTE_CONVERTERS[get_data_type(source_table.c[attr[0]])](attr[1])
                  attr_v_values.append(
                      {'object_version_id': obj_v_id,
                       'attribute_name_id': attr_map[(class_name, attr[0])],
-                      'value': str(attr[1])
+                      'value': value,
+                      'type': value_type
                       })
 
         res_ins_attr_v = insert_values(mm_conn, attr_v_table, attr_v_values)
@@ -268,126 +711,933 @@ def insert_object(mm_conn, obj, source_table, class_name, class_map, attr_map,
         raise
 
 
-def _get_dict_from_cursor(cursor):
-    tup = cursor.fetchone()
-
-    obj = None
-
-    if tup:
-        obj = dict()
-        for i, c in enumerate(cursor.description):
-            obj[c[0]] = tup[i]
-
-    return obj
+# create a cursor on a raw connection to the source db. Server-side cursors are used when the dialect supports
+# them, so the driver does not buffer the whole result in memory
+def _create_source_cursor(db_engine: Engine, dbapi_conn, batch_size=DEFAULT_BATCH_SIZE):
+    dialect = db_engine.dialect
+    if getattr(dialect, 'supports_server_side_cursors', False):
+        if dialect.name == 'postgresql':
+            cursor = dbapi_conn.cursor('eddytools_{}'.format(uuid4().hex))
+            cursor.itersize = batch_size
+            return cursor
+        sscursor = getattr(dialect, '_sscursor', None)
+        if sscursor:
+            return dbapi_conn.cursor(sscursor)
+    return dbapi_conn.cursor()
+
+
+class SourceReader:
+    """Streams the rows of a query on the source db in batches of plain tuples fetched with fetchmany.
+    Columns are looked up by position through the single map in `index` (column name -> position).
+    Values are the ones returned by the DBAPI, without the type conversions of SQLAlchemy.
+    fetch_time is the time spent fetching the last batch."""
+
+    def __init__(self, db_engine: Engine, query, batch_size=DEFAULT_BATCH_SIZE):
+        self.batch_size = max(int(batch_size), 1)
+        self.conn = db_engine.raw_connection()
+        try:
+            self.cursor = _create_source_cursor(db_engine, self.conn, self.batch_size)
+            # bound values of the query are passed to the DBAPI as they are, without type conversions
+            compiled = query.compile(dialect=db_engine.dialect)
+            params = compiled.construct_params()
+            if compiled.positional:
+                params = tuple(params[name] for name in compiled.positiontup)
+            self.cursor.execute(str(compiled), params)
+        except:
+            self.conn.close()
+            raise
+        self.columns = None
+        self.index = None
+        self.fetch_time = 0.0
+
+    def batches(self):
+        while True:
+            t1 = time.time()
+            rows = self.cursor.fetchmany(self.batch_size)
+            self.fetch_time = time.time() - t1
+            if self.columns is None and self.cursor.description:
+                # named cursors only have a description after the first fetch
+                self.columns = [c[0] for c in self.cursor.description]
+                self.index = {c: i for i, c in enumerate(self.columns)}
+            if not rows:
+                break
+            yield rows
+
+    def close(self):
+        try:
+            self.cursor.close()
+        finally:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# get the tuples of column names that identify an object of the source table
+# (its unique and primary keys, or all its columns if it has none)
+def _get_unique_tuples(source_table: Table):
+    unique_tuples = []
+    for uc in source_table.constraints:
+        if isinstance(uc, (UniqueConstraint, PrimaryKeyConstraint)) and uc.columns:
+            unique_tuples.append(tuple(col.name for col in uc))
+    if not unique_tuples:
+        unique_tuples.append(tuple(col.name for col in source_table.columns))
+    return unique_tuples
+
+
+class AttributeDictionary:
+    """The dictionary of the string values of every attribute of an OpenSLEX mm with value-dictionary storage,
+    loaded from the mm and extended while values are inserted. An attribute takes at most max_values values
+    in the dictionary, so attributes with many distinct values (names, notes) are stored as they are."""
+
+    def __init__(self, cursor, max_values=DICTIONARY_MAX_VALUES):
+        self.max_values = max_values
+        self.ids = dict()
+        self.sizes = dict()
+        self.pending = []
+        cursor.execute('SELECT id, attribute_name_id, value FROM attribute_value_dictionary')
+        for value_id, attr_id, value in cursor.fetchall():
+            self.ids[(attr_id, value)] = value_id
+            self.sizes[attr_id] = self.sizes.get(attr_id, 0) + 1
+        self.next_id = max(self.ids.values(), default=0) + 1
+
+    # get the id of the value in the dictionary, adding it if the attribute has room for it. None if it has not
+    def encode(self, attr_id, value):
+        value_id = self.ids.get((attr_id, value))
+        if value_id is None:
+            size = self.sizes.get(attr_id, 0)
+            if size >= self.max_values:
+                return None
+            value_id = self.next_id
+            self.next_id += 1
+            self.ids[(attr_id, value)] = value_id
+            self.sizes[attr_id] = size + 1
+            self.pending.append((value_id, attr_id, value))
+        return value_id
+
+    def flush(self, cursor):
+        if self.pending:
+            cursor.executemany('INSERT INTO attribute_value_dictionary (id, attribute_name_id, value) '
+                               'VALUES (?, ?, ?)', self.pending)
+            self.pending = []
+
+
+class ObjectBatchWriter:
+    """Buffers objects, object versions and attribute values and writes them to the
+    OpenSLEX mm with one executemany per table. Ids are assigned here instead of
+    being read back from the database after every insert, so the writer must be
+    the only one inserting into these tables while it is in use.
+    In OpenSLEX mms with value-dictionary storage, string values are replaced by their id
+    in the AttributeDictionary, which writers sharing ids must share too.
+    write_time is the total time spent executing the inserts."""
+
+    def __init__(self, mm_conn: Connection, batch_size=DEFAULT_BATCH_SIZE, first_ids=None, max_objects=None,
+                 dictionary: AttributeDictionary = None):
+        self.mm_conn = mm_conn
+        self.batch_size = max(int(batch_size), 1)
+        self.cursor = mm_conn.connection.cursor()
+        self.attr_v_table = get_attribute_value_table(self.cursor)
+        if dictionary is None and self.attr_v_table == 'attribute_value_data':
+            dictionary = AttributeDictionary(self.cursor)
+        self.dictionary = dictionary
+        if first_ids:
+            self.next_obj_id, self.next_obj_v_id, self.next_attr_v_id = first_ids
+        else:
+            self.next_obj_id = self._next_id('object')
+            self.next_obj_v_id = self._next_id('object_version')
+            self.next_attr_v_id = self._next_id(self.attr_v_table)
+        self.max_objects = max_objects
+        self.num_objects = 0
+        self.write_time = 0.0
+        self.objs = []
+        self.obj_vs = []
+        self.attr_vs = []
+
+    def _next_id(self, table_name):
+        # fetch all rows, so the statement is done and releases its read lock
+        self.cursor.execute('SELECT coalesce(max(id), 0) FROM {}'.format(table_name))
+        return self.cursor.fetchall()[0][0] + 1
+
+    # reserve consecutive ids for num_objs objects with up to num_attr_vs attribute values, to be assigned
+    # by another writer created with first_ids and max_objects. Returns the first reserved ids
+    def reserve(self, num_objs, num_attr_vs):
+        first_ids = (self.next_obj_id, self.next_obj_v_id, self.next_attr_v_id)
+        self.next_obj_id += num_objs
+        self.next_obj_v_id += num_objs
+        self.next_attr_v_id += num_attr_vs
+        return first_ids
+
+    # buffer one object with its attribute values [(attribute_name_id, value, type)] and return its object version id.
+    # With object_id, only a new version of that object is added, valid from start_timestamp
+    def add_object(self, class_id, attr_values, object_id=None, start_timestamp=-2):
+        self.num_objects += 1
+        if self.max_objects is not None and self.num_objects > self.max_objects:
+            raise Exception('More objects than the {} ids reserved for them. '
+                            'Has the source table changed during the extraction?'.format(self.max_objects))
+        if object_id is None:
+            obj_id = self.next_obj_id
+            self.next_obj_id += 1
+            self.objs.append((obj_id, class_id))
+        else:
+            obj_id = object_id
+        obj_v_id = self.next_obj_v_id
+        self.next_obj_v_id += 1
+
+        self.obj_vs.append((obj_v_id, obj_id, start_timestamp, -1))
+        dictionary = self.dictionary
+        for attr_id, value, value_type in attr_values:
+            if dictionary and value.__class__ is str:
+                value_id = dictionary.encode(attr_id, value)
+                if value_id is not None:
+                    self.attr_vs.append((self.next_attr_v_id, obj_v_id, attr_id, None, value_id, value_type))
+                    self.next_attr_v_id += 1
+                    continue
+            self.attr_vs.append((self.next_attr_v_id, obj_v_id, attr_id, value, None, value_type)
+                                if dictionary else (self.next_attr_v_id, obj_v_id, attr_id, value, value_type))
+            self.next_attr_v_id += 1
+
+        if self.obj_vs.__len__() >= self.batch_size:
+            self.flush()
+
+        return obj_v_id
+
+    def flush(self):
+        t1 = time.time()
+        if self.objs:
+            self.cursor.executemany('INSERT INTO object (id, class_id) VALUES (?, ?)', self.objs)
+        if self.obj_vs:
+            self.cursor.executemany('INSERT INTO object_version (id, object_id, start_timestamp, end_timestamp) '
+                                    'VALUES (?, ?, ?, ?)', self.obj_vs)
+        if self.dictionary:
+            self.dictionary.flush(self.cursor)
+            if self.attr_vs:
+                self.cursor.executemany('INSERT INTO attribute_value_data (id, object_version_id, attribute_name_id, '
+                                        'value, value_id, type) VALUES (?, ?, ?, ?, ?, ?)', self.attr_vs)
+        elif self.attr_vs:
+            self.cursor.executemany('INSERT INTO attribute_value (id, object_version_id, attribute_name_id, value, '
+                                    'type) VALUES (?, ?, ?, ?, ?)', self.attr_vs)
+        self.objs = []
+        self.obj_vs = []
+        self.attr_vs = []
+        self.write_time += time.time() - t1
+
+    # flush the buffered rows, unless the load failed, and release the cursor before the connection is closed
+    def close(self, flush=True):
+        if flush:
+            self.flush()
+        self.cursor.close()
+
+
+class RelationBuffer:
+    """Foreign key values collected while the objects of each class are inserted (single-pass extraction).
+    Every entry keeps the object version id of the source object, the relationship it belongs to and the
+    encoded key of the referred object, so the relations can be resolved once all classes are in the key index.
+    Entries are kept in compact buffers and appended to a temporary file under spill_dir when they grow
+    over memory_budget bytes. With sort_runs, they are appended as runs sorted by spec id and key digest,
+    to be merge-joined with the key index (see insert_merged_relations)."""
+
+    def __init__(self, spill_dir=None, memory_budget=DEFAULT_MEMORY_BUDGET, sort_runs=False):
+        self.spill_dir = spill_dir
+        self.memory_budget = memory_budget
+        self.sort_runs = sort_runs
+        self.specs = []
+        self.spill_file = None
+        self._reset()
+
+    def _reset(self):
+        self.spec_ids = array('q')
+        self.ov_ids = array('q')
+        self.key_lengths = array('q')
+        self.keys = bytearray()
+
+    # register a relationship and return its spec id: (relationship_id, referred class, referred columns)
+    def add_spec(self, rel_id, ref_class, ref_cols):
+        self.specs.append((rel_id, ref_class, ref_cols))
+        return self.specs.__len__() - 1
+
+    def add(self, spec_id, source_ov_id, values):
+        key = encode_key(values)
+        self.spec_ids.append(spec_id)
+        self.ov_ids.append(source_ov_id)
+        self.key_lengths.append(key.__len__())
+        self.keys.extend(key)
+        if (self.spec_ids.__len__() * 24) + self.keys.__len__() > self.memory_budget:
+            self._spill()
+
+    def _spill(self):
+        if not self.spill_file:
+            if self.spill_dir:
+                os.makedirs(self.spill_dir, exist_ok=True)
+            self.spill_file = tempfile.TemporaryFile(prefix='relation_buffer-', dir=self.spill_dir)
+        chunk = self._sorted_run() if self.sort_runs else \
+            (self.spec_ids, self.ov_ids, self.key_lengths, bytes(self.keys))
+        pickle.dump(chunk, self.spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._reset()
+
+    # sort the buffered entries by spec id and key digest (stable, so in insertion order for repeated keys):
+    # (spec_ids, ov_ids, digests, key_lengths, keys), with the keys one after the other in that order
+    def _sorted_run(self):
+        spec_ids = np.frombuffer(self.spec_ids, dtype=np.int64)
+        lengths = np.frombuffer(self.key_lengths, dtype=np.int64)
+        starts = np.cumsum(lengths) - lengths
+        keys = bytes(self.keys)
+        digests = np.fromiter((key_digest(keys[start:start + length])
+                               for start, length in zip(starts.tolist(), lengths.tolist())),
+                              dtype=np.uint64, count=spec_ids.__len__())
+        order = np.lexsort((digests, spec_ids))
+        return (spec_ids[order], np.frombuffer(self.ov_ids, dtype=np.int64)[order], digests[order], lengths[order],
+                np.frombuffer(keys, dtype=np.uint8)[key_positions(starts[order], lengths[order])])
+
+    # yield the buffered entries in insertion order as lists of (spec_id, source_ov_id, encoded key)
+    def chunks(self):
+        if self.spill_file:
+            self.spill_file.seek(0)
+            while True:
+                try:
+                    chunk = pickle.load(self.spill_file)
+                except EOFError:
+                    break
+                yield self._entries(*chunk)
+        yield self._entries(self.spec_ids, self.ov_ids, self.key_lengths, self.keys)
+
+    # yield the buffered entries (with sort_runs) in runs sorted by key digest, one for every spec in every chunk:
+    # (spec_id, source ov ids, digests, keys, key starts, key lengths)
+    def sorted_runs(self):
+        if self.spill_file:
+            self.spill_file.seek(0)
+            while True:
+                try:
+                    run = pickle.load(self.spill_file)
+                except EOFError:
+                    break
+                yield from self._spec_runs(*run)
+        yield from self._spec_runs(*self._sorted_run())
+
+    @staticmethod
+    def _spec_runs(spec_ids, ov_ids, digests, key_lengths, keys):
+        key_starts = np.cumsum(key_lengths) - key_lengths
+        bounds = [0] + (np.nonzero(np.diff(spec_ids))[0] + 1).tolist() + [spec_ids.__len__()]
+        for low, high in zip(bounds[:-1], bounds[1:]):
+            if low < high:
+                yield (int(spec_ids[low]), ov_ids[low:high], digests[low:high], keys, key_starts[low:high],
+                       key_lengths[low:high])
+
+    @staticmethod
+    def _entries(spec_ids, ov_ids, key_lengths, keys):
+        entries = []
+        start = 0
+        for spec_id, ov_id, length in zip(spec_ids, ov_ids, key_lengths):
+            entries.append((spec_id, ov_id, bytes(keys[start:start + length])))
+            start += length
+        return entries
+
+    def close(self):
+        self._reset()
+        if self.spill_file:
+            self.spill_file.close()
+            self.spill_file = None
+
+
+_STAGING_PREFIX = 'relation_staging_'
+
+
+def get_staging_tables(mm_conn):
+    return [name for name, in mm_conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                              "AND name GLOB '{}*'".format(_STAGING_PREFIX)).fetchall()]
+
+
+def drop_staging_tables(mm_conn):
+    for name in get_staging_tables(mm_conn):
+        mm_conn.execute('DROP TABLE {}'.format(name))
+
+
+# digest of the values of a key as a signed 64-bit integer, to be stored in SQLite
+def _stage_digest(values):
+    digest = key_digest(encode_key(values))
+    return digest - (1 << 64) if digest > _MAX_INTEGER else digest
+
+
+# value of a key column as stored in a staging table. Values SQLite cannot store as they are
+# (decimals, dates, big integers...) are stored encoded with encode_key
+def _stage_value(value):
+    if value is None or value.__class__ in (str, float, bytes) or \
+            (value.__class__ is int and _MIN_INTEGER <= value <= _MAX_INTEGER):
+        return value
+    return encode_key((value,))
+
+
+class RelationStaging:
+    """Keys and foreign keys of the objects of every class, staged in tables of the OpenSLEX mm while the objects
+    are inserted, so insert_staged_relations resolves the relations in SQLite with one INSERT ... SELECT ... JOIN
+    per foreign key instead of one key index lookup per row and foreign key.
+    The staging table of a class has the object version id of every object, the digests of its keys referred to
+    by foreign keys and of its foreign keys, and the values of their columns, which tell apart keys with the
+    same digest. Rows are written with a cursor of mm_conn, in the transaction of the objects they belong to."""
+
+    def __init__(self, mm_conn: Connection, db_meta: MetaData, classes, class_map, rel_map,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        self.mm_conn = mm_conn
+        self.batch_size = max(int(batch_size), 1)
+        self.cursor = mm_conn.connection.cursor()
+        self.classes = dict()
+        self.rows = dict()
+        unique_tuples = {c: _get_unique_tuples(db_meta.tables.get(c)) for c in classes}
+        # only the foreign keys referring to a key of an extracted class are resolved, as with the key index
+        fk_specs = {c: [spec for spec in _get_relation_specs(db_meta.tables.get(c), c, rel_map)[1]
+                        if spec[2] in unique_tuples.get(spec[1], [])] for c in classes}
+        keys = {c: [] for c in classes}
+        for c in classes:
+            for _, ref_class, ref_cols, _ in fk_specs[c]:
+                k = unique_tuples[ref_class].index(ref_cols)
+                if k not in keys[ref_class]:
+                    keys[ref_class].append(k)
+        for c in classes:
+            if not (keys[c] or fk_specs[c]):
+                continue
+            tuples = unique_tuples[c]
+            # values of every column, from the first key or foreign key it is part of
+            groups = [tuples[k] for k in keys[c]] + [fk_cols for _, _, _, fk_cols in fk_specs[c]]
+            columns = dict()
+            values = []
+            for cols in groups:
+                for col in cols:
+                    if col not in columns:
+                        columns[col] = values.__len__()
+                        values.append((groups.index(cols), cols.index(col)))
+            self.classes[c] = {
+                'table': '{}{}'.format(_STAGING_PREFIX, int(class_map[c])),
+                'unique_tuples': tuples,
+                'keys': keys[c],
+                'fk_specs': fk_specs[c],
+                'columns': columns,
+                'values': values,
+            }
+            self.rows[c] = []
+
+    # create the staging tables of the classes in class_names, dropping their rows of a previous run, and return
+    # the staged classes whose tables are in the mm: these ones and the ones staged by a previous run
+    def create_tables(self, class_names):
+        existing = set(get_staging_tables(self.mm_conn))
+        trans = self.mm_conn.begin()
+        try:
+            for c in class_names:
+                stage = self.classes.get(c)
+                if stage is None:
+                    continue
+                columns = ['object_version_id INTEGER PRIMARY KEY'] + \
+                          ['k{} INTEGER'.format(k) for k in stage['keys']] + \
+                          ['f{} INTEGER'.format(i) for i in range(stage['fk_specs'].__len__())] + \
+                          ['c{}'.format(j) for j in range(stage['values'].__len__())]
+                self.mm_conn.execute('DROP TABLE IF EXISTS {}'.format(stage['table']))
+                self.mm_conn.execute('CREATE TABLE {} ({})'.format(stage['table'], ', '.join(columns)))
+                existing.add(stage['table'])
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        return {c for c, stage in self.classes.items() if stage['table'] in existing}
+
+    # stage the keys and foreign keys of an object, given the values of the unique tuples of its source table
+    # (_get_unique_tuples) and of its staged foreign keys
+    def add(self, class_name, obj_v_id, unique_values, fk_values):
+        stage = self.classes[class_name]
+        groups = [unique_values[k] for k in stage['keys']] + fk_values
+        row = [obj_v_id]
+        row.extend(_stage_digest(values) for values in groups)
+        row.extend(_stage_value(groups[g][i]) for g, i in stage['values'])
+        rows = self.rows[class_name]
+        rows.append(row)
+        if rows.__len__() >= self.batch_size:
+            self._flush_class(class_name)
+
+    def _flush_class(self, class_name):
+        rows = self.rows[class_name]
+        if rows:
+            self.cursor.executemany('INSERT INTO {} VALUES ({})'.format(
+                self.classes[class_name]['table'], ', '.join('?' * rows[0].__len__())), rows)
+            self.rows[class_name] = []
+
+    def flush(self):
+        for class_name in self.rows:
+            self._flush_class(class_name)
+
+    # get the statement inserting the relations of the foreign key fk of class_name. Repeated keys are resolved
+    # to the first object version inserted with them, as with the key index
+    def get_relation_statement(self, class_name, fk, start_timestamp=-2):
+        stage = self.classes[class_name]
+        rel_id, ref_class, ref_cols, fk_cols = stage['fk_specs'][fk]
+        ref_stage = self.classes[ref_class]
+        k = ref_stage['unique_tuples'].index(ref_cols)
+        conditions = ['T.k{} = S.f{}'.format(k, fk)] + \
+                     ['T.c{} IS S.c{}'.format(ref_stage['columns'][ref_col], stage['columns'][fk_col])
+                      for ref_col, fk_col in zip(ref_cols, fk_cols)]
+        return ('INSERT INTO relation (source_object_version_id, target_object_version_id, relationship_id, '
+                'start_timestamp, end_timestamp) '
+                'SELECT S.object_version_id, min(T.object_version_id), {}, {}, -1 FROM {} AS S JOIN {} AS T ON {} '
+                'GROUP BY S.object_version_id'.format(int(rel_id), int(start_timestamp), stage['table'],
+                                                      ref_stage['table'], ' AND '.join(conditions)))
+
+    # index the digests of the keys in the staging tables of the classes, once all their rows are written
+    def create_indexes(self, class_names):
+        for class_name in class_names:
+            stage = self.classes[class_name]
+            for k in stage['keys']:
+                self.mm_conn.execute('CREATE INDEX IF NOT EXISTS {0}_k{1} ON {0} (k{1})'.format(stage['table'], k))
+
+    def close(self):
+        self.rows = {c: [] for c in self.rows}
+        self.cursor.close()
+
+
+# get what has to be read from a source table and where it goes in the OpenSLEX mm: the class id, the columns
+# mapped to attributes, the unique keys of the objects and, if relations are buffered or staged, the foreign keys
+def _get_class_plan(source_table: Table, class_name, class_map, attr_map, rel_map,
+                    relation_buffer: RelationBuffer = None, staging: RelationStaging = None):
+    fk_specs = []
+    if relation_buffer is not None:
+        _, rel_specs = _get_relation_specs(source_table, class_name, rel_map)
+        fk_specs = [(relation_buffer.add_spec(rel_id, ref_class, ref_cols), fk_cols)
+                    for rel_id, ref_class, ref_cols, fk_cols in rel_specs]
+    elif staging is not None and class_name in staging.classes:
+        fk_specs = [(i, fk_cols) for i, (_, _, _, fk_cols) in enumerate(staging.classes[class_name]['fk_specs'])]
+    return {
+        'class_name': class_name,
+        'class_id': class_map[class_name],
+        'attr_cols': [(col.name, attr_map[(class_name, col.name)], ATTRIBUTE_CONVERTERS[get_data_type(col)])
+                      for col in source_table.columns if (class_name, col.name) in attr_map],
+        'unique_tuples': _get_unique_tuples(source_table),
+        'fk_specs': fk_specs,
+        'staged': staging is not None and class_name in staging.classes,
+    }
+
+
+# get the query reading the columns of source_table needed to extract its objects and relations: the columns
+# mapped to attributes and the columns of its keys and foreign keys. Other columns, like the binary ones that
+# get_data_type does not map to attributes, are not read from the source db
+def get_class_query(source_table: Table, class_name, attr_map, rel_map):
+    names = {col for unique_tuple in _get_unique_tuples(source_table) for col in unique_tuple}
+    names.update(col.name for col in source_table.columns if (class_name, col.name) in attr_map)
+    source_cols, fk_specs = _get_relation_specs(source_table, class_name, rel_map)
+    names.update(source_cols)
+    for _, _, _, fk_cols in fk_specs:
+        names.update(fk_cols)
+    return select([col for col in source_table.columns if col.name in names])
+
+
+# restrict a query on the table of class_name to the rows selected by its clause in filters, if any
+def _filter_query(query, filters, class_name):
+    clause = (filters or dict()).get(class_name)
+    return query if clause is None else query.where(clause)
+
+
+# get the where clauses {class_name: clause} selecting the rows to extract from a filter spec
+# {class_name: {'where': SQL condition, 'column': timestamp column, 'start': first value, 'end': value after the last}}.
+# With fk_closure, the rows referred to by the foreign keys of the rows selected are selected as well.
+# Classes without a clause are extracted whole
+def get_filter_clauses(db_meta: MetaData, filters, classes, fk_closure=False):
+    clauses = dict()
+    for class_name in classes:
+        clause = _get_filter_clause(db_meta, filters or dict(), classes, class_name,
+                                    db_meta.tables.get(class_name), fk_closure, set())
+        if clause is not None:
+            clauses[class_name] = clause
+    return clauses
+
+
+# where clause of one class on source_table (the table of the class or an alias of it). The rows referred to
+# by other classes are selected with EXISTS subqueries on them, following their own clauses. Foreign keys
+# closing a cycle of classes are not followed
+def _get_filter_clause(db_meta, filters, classes, class_name, source_table, fk_closure, visiting):
+    spec = filters.get(class_name)
+    if spec is None:
+        # the whole table is extracted
+        return None
+    for option in spec:
+        if option not in ('where', 'column', 'start', 'end'):
+            raise Exception('Unknown filter option {} of class {}'.format(option, class_name))
+    parts = []
+    if spec.get('where'):
+        parts.append(text('({})'.format(spec['where'])))
+    if spec.get('start') is not None or spec.get('end') is not None:
+        if spec.get('column') not in source_table.c:
+            raise Exception('Filter column {} not found in {}'.format(spec.get('column'), class_name))
+        col = source_table.c[spec['column']]
+        if spec.get('start') is not None:
+            parts.append(col >= spec['start'])
+        if spec.get('end') is not None:
+            parts.append(col < spec['end'])
+    clause = and_(*parts) if parts else None
+    if not fk_closure or clause is None:
+        return clause
+
+    visiting = visiting | {class_name}
+    referred = [clause]
+    for c in classes:
+        if c in visiting and c != class_name:
+            continue
+        for fkc in db_meta.tables.get(c).foreign_key_constraints:
+            if fkc.referred_table.fullname != class_name:
+                continue
+            child = db_meta.tables.get(c).alias()
+            # a foreign key of the table to itself is followed only one level
+            child_clause = _get_filter_clause(db_meta, filters, classes, c, child,
+                                              fk_closure and c != class_name, visiting)
+            conditions = [child.c[col.name] == source_table.c[fk.column.name]
+                          for col, fk in zip(fkc.columns, fkc.elements)]
+            if child_clause is not None:
+                conditions.append(child_clause)
+            referred.append(exists(select([literal_column('1')]).select_from(child).where(and_(*conditions))))
+    return or_(*referred)
+
+
+# get where clauses {class_name: clause} selecting a referentially consistent sample of the source db: `size` seed
+# rows of every root class (the first ones by key, among the rows selected by filters), the rows referring to the
+# rows selected through the foreign keys between classes, recursively, and the rows referred to by every row
+# selected. Rows reached only as referred rows do not add the rows referring to them, so the sample stays small.
+# Classes not reached are left empty. The keys of the sample are bound to the where clauses,
+# so its size is limited by the number of parameters the source db accepts in a query
+def get_sample_clauses(db_engine, db_meta: MetaData, classes, size, roots=None, filters=None,
+                       batch_size=DEFAULT_BATCH_SIZE):
+    tables = {c: db_meta.tables.get(c) for c in classes}
+    # foreign keys between the classes: (class, referred class, columns, referred columns)
+    fks = [(c, fkc.referred_table.fullname, tuple(col.name for col in fkc.columns),
+            tuple(fk.column.name for fk in fkc.elements))
+           for c in classes for fkc in tables[c].foreign_key_constraints if fkc.referred_table.fullname in tables]
+    # the rows of every class are identified by their first key, and read with the columns of their foreign keys
+    # and the columns referred to by the foreign keys of other classes
+    key_cols = {c: _get_unique_tuples(tables[c])[0] for c in classes}
+    columns = {c: list(key_cols[c]) for c in classes}
+    for c, ref_class, fk_cols, ref_cols in fks:
+        columns[c].extend(col for col in fk_cols if col not in columns[c])
+        columns[ref_class].extend(col for col in ref_cols if col not in columns[ref_class])
+
+    selected = {c: set() for c in classes}
+    followed = {c: set() for c in classes}
+    pending_referring = {c: [] for c in classes}
+    pending_referred = {c: [] for c in classes}
+
+    def read(query):
+        rows = []
+        with SourceReader(db_engine, query, batch_size) as reader:
+            for batch in reader.batches():
+                rows.extend(dict(zip(reader.columns, row)) for row in batch)
+        return rows
+
+    def add(class_name, rows, follow_referring):
+        for row in rows:
+            key = tuple(row[col] for col in key_cols[class_name])
+            if key not in selected[class_name]:
+                selected[class_name].add(key)
+                pending_referred[class_name].append(row)
+                tpb.update(1)
+            if follow_referring and key not in followed[class_name]:
+                followed[class_name].add(key)
+                pending_referring[class_name].append(row)
+
+    def read_matching(class_name, cols, rows):
+        values = {tuple(row[col] for col in fk_cols) for row, fk_cols in rows}
+        values = [v for v in values if None not in v]
+        if not values:
+            return []
+        table = tables[class_name]
+        return [row for chunk in get_chunks(values, 500) for row in read(select(
+            [table.c[col] for col in columns[class_name]]).where(get_keys_clause(table, cols, chunk)))]
+
+    with tqdm(desc='Sampling') as tpb:
+        for class_name in (roots if roots is not None else classes):
+            if class_name not in tables:
+                raise Exception('Sample root class {} is not extracted'.format(class_name))
+            table = tables[class_name]
+            query = select([table.c[col] for col in columns[class_name]]) \
+                .order_by(*[table.c[col] for col in key_cols[class_name]]).limit(size)
+            add(class_name, read(_filter_query(query, filters, class_name)), True)
+
+        while any(pending_referring.values()) or any(pending_referred.values()):
+            for class_name in classes:
+                rows, pending_referring[class_name] = pending_referring[class_name], []
+                for c, ref_class, fk_cols, ref_cols in fks:
+                    if ref_class == class_name and rows:
+                        add(c, read_matching(c, fk_cols, [(row, ref_cols) for row in rows]), True)
+                rows, pending_referred[class_name] = pending_referred[class_name], []
+                for c, ref_class, fk_cols, ref_cols in fks:
+                    if c == class_name and rows:
+                        add(ref_class, read_matching(ref_class, ref_cols, [(row, fk_cols) for row in rows]), False)
+
+    return {c: get_keys_clause(tables[c], key_cols[c], sorted(selected[c], key=repr)) for c in classes}
+
+
+# split a list of values into lists of at most size values
+def get_chunks(values, size):
+    return [values[i:i + size] for i in range(0, values.__len__(), size)]
+
+
+# where clause selecting the rows of table whose columns `cols` have one of the tuples of values
+def get_keys_clause(table: Table, cols, values):
+    if not values:
+        return false()
+    if cols.__len__() == 1:
+        col = table.c[cols[0]]
+        parts = [col.in_([v[0] for v in chunk]) for chunk in get_chunks([v for v in values if v[0] is not None], 500)]
+        if any(v[0] is None for v in values):
+            parts.append(col.is_(None))
+    else:
+        parts = [or_(*[and_(*[table.c[col] == v for col, v in zip(cols, value)]) for value in chunk])
+                 for chunk in get_chunks(values, 100)]
+    return or_(*parts) if parts.__len__() > 1 else parts[0]
+
+
+# transform a batch of source rows into records of (attribute values, unique key values, foreign key values)
+def _transform_rows(plan, index, rows):
+    attr_idxs = [(index[col], attr_id, convert) for col, attr_id, convert in plan['attr_cols']]
+    unique_idxs = [tuple(index[col] for col in unique_tuple) for unique_tuple in plan['unique_tuples']]
+    fk_idxs = [tuple(index[col] for col in fk_cols) for _, fk_cols in plan['fk_specs']]
+    records = []
+    for row in rows:
+        # values that are empty in the source db (None, 0, '') are not stored
+        records.append(([(attr_id,) + convert(row[i]) for i, attr_id, convert in attr_idxs if row[i]],
+                        [tuple(row[i] for i in idxs) for idxs in unique_idxs],
+                        [tuple(row[i] for i in idxs) for idxs in fk_idxs]))
+    return records
+
+
+# write transformed records as objects of the class in the plan, registering their keys
+def _write_records(plan, records, writer: ObjectBatchWriter, key_index: KeyIndex,
+                   relation_buffer: RelationBuffer = None, staging: RelationStaging = None,
+                   report: ExtractionReport = NO_REPORT):
+    t1 = time.time()
+    write_time = writer.write_time
+    first_ids = (writer.next_obj_id, writer.next_obj_v_id, writer.next_attr_v_id)
+    class_name = plan['class_name']
+    class_id = plan['class_id']
+    unique_tuples = plan['unique_tuples']
+    spec_ids = [spec_id for spec_id, _ in plan['fk_specs']] if relation_buffer is not None else []
+    staging = staging if plan['staged'] else None
+    for attr_values, unique_values, fk_values in records:
+        obj_v_id = writer.add_object(class_id, attr_values)
+        for unique_tuple, values in zip(unique_tuples, unique_values):
+            key_index.add(class_name, unique_tuple, values, obj_v_id)
+        for spec_id, values in zip(spec_ids, fk_values):
+            relation_buffer.add(spec_id, obj_v_id, values)
+        if staging:
+            staging.add(class_name, obj_v_id, unique_values, fk_values)
+    write_time = writer.write_time - write_time
+    report.add_times(class_name, write=write_time, sync=time.time() - t1 - write_time)
+    report.add_rows(class_name, object=writer.next_obj_id - first_ids[0],
+                    object_version=writer.next_obj_v_id - first_ids[1],
+                    attribute_value=writer.next_attr_v_id - first_ids[2])
 
 
 # insert all objects of one class into the OpenSLEX mm
 def insert_class_objects(mm_conn: Connection, mm_meta, db_engine, db_meta, class_name,
-                         class_map, attr_map, rel_map, obj_v_map, obj_hash_map):
-    t1 = time.time()
+                         class_map, attr_map, rel_map, key_index: KeyIndex,
+                         batch_size=DEFAULT_BATCH_SIZE, relation_buffer: RelationBuffer = None,
+                         checkpoint_dir=None, filters=None, staging: RelationStaging = None,
+                         report: ExtractionReport = NO_REPORT):
     trans: Transaction = mm_conn.begin()
+    writer = None
     try:
         source_table: Table = db_meta.tables.get(class_name)
-        num_objs = db_engine.execute(source_table.count()).scalar()
-
-        q = source_table.select()
-        conn = db_engine.raw_connection()
-        cursor = conn.cursor()
-        cursor.execute(str(q.compile(dialect=db_engine.dialect, compile_kwargs={"literal_binds": True})))
-
-        i = 0
-        obj = _get_dict_from_cursor(cursor)
-        with tqdm(desc='Objects', total=num_objs) as tpb:
-            while obj:
-                insert_object(mm_conn, obj, source_table, class_name, class_map,
-                              attr_map, rel_map, obj_v_map, obj_hash_map, mm_meta)
-                obj = _get_dict_from_cursor(cursor)
-                tpb.update(1)
-                i += 1
-                if i > 1000:
-                    i = 0
-                    try:
-                        obj_v_map.sync()
-                        obj_hash_map.sync()
-                    except:
-                        pass
-
-        trans.commit()
+        if relation_buffer is None and staging is None:
+            num_objs = db_engine.execute(_filter_query(select([func.count()]).select_from(source_table),
+                                                       filters, class_name)).scalar()
+        else:
+            # in single-pass mode the table is read only once, without counting its rows first
+            num_objs = None
+        plan = _get_class_plan(source_table, class_name, class_map, attr_map, rel_map, relation_buffer, staging)
+
+        writer = ObjectBatchWriter(mm_conn, batch_size)
+        query = _filter_query(get_class_query(source_table, class_name, attr_map, rel_map), filters, class_name)
+        with SourceReader(db_engine, query, batch_size) as reader, \
+                tqdm(desc='Objects', total=num_objs) as tpb:
+            for rows in reader.batches():
+                report.read(class_name, rows, reader.fetch_time)
+                with report.timed(class_name, 'transform'):
+                    records = _transform_rows(plan, reader.index, rows)
+                _write_records(plan, records, writer, key_index, relation_buffer, staging, report)
+                tpb.update(rows.__len__())
+        with report.timed(class_name, 'write'):
+            writer.close()
+        with report.timed(class_name, 'sync'):
+            if staging:
+                staging.flush()
+            if checkpoint_dir:
+                key_index.save_class(class_name, checkpoint_dir)
+                set_checkpoint(mm_conn, [class_name], 'objects')
+        with report.timed(class_name, 'write'):
+            trans.commit()
+        report.sample_rss(class_name)
     except:
+        if writer:
+            writer.close(flush=False)
         trans.rollback()
         raise
-    t2 = time.time()
-    time_diff = t2 - t1
-
-
-def _set_v_id_for_values(v_map, hash_map, values, id):
-    v_str = str(values)
-    v_hash = v_str.__hash__()
-
-    idlist = v_map.get(v_hash, [])
-    idlist.append(id)
-    v_map[v_hash] = idlist
 
-    vlist = hash_map.get(v_hash, [])
-    vlist.append(values)
-    hash_map[v_hash] = vlist
 
+# split the rows of source_table into at most `partitions` ranges of its primary key, to be read by different
+# connections. Returns a list of where clauses, or None when the table has no integer primary key to split on
+def get_key_ranges(db_engine, source_table: Table, partitions):
+    if partitions < 2 or not source_table.primary_key or not source_table.primary_key.columns:
+        return None
+    col = list(source_table.primary_key.columns)[0]
+    try:
+        if col.type.python_type is not int:
+            return None
+    except NotImplementedError:
+        return None
+    lo, hi = db_engine.execute(select([func.min(col), func.max(col)])).first()
+    if lo is None:
+        return None
+    step = -(-(hi - lo + 1) // partitions)
+    bounds = list(range(lo + step, hi + 1, step))
+    if not bounds:
+        return None
+    # the first and last ranges are open, so no row is missed whatever the current min and max
+    ranges = [col < bounds[0]]
+    ranges.extend(and_(col >= b0, col < b1) for b0, b1 in zip(bounds, bounds[1:]))
+    ranges.append(col >= bounds[-1])
+    return ranges
+
+
+# insert the objects of several classes concurrently: `jobs` threads read and transform different classes,
+# each one with its own connection from the pool of db_engine, and put the records in a bounded queue.
+# The calling thread is the only writer of the OpenSLEX mm and of the key index, and drains the queue.
+# Relations are collected in relation_buffer, to be resolved once all classes are inserted.
+# With partitions > 1, tables with an integer primary key are also split into key ranges read by different
+# threads. Then ids are reserved for every range before reading, so they do not depend on the order in which
+# the ranges are read
+def insert_objects_parallel(mm_conn: Connection, db_engine, db_meta, classes, class_map, attr_map, rel_map,
+                            key_index: KeyIndex, relation_buffer: RelationBuffer, jobs=2,
+                            batch_size=DEFAULT_BATCH_SIZE, partitions=1, checkpoint_dir=None, filters=None,
+                            staging: RelationStaging = None, report: ExtractionReport = NO_REPORT):
+    plans = {c: _get_class_plan(db_meta.tables.get(c), c, class_map, attr_map, rel_map, relation_buffer, staging)
+             for c in classes}
+    # units of work: (class_name, where clause or None)
+    units = []
+    for class_name in classes:
+        source_table: Table = db_meta.tables.get(class_name)
+        ranges = get_key_ranges(db_engine, source_table, partitions)
+        if ranges:
+            units.extend((class_name, clause) for clause in ranges)
+        else:
+            units.append((class_name, None))
+    queue = Queue(maxsize=jobs * 2)
+    stop = threading.Event()
 
-def _get_v_id_for_values(v_map, hash_map, values):
-    id = None
-
-    v_str = str(values)
-    v_hash = v_str.__hash__()
-
-    vlist = hash_map.get(v_hash, [])
-
-    for i, v in enumerate(vlist):
-        if v == values:
-            idlist = v_map.get(v_hash)
-            id = idlist[i]
-            break
-
-    return id
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return
+            except Full:
+                pass
+
+    def read_unit(unit_id):
+        class_name, clause = units[unit_id]
+        try:
+            source_table: Table = db_meta.tables.get(class_name)
+            query = _filter_query(get_class_query(source_table, class_name, attr_map, rel_map), filters, class_name)
+            if clause is not None:
+                query = query.where(clause).order_by(*source_table.primary_key.columns)
+            with SourceReader(db_engine, query, batch_size) as reader:
+                for rows in reader.batches():
+                    if stop.is_set():
+                        return
+                    report.read(class_name, rows, reader.fetch_time)
+                    with report.timed(class_name, 'transform'):
+                        records = _transform_rows(plans[class_name], reader.index, rows)
+                    put(('batch', unit_id, records))
+            put(('done', unit_id, None))
+        except Exception as e:
+            put(('error', unit_id, e))
+
+    writer = ObjectBatchWriter(mm_conn, batch_size)
+    writers = [writer] * units.__len__()
+    if partitions > 1:
+        for unit_id, (class_name, clause) in enumerate(units):
+            source_table: Table = db_meta.tables.get(class_name)
+            query = _filter_query(select([func.count()]).select_from(source_table), filters, class_name)
+            if clause is not None:
+                query = query.where(clause)
+            num_rows = db_engine.execute(query).scalar()
+            first_ids = writer.reserve(num_rows, num_rows * plans[class_name]['attr_cols'].__len__())
+            writers[unit_id] = ObjectBatchWriter(mm_conn, batch_size, first_ids=first_ids, max_objects=num_rows,
+                                                 dictionary=writer.dictionary)
+
+    pending = {c: 0 for c in classes}
+    for class_name, _ in units:
+        pending[class_name] += 1
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for unit_id in range(units.__len__()):
+            executor.submit(read_unit, unit_id)
+
+        trans = mm_conn.begin()
+        try:
+            with tqdm(desc='Objects') as tpb, tqdm(total=pending.__len__(), desc='Inserting Class Objects') as tpb_c:
+                while pending:
+                    kind, unit_id, payload = queue.get()
+                    class_name = units[unit_id][0]
+                    if kind == 'batch':
+                        _write_records(plans[class_name], payload, writers[unit_id], key_index, relation_buffer,
+                                       staging, report)
+                        tpb.update(payload.__len__())
+                    elif kind == 'done':
+                        with report.timed(class_name, 'write'):
+                            writers[unit_id].flush()
+                        pending[class_name] -= 1
+                        if pending[class_name] == 0:
+                            del pending[class_name]
+                            with report.timed(class_name, 'write'):
+                                writer.flush()
+                            with report.timed(class_name, 'sync'):
+                                if staging:
+                                    staging.flush()
+                                if checkpoint_dir:
+                                    # objects of other classes committed with this one are deleted on resume
+                                    key_index.save_class(class_name, checkpoint_dir)
+                                    set_checkpoint(mm_conn, [class_name], 'objects')
+                            with report.timed(class_name, 'write'):
+                                trans.commit()
+                            report.sample_rss(class_name)
+                            trans = mm_conn.begin()
+                            tpb_c.set_postfix_str(class_name, refresh=False)
+                            tpb_c.update(1)
+                    else:
+                        raise payload
+            for w in set(writers):
+                w.close()
+            if staging:
+                staging.flush()
+            trans.commit()
+        except:
+            stop.set()
+            for w in set(writers):
+                w.close(flush=False)
+            trans.rollback()
+            raise
 
 
 # insert the relations of one object into the OpenSLEX mm
 def insert_object_relations(mm_conn, mm_meta, obj, source_table: Table, class_name,
-                            rel_map, obj_v_map, obj_hash_map):
+                            rel_map, key_index: KeyIndex):
     trans = mm_conn.begin()
     try:
         rel_table = mm_meta.tables.get('relation')
         for fkc in source_table.foreign_key_constraints:
             tuple_foreign_cols = tuple(fk.column.name for fk in fkc.elements)
             tuple_cols = tuple(col.name for col in fkc.columns)
-            target_obj_v_params = (
-                fkc.referred_table.fullname,
-                tuple_foreign_cols,
-                tuple(obj[col] for col in tuple_cols)
-            )
-            target_obj_v_id = _get_v_id_for_values(obj_v_map, obj_hash_map, target_obj_v_params)
+            target_obj_v_id = key_index.get(fkc.referred_table.fullname, tuple_foreign_cols,
+                                            tuple(obj[col] for col in tuple_cols))
             if target_obj_v_id:
                 if not source_table.primary_key or not source_table.primary_key.columns:
                     tuple_cols = tuple(col.name for col in source_table.columns)
-                    source_obj_v_id = _get_v_id_for_values(
-                        obj_v_map, obj_hash_map, (source_table.fullname,
-                                                  tuple_cols,
-                                                  tuple(obj[col] for col in tuple_cols)))
-                    # source_obj_v_id = obj_v_map[str((
-                    #     source_table.fullname,
-                    #     tuple_cols,
-                    #     tuple(obj[col] for col in tuple_cols)
-                    # ))]
                 else:
                     tuple_cols = tuple(col.name for col in source_table.primary_key.columns)
-                    source_obj_v_id = _get_v_id_for_values(
-                        obj_v_map, obj_hash_map, (source_table.fullname,
-                                                  tuple_cols,
-                                                  tuple(obj[col] for col in tuple_cols)))
-                    # source_obj_v_id = obj_v_map[str((
-                    #     source_table.fullname,
-                    #     tuple_cols,
-                    #     tuple(obj[col] for col in tuple_cols)
-                    # ))]
+                source_obj_v_id = key_index.get(source_table.fullname, tuple_cols,
+                                                tuple(obj[col] for col in tuple_cols))
                 rel_value = [{
                     'source_object_version_id': source_obj_v_id,
                     'target_object_version_id': target_obj_v_id,
@@ -403,92 +1653,246 @@ def insert_object_relations(mm_conn, mm_meta, obj, source_table: Table, class_na
         raise
 
 
+# get the columns identifying the source object of a relation, and for each foreign key of the source table:
+# (relationship_id, referred class, referred columns, foreign key columns)
+def _get_relation_specs(source_table: Table, class_name, rel_map):
+    if not source_table.primary_key or not source_table.primary_key.columns:
+        source_cols = tuple(col.name for col in source_table.columns)
+    else:
+        source_cols = tuple(col.name for col in source_table.primary_key.columns)
+    fk_specs = []
+    for fkc in source_table.foreign_key_constraints:
+        if (class_name, fkc.name) in rel_map:
+            fk_specs.append((rel_map[(class_name, fkc.name)],
+                             fkc.referred_table.fullname,
+                             tuple(fk.column.name for fk in fkc.elements),
+                             tuple(col.name for col in fkc.columns)))
+    return source_cols, fk_specs
+
+
+def _insert_relations(cursor, rel_values, start_timestamp=-2):
+    cursor.executemany('INSERT INTO relation (source_object_version_id, target_object_version_id, '
+                       'relationship_id, start_timestamp, end_timestamp) VALUES (?, ?, ?, {}, -1)'
+                       .format(int(start_timestamp)), rel_values)
+
+
 # insert the relations of all objects of one class into the OpenSLEX mm
 def insert_class_relations(mm_conn, mm_meta, db_engine, db_meta, class_name,
-                           rel_map, obj_v_map, obj_hash_map):
-    t1 = time.time()
+                           rel_map, key_index: KeyIndex, batch_size=DEFAULT_BATCH_SIZE, checkpoint=False,
+                           filters=None, report: ExtractionReport = NO_REPORT):
     trans = mm_conn.begin()
     try:
+        if checkpoint:
+            set_checkpoint(mm_conn, [class_name], 'relations')
         source_table: Table = db_meta.tables.get(class_name)
-        num_objs = db_engine.execute(source_table.count()).scalar()
+        source_cols, fk_specs = _get_relation_specs(source_table, class_name, rel_map)
+        if not fk_specs:
+            trans.commit()
+            return
+        num_objs = db_engine.execute(_filter_query(select([func.count()]).select_from(source_table),
+                                                   filters, class_name)).scalar()
+
+        mm_cursor = mm_conn.connection.cursor()
+        # only the columns identifying the objects and their foreign keys are read
+        query = _filter_query(select([col for col in source_table.columns if col.name in source_cols or
+                                      any(col.name in fk_cols for _, _, _, fk_cols in fk_specs)]),
+                              filters, class_name)
+        with SourceReader(db_engine, query, batch_size) as reader, \
+                tqdm(desc='Relations', total=num_objs) as tpb:
+            for rows in reader.batches():
+                report.read(class_name, rows, reader.fetch_time)
+                t1 = time.time()
+                source_idxs = tuple(reader.index[col] for col in source_cols)
+                fk_idxs = [(rel_id, ref_class, ref_cols, tuple(reader.index[col] for col in fk_cols))
+                           for rel_id, ref_class, ref_cols, fk_cols in fk_specs]
+                rel_values = []
+                for row in rows:
+                    for rel_id, ref_class, ref_cols, idxs in fk_idxs:
+                        target_obj_v_id = key_index.get(ref_class, ref_cols, tuple(row[i] for i in idxs))
+                        if target_obj_v_id:
+                            source_obj_v_id = key_index.get(class_name, source_cols,
+                                                            tuple(row[i] for i in source_idxs))
+                            rel_values.append((source_obj_v_id, target_obj_v_id, rel_id))
+                report.add_times(class_name, transform=time.time() - t1)
+                with report.timed(class_name, 'write'):
+                    _insert_relations(mm_cursor, rel_values)
+                report.add_rows(class_name, relation=rel_values.__len__())
+                tpb.update(rows.__len__())
+        mm_cursor.close()
+
+        with report.timed(class_name, 'write'):
+            trans.commit()
+    except:
+        trans.rollback()
+        raise
 
-        q = source_table.select()
-        conn = db_engine.raw_connection()
-        cursor = conn.cursor()
-        cursor.execute(str(q.compile(dialect=db_engine.dialect, compile_kwargs={"literal_binds": True})))
-
-        i = 0
-        obj = _get_dict_from_cursor(cursor)
-        with tqdm(desc='Relations', total=num_objs) as tpb:
-            while obj:
-                insert_object_relations(mm_conn, mm_meta, obj, source_table, class_name,
-                                        rel_map, obj_v_map, obj_hash_map)
-                obj = _get_dict_from_cursor(cursor)
-                tpb.update(1)
-                i += 1
-                if i > 1000:
-                    i = 0
-                    try:
-                        obj_v_map.sync()
-                        obj_hash_map.sync()
-                    except:
-                        pass
 
+# insert the relations collected in a RelationBuffer once the keys of all classes are in the key index
+def insert_buffered_relations(mm_conn, relation_buffer: RelationBuffer, key_index: KeyIndex,
+                              checkpoint_classes=None, start_timestamp=-2, report: ExtractionReport = NO_REPORT):
+    trans = mm_conn.begin()
+    try:
+        if checkpoint_classes:
+            set_checkpoint(mm_conn, checkpoint_classes, 'relations')
+        mm_cursor = mm_conn.connection.cursor()
+        specs = relation_buffer.specs
+        with tqdm(desc='Relations') as tpb:
+            for entries in relation_buffer.chunks():
+                rel_values = []
+                for spec_id, source_obj_v_id, key in entries:
+                    rel_id, ref_class, ref_cols = specs[spec_id]
+                    target_obj_v_id = key_index.get_encoded(ref_class, ref_cols, key)
+                    if target_obj_v_id:
+                        rel_values.append((source_obj_v_id, target_obj_v_id, rel_id))
+                _insert_relations(mm_cursor, rel_values, start_timestamp)
+                if report.enabled:
+                    report.add_relations(Counter(rel_id for _, _, rel_id in rel_values))
+                tpb.update(entries.__len__())
+        mm_cursor.close()
         trans.commit()
+    except:
+        trans.rollback()
+        raise
 
-        # source_table = db_meta.tables.get(class_name)
-        # num_objs = db_engine.execute(source_table.count()).scalar()
-        # objs = db_engine.execute(source_table.select())
-        # for obj in tqdm(objs, total=num_objs, desc='Relations'):
-        #     insert_object_relations(mm_conn, mm_meta, obj, source_table, class_name, rel_map, obj_v_map)
-        # trans.commit()
+
+# insert the relations collected in a RelationBuffer with sort_runs with a sort-merge join: every run of entries,
+# sorted by key digest, is merged with the table of the key index it refers to, whose arrays are kept sorted by
+# digest (see _KeyTable.get_sorted). The table is read forward once per run, instead of with a lookup per key,
+# so the key index can be spilled to disk with little loss of throughput
+def insert_merged_relations(mm_conn, relation_buffer: RelationBuffer, key_index: KeyIndex,
+                            checkpoint_classes=None, start_timestamp=-2, report: ExtractionReport = NO_REPORT):
+    trans = mm_conn.begin()
+    try:
+        if checkpoint_classes:
+            set_checkpoint(mm_conn, checkpoint_classes, 'relations')
+        mm_cursor = mm_conn.connection.cursor()
+        specs = relation_buffer.specs
+        with tqdm(desc='Relations') as tpb:
+            for spec_id, source_obj_v_ids, digests, keys, key_starts, key_lengths in relation_buffer.sorted_runs():
+                rel_id, ref_class, ref_cols = specs[spec_id]
+                target_obj_v_ids = key_index.get_sorted(ref_class, ref_cols, digests, keys, key_starts, key_lengths)
+                found = np.nonzero(target_obj_v_ids)[0]
+                _insert_relations(mm_cursor, zip(source_obj_v_ids[found].tolist(), target_obj_v_ids[found].tolist(),
+                                                 [rel_id] * found.__len__()), start_timestamp)
+                report.add_relations({rel_id: found.__len__()})
+                tpb.update(digests.__len__())
+        mm_cursor.close()
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+
+
+# insert the relations of the classes staged in a RelationStaging, with one INSERT ... SELECT ... JOIN per
+# foreign key. The staging tables of all the classes they refer to must be in the mm
+def insert_staged_relations(mm_conn, staging: RelationStaging, class_names, checkpoint=False,
+                            report: ExtractionReport = NO_REPORT):
+    trans = mm_conn.begin()
+    try:
+        if checkpoint and class_names:
+            set_checkpoint(mm_conn, class_names, 'relations')
+        fks = [(c, fk) for c in class_names if c in staging.classes
+               for fk in range(staging.classes[c]['fk_specs'].__len__())]
+        staging.create_indexes({staging.classes[c]['fk_specs'][fk][1] for c, fk in fks})
+        with tqdm(fks, desc='Relations') as tpb:
+            for class_name, fk in tpb:
+                with report.timed(class_name, 'write'):
+                    result = mm_conn.execute(staging.get_relation_statement(class_name, fk))
+                report.add_rows(class_name, relation=result.rowcount)
+        trans.commit()
     except:
         trans.rollback()
         raise
-    t2 = time.time()
-    time_diff = t2 - t1
 
 
 # insert the objects of all classes of the source db into the OpenSLEX mm
-def insert_objects(mm_conn, mm_meta, db_engine, db_meta, classes, class_map, attr_map, rel_map, cache_dir):
-    obj_v_map = SqliteDict(
-        flag='n',
-        filename='{}/{}-{}'.format(cache_dir, 'obj_v_map_filecache', datetime.now().timestamp()),
-        autocommit=True)
-
-    obj_hash_map = SqliteDict(
-        flag='n',
-        filename='{}/{}-{}'.format(cache_dir, 'obj_hash_map_filecache', datetime.now().timestamp()),
-        autocommit=True)
-
-    with tqdm(classes, desc='Inserting Class Objects') as tpb:
-        for class_name in tpb:
-            tpb.set_postfix_str(class_name, refresh=True)
-            insert_class_objects(mm_conn, mm_meta, db_engine, db_meta, class_name,
-                                 class_map, attr_map, rel_map, obj_v_map, obj_hash_map)
-            obj_v_map.sync()
-            obj_hash_map.sync()
-
-    with tqdm(classes, desc='Inserting Class Relations') as tpb:
-        for class_name in tpb:
-            tpb.set_postfix_str(class_name, refresh=True)
-            insert_class_relations(mm_conn, mm_meta, db_engine, db_meta, class_name,
-                                   rel_map, obj_v_map, obj_hash_map)
-            obj_v_map.sync()
-            obj_hash_map.sync()
+def insert_objects(mm_conn, mm_meta, db_engine, db_meta, classes, class_map, attr_map, rel_map, cache_dir,
+                   batch_size=DEFAULT_BATCH_SIZE, index_memory=DEFAULT_MEMORY_BUDGET, single_pass=False, jobs=1,
+                   partitions=1, checkpoint_dir=None, checkpoints=None, filters=None, staged_relations=False,
+                   merge_relations=False, report: ExtractionReport = NO_REPORT):
+    # parallel extraction reads every table only once, so relations are always buffered or staged.
+    # With staged_relations, the keys are staged in the mm and the relations resolved there (see RelationStaging).
+    # With merge_relations, buffered relations are resolved with a sort-merge join (see insert_merged_relations)
+    if staged_relations and merge_relations:
+        raise Exception('Relations can be either staged or merged')
+    single_pass = (single_pass or jobs > 1 or merge_relations) and not staged_relations
+    # with checkpoint_dir, the keys of every class are saved there and its progress recorded in the mm,
+    # and the classes in checkpoints (completed by a previous run) are not extracted again
+    checkpoints = checkpoints or dict()
+    pending_objects = [c for c in classes if c not in checkpoints]
+    pending_relations = [c for c in classes if checkpoints.get(c) != 'relations']
+    key_index = KeyIndex(spill_dir=cache_dir, memory_budget=index_memory)
+    relation_buffer = RelationBuffer(spill_dir=cache_dir, memory_budget=index_memory,
+                                     sort_runs=merge_relations) if single_pass else None
+    staging = None
 
     try:
-        obj_v_map.close()
-        obj_hash_map.close()
-    except:
-        pass
+        with report.stage('load_keys'):
+            for class_name in tqdm([c for c in classes if c in checkpoints], desc='Loading Class Keys'):
+                if not key_index.load_class(class_name, checkpoint_dir):
+                    raise Exception('Keys of class {} not found in {}'.format(class_name, checkpoint_dir))
+        if staged_relations:
+            staging = RelationStaging(mm_conn, db_meta, classes, class_map, rel_map, batch_size=batch_size)
+            staged_classes = staging.create_tables(pending_objects)
+
+        with report.stage('objects'):
+            if jobs > 1:
+                insert_objects_parallel(mm_conn, db_engine, db_meta, pending_objects, class_map, attr_map, rel_map,
+                                        key_index, relation_buffer, jobs=jobs, batch_size=batch_size,
+                                        partitions=partitions, checkpoint_dir=checkpoint_dir, filters=filters,
+                                        staging=staging, report=report)
+            else:
+                with tqdm(pending_objects, desc='Inserting Class Objects') as tpb:
+                    for class_name in tpb:
+                        tpb.set_postfix_str(class_name, refresh=True)
+                        insert_class_objects(mm_conn, mm_meta, db_engine, db_meta, class_name,
+                                             class_map, attr_map, rel_map, key_index,
+                                             batch_size=batch_size, relation_buffer=relation_buffer,
+                                             checkpoint_dir=checkpoint_dir, filters=filters, staging=staging,
+                                             report=report)
+
+        with report.stage('relations'):
+            if single_pass:
+                insert_relations = insert_merged_relations if merge_relations else insert_buffered_relations
+                insert_relations(mm_conn, relation_buffer, key_index,
+                                 checkpoint_classes=pending_objects if checkpoint_dir else None, report=report)
+                # the relations of classes extracted by a previous run were not buffered
+                pending_relations = [c for c in pending_relations if c not in pending_objects]
+            if staging:
+                # classes extracted by a previous run without staging, and the ones referring to them,
+                # are resolved with the key index
+                joined = [c for c in pending_relations
+                          if all(c in staged_classes and ref_class in staged_classes
+                                 for _, ref_class, _, _ in staging.classes.get(c, {'fk_specs': []})['fk_specs'])]
+                insert_staged_relations(mm_conn, staging, joined, checkpoint=checkpoint_dir is not None,
+                                        report=report)
+                pending_relations = [c for c in pending_relations if c not in joined]
+            with tqdm(pending_relations, desc='Inserting Class Relations') as tpb:
+                for class_name in tpb:
+                    tpb.set_postfix_str(class_name, refresh=True)
+                    insert_class_relations(mm_conn, mm_meta, db_engine, db_meta, class_name,
+                                           rel_map, key_index, batch_size=batch_size,
+                                           checkpoint=checkpoint_dir is not None, filters=filters, report=report)
+            # including the ones of a previous run resumed without staging
+            with mm_conn.begin():
+                drop_staging_tables(mm_conn)
+    finally:
+        key_index.close()
+        if relation_buffer:
+            relation_buffer.close()
+        if staging:
+            staging.close()
 
 
 def extract_to_mm(openslex_file_path, connection_params, cache_dir, db_engine=None, schemas=None,
-                  overwrite=False, classes=None, metadata=None):
+                  overwrite=False, classes=None, metadata=None, batch_size=DEFAULT_BATCH_SIZE,
+                  index_memory=DEFAULT_MEMORY_BUDGET, single_pass=False, jobs=1, partitions=1, bulk_load=False,
+                  resume=False, watermarks=None, filters=None, fk_closure=False, sample=None, sample_roots=None,
+                  dictionary=False, staged_relations=False, merge_relations=False, report=False):
     # connect to the OpenSLEX mm
     try:
-        create_mm(openslex_file_path, overwrite)
+        if not (resume and os.path.exists(openslex_file_path)):
+            create_mm(openslex_file_path, overwrite, dictionary=dictionary)
         mm_engine = create_mm_engine(openslex_file_path)
         if not db_engine:
             db_engine = create_db_engine(**connection_params)
@@ -502,45 +1906,283 @@ def extract_to_mm(openslex_file_path, connection_params, cache_dir, db_engine=No
         raise e
 
     extraction_from_db(openslex_file_path, cache_dir, db_engine, overwrite,
-                       classes, metadata)
+                       classes, metadata, batch_size=batch_size, index_memory=index_memory,
+                       single_pass=single_pass, jobs=jobs, partitions=partitions, bulk_load=bulk_load,
+                       resume=resume, watermarks=watermarks, filters=filters, fk_closure=fk_closure,
+                       sample=sample, sample_roots=sample_roots, dictionary=dictionary,
+                       staged_relations=staged_relations, merge_relations=merge_relations, report=report)
+
+
+# path of the JSON report of the extraction of an OpenSLEX mm (see ExtractionReport)
+def get_report_path(openslex_file_path):
+    return '{}.report.json'.format(os.path.splitext(str(openslex_file_path))[0])
 
 
 def extraction_from_db(openslex_file_path, cache_dir, db_engine=None,
-                       overwrite=False, classes=None, metadata=None):
+                       overwrite=False, classes=None, metadata=None, batch_size=DEFAULT_BATCH_SIZE,
+                       index_memory=DEFAULT_MEMORY_BUDGET, single_pass=False, jobs=1, partitions=1,
+                       bulk_load=False, resume=False, watermarks=None, filters=None, fk_closure=False, sample=None,
+                       sample_roots=None, dictionary=False, staged_relations=False, merge_relations=False,
+                       report=False):
+    # progress is recorded in the OpenSLEX mm and the keys of the extracted classes in keys_dir, where they
+    # are kept for incremental_extraction_from_db. With resume, an existing mm is completed instead of created again.
+    # watermarks ({class_name: column_name}) are the columns used to find the rows changed after this extraction.
+    # filters select the rows extracted from every class (see get_filter_clauses). With sample, only a sample of
+    # sample rows of every class in sample_roots, and the rows related to them, is extracted (see get_sample_clauses).
+    # With dictionary, the mm is created with value-dictionary storage of the attribute values.
+    # With staged_relations, the relations are resolved in the mm with joins on staged keys (see RelationStaging),
+    # and with merge_relations, with a sort-merge join on the key index (see insert_merged_relations).
+    # With report, the statistics of the extraction are saved in JSON next to the mm (see get_report_path)
+    keys_dir = get_keys_dir(openslex_file_path, cache_dir)
+    resume = resume and os.path.exists(openslex_file_path)
+    run_report = ExtractionReport(enabled=report)
+    run_report.options = dict(batch_size=batch_size, index_memory=index_memory, single_pass=single_pass, jobs=jobs,
+                              partitions=partitions, bulk_load=bulk_load, resume=resume, sample=sample,
+                              dictionary=dictionary, staged_relations=staged_relations,
+                              merge_relations=merge_relations)
+
     # connect to the OpenSLEX mm
     try:
-        create_mm(openslex_file_path, overwrite)
-        mm_engine = create_mm_engine(openslex_file_path)
+        if not resume:
+            create_mm(openslex_file_path, overwrite, dictionary=dictionary)
+            shutil.rmtree(keys_dir, ignore_errors=True)
+        mm_engine = create_mm_engine(openslex_file_path, bulk_load=bulk_load)
+        # a resumed extraction also creates the indexes dropped by a failed bulk load
+        deferred_indexes = begin_mm_bulk_load(mm_engine) if bulk_load else get_deferred_indexes(mm_engine)
         db_meta = metadata
         mm_meta = get_mm_meta(mm_engine)
         dm_name = 'datamodel'
+        if classes is None:
+            classes = [t.fullname for t in db_meta.tables.values()]
+        filter_clauses = get_filter_clauses(db_meta, filters, classes, fk_closure)
+        if sample:
+            with run_report.stage('sample'):
+                filter_clauses = get_sample_clauses(db_engine, db_meta, classes, sample, roots=sample_roots,
+                                                    filters=filter_clauses, batch_size=batch_size)
     except Exception as e:
         raise e
 
     # insert the source's datamodel into the OpenSLEX mm
-    t1 = time.time()
     mm_conn = mm_engine.connect()
     try:
-        class_map, attr_map, rel_map = insert_metadata(mm_conn, mm_meta, db_meta, dm_name, classes)
-    except Exception as e:
-        raise e
-    mm_conn.close()
-    t2 = time.time()
-    time_diff = t2 - t1
+        with run_report.stage('metadata'):
+            create_checkpoint_table(mm_conn)
+            if resume and mm_conn.execute('SELECT count(*) FROM class').scalar():
+                print('Resuming extraction')
+                class_map, attr_map, rel_map = get_metadata_maps(mm_conn, classes)
+            else:
+                class_map, attr_map, rel_map = insert_metadata(mm_conn, mm_meta, db_meta, dm_name, classes)
+    finally:
+        mm_conn.close()
+    run_report.set_relationships(rel_map)
 
     # insert objects into the OpenSLEX mm
-    t1 = time.time()
     mm_conn = mm_engine.connect()
     try:
-        if classes is None:
-            classes = [t.fullname for t in db_meta.tables.values()]
+        if watermarks:
+            # the watermarks are read before the tables, so rows changed during the extraction are read again
+            # by the next incremental extraction. A resumed extraction keeps the ones of the first run
+            with mm_conn.begin():
+                set_watermarks(mm_conn, {c: (col, get_watermark_value(db_engine, db_meta.tables.get(c), col))
+                                         for c, col in watermarks.items() if c in classes}, replace=False)
+        checkpoints = get_checkpoints(mm_conn)
+        delete_class_objects(mm_conn, [class_map[c] for c in classes if c not in checkpoints])
         insert_objects(mm_conn, mm_meta, db_engine,
                        db_meta, classes, class_map,
-                       attr_map, rel_map, cache_dir)
-    except Exception as e:
-        raise e
-    mm_conn.close()
+                       attr_map, rel_map, cache_dir, batch_size=batch_size,
+                       index_memory=index_memory, single_pass=single_pass, jobs=jobs, partitions=partitions,
+                       checkpoint_dir=keys_dir, checkpoints=checkpoints, filters=filter_clauses,
+                       staged_relations=staged_relations, merge_relations=merge_relations, report=run_report)
+    finally:
+        mm_conn.close()
+    if bulk_load or deferred_indexes:
+        with run_report.stage('indexes'):
+            end_mm_bulk_load(mm_engine, deferred_indexes)
+    mm_engine.dispose()
+    db_engine.dispose()
+    if report:
+        run_report.save(get_report_path(openslex_file_path))
+
+
+# get the object ids of object versions {object_version_id: object_id}
+def _get_object_ids(cursor, obj_v_ids, chunk_size=500):
+    object_ids = dict()
+    for i in range(0, obj_v_ids.__len__(), chunk_size):
+        chunk = obj_v_ids[i:i + chunk_size]
+        cursor.execute('SELECT id, object_id FROM object_version WHERE id IN ({})'
+                       .format(', '.join('?' * chunk.__len__())), chunk)
+        object_ids.update(cursor.fetchall())
+    return object_ids
+
+
+# write transformed records of rows changed in the source db. Rows of objects already in the OpenSLEX mm become
+# new versions of them, starting at timestamp, and the versions they replace end at timestamp.
+# The replaced versions are recorded in the temporary table ov_replacement (old_id, new_id)
+def _write_changed_records(plan, records, writer: ObjectBatchWriter, key_index: KeyIndex,
+                           relation_buffer: RelationBuffer, timestamp):
+    class_name = plan['class_name']
+    class_id = plan['class_id']
+    unique_tuples = plan['unique_tuples']
+    spec_ids = [spec_id for spec_id, _ in plan['fk_specs']]
+    old_obj_v_ids = []
+    for _, unique_values, _ in records:
+        old_obj_v_id = None
+        for unique_tuple, values in zip(unique_tuples, unique_values):
+            old_obj_v_id = key_index.get(class_name, unique_tuple, values)
+            if old_obj_v_id:
+                break
+        old_obj_v_ids.append(old_obj_v_id)
+    object_ids = _get_object_ids(writer.cursor, [i for i in old_obj_v_ids if i])
+
+    replaced = []
+    for (attr_values, unique_values, fk_values), old_obj_v_id in zip(records, old_obj_v_ids):
+        object_id = object_ids.get(old_obj_v_id)
+        obj_v_id = writer.add_object(class_id, attr_values, object_id=object_id, start_timestamp=timestamp)
+        if object_id:
+            replaced.append((old_obj_v_id, obj_v_id))
+        for unique_tuple, values in zip(unique_tuples, unique_values):
+            key_index.replace(class_name, unique_tuple, values, obj_v_id)
+        for spec_id, values in zip(spec_ids, fk_values):
+            relation_buffer.add(spec_id, obj_v_id, values)
+    writer.cursor.executemany('UPDATE object_version SET end_timestamp = ? WHERE id = ?',
+                              [(timestamp, old) for old, _ in replaced])
+    writer.cursor.executemany('INSERT INTO temp.ov_replacement (old_id, new_id) VALUES (?, ?)', replaced)
+
+
+# insert the rows of one class changed since its watermark (or all of them if it has none) and return the
+# new watermark. Every row read is a new object, or a new version of the object with the same key
+def insert_changed_objects(mm_conn: Connection, db_engine, db_meta, class_name, class_map, attr_map, rel_map,
+                           key_index: KeyIndex, relation_buffer: RelationBuffer, watermark_column, watermark,
+                           timestamp, batch_size=DEFAULT_BATCH_SIZE, filters=None):
+    source_table: Table = db_meta.tables.get(class_name)
+    high = get_watermark_value(db_engine, source_table, watermark_column)
+    if high is None:
+        return watermark
+    col = source_table.c[watermark_column]
+    clause = col <= high
+    if watermark is not None:
+        clause = and_(col > watermark, clause)
+    plan = _get_class_plan(source_table, class_name, class_map, attr_map, rel_map, relation_buffer)
+
+    writer = ObjectBatchWriter(mm_conn, batch_size)
+    try:
+        query = _filter_query(get_class_query(source_table, class_name, attr_map, rel_map).where(clause),
+                              filters, class_name)
+        with SourceReader(db_engine, query, batch_size) as reader, \
+                tqdm(desc='Objects') as tpb:
+            for rows in reader.batches():
+                _write_changed_records(plan, _transform_rows(plan, reader.index, rows), writer, key_index,
+                                       relation_buffer, timestamp)
+                tpb.update(rows.__len__())
+        writer.close()
+    except:
+        writer.close(flush=False)
+        raise
+    return high
+
+
+# move the relations of the replaced object versions in ov_replacement to their new versions: the relations
+# from or to a replaced version end at timestamp, and the ones from unchanged objects to a replaced version
+# continue from timestamp to its new version. The relations from the new versions are inserted from the rows read
+def update_replaced_relations(mm_conn, class_ids, timestamp):
+    class_ids = set(class_ids)
+    cursor = mm_conn.connection.cursor()
+    cursor.execute('SELECT id, source, target FROM relationship')
+    for rel_id, source, target in cursor.fetchall():
+        if target in class_ids:
+            cursor.execute('INSERT INTO relation (source_object_version_id, target_object_version_id, '
+                           'relationship_id, start_timestamp, end_timestamp) '
+                           'SELECT R.source_object_version_id, X.new_id, R.relationship_id, ?, -1 '
+                           'FROM temp.ov_replacement AS X, relation AS R '
+                           'WHERE R.relationship_id = ? AND R.target_object_version_id = X.old_id '
+                           'AND R.end_timestamp = -1 '
+                           'AND R.source_object_version_id NOT IN (SELECT old_id FROM temp.ov_replacement)',
+                           (timestamp, rel_id))
+            cursor.execute('UPDATE relation SET end_timestamp = ? WHERE relationship_id = ? AND end_timestamp = -1 '
+                           'AND target_object_version_id IN (SELECT old_id FROM temp.ov_replacement)',
+                           (timestamp, rel_id))
+        if source in class_ids:
+            cursor.execute('UPDATE relation SET end_timestamp = ? WHERE relationship_id = ? AND end_timestamp = -1 '
+                           'AND source_object_version_id IN (SELECT old_id FROM temp.ov_replacement)',
+                           (timestamp, rel_id))
+    cursor.close()
+
+
+# update an OpenSLEX mm created by extraction_from_db with the rows changed in the source db since its last
+# extraction, read with the watermarks {class_name: column_name}, or with the ones stored in the mm if None.
+# Changed objects get new versions valid from the time of this extraction, and only the relations of the changed
+# objects are resolved. Rows deleted from the source db are not detected
+def incremental_extraction_from_db(openslex_file_path, cache_dir, db_engine, metadata, watermarks=None,
+                                   batch_size=DEFAULT_BATCH_SIZE, index_memory=DEFAULT_MEMORY_BUDGET,
+                                   filters=None, fk_closure=False):
+    if not os.path.exists(openslex_file_path):
+        raise Exception('OpenSLEX mm {} not found'.format(openslex_file_path))
+    mm_engine = create_mm_engine(openslex_file_path)
+    if watermarks is None:
+        mm_conn = mm_engine.connect()
+        try:
+            watermarks = {c: col for c, (col, _) in get_watermarks(mm_conn).items()}
+        finally:
+            mm_conn.close()
+        if not watermarks:
+            raise Exception('No watermarks stored in OpenSLEX mm {}. '
+                            'Extract it with watermarks first'.format(openslex_file_path))
+    keys_dir = get_keys_dir(openslex_file_path, cache_dir)
+    db_meta = metadata
+    classes = [c for c in watermarks if c in db_meta.tables]
+    filter_clauses = get_filter_clauses(db_meta, filters, classes, fk_closure)
+    timestamp = int(time.time() * 1000)
+
+    check_mm_indexes(mm_engine)
+    mm_conn = mm_engine.connect()
+    key_index = KeyIndex(spill_dir=cache_dir, memory_budget=index_memory)
+    relation_buffer = RelationBuffer(spill_dir=cache_dir, memory_budget=index_memory)
+    try:
+        class_map, attr_map, rel_map = get_metadata_maps(mm_conn, classes)
+        stored = get_watermarks(mm_conn)
+
+        # the keys of the changed classes and of the classes they refer to
+        key_classes = set(classes)
+        for class_name in classes:
+            _, fk_specs = _get_relation_specs(db_meta.tables.get(class_name), class_name, rel_map)
+            key_classes.update(ref_class for _, ref_class, _, _ in fk_specs)
+        for class_name in tqdm(sorted(key_classes), desc='Loading Class Keys'):
+            if not key_index.load_class(class_name, keys_dir):
+                raise Exception('Keys of class {} not found in {}'.format(class_name, keys_dir))
+
+        trans = mm_conn.begin()
+        try:
+            mm_conn.execute('CREATE TEMP TABLE IF NOT EXISTS ov_replacement '
+                            '(old_id INTEGER PRIMARY KEY, new_id INTEGER)')
+            mm_conn.execute('DELETE FROM temp.ov_replacement')
+            new_watermarks = dict()
+            with tqdm(classes, desc='Inserting Changed Objects') as tpb:
+                for class_name in tpb:
+                    tpb.set_postfix_str(class_name, refresh=True)
+                    column = watermarks[class_name]
+                    stored_column, watermark = stored.get(class_name, (column, None))
+                    if stored_column != column:
+                        print('Watermark column of {} changed from {} to {}, reading all its rows'
+                              .format(class_name, stored_column, column))
+                        watermark = None
+                    new_watermarks[class_name] = (column, insert_changed_objects(
+                        mm_conn, db_engine, db_meta, class_name, class_map, attr_map, rel_map, key_index,
+                        relation_buffer, column, watermark, timestamp, batch_size=batch_size,
+                        filters=filter_clauses))
+            update_replaced_relations(mm_conn, [class_map[c] for c in classes], timestamp)
+            insert_buffered_relations(mm_conn, relation_buffer, key_index, start_timestamp=timestamp)
+            set_watermarks(mm_conn, new_watermarks)
+            mm_conn.execute('DROP TABLE temp.ov_replacement')
+            # the keys are saved before the commit, so the mm is not updated if they cannot be saved
+            for class_name in classes:
+                key_index.save_class(class_name, keys_dir)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+    finally:
+        key_index.close()
+        relation_buffer.close()
+        mm_conn.close()
     mm_engine.dispose()
     db_engine.dispose()
-    t2 = time.time()
-    time_diff = t2 - t1
@@ -0,0 +1,427 @@
+import json
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+from hashlib import blake2b
+
+import numpy as np
+
+# in-memory budget (bytes) of a KeyIndex before its sorted arrays are spilled to memory-mapped files
+DEFAULT_MEMORY_BUDGET = 1 << 30
+
+# number of entries processed at once when merging spilled arrays and joining sorted keys
+_BLOCK_SIZE = 1 << 16
+
+_INT = struct.Struct('<Bq')
+_FLOAT = struct.Struct('<Bd')
+_SIZED = struct.Struct('<BI')
+
+
+def _encode_int(v):
+    if -0x8000000000000000 <= v <= 0x7FFFFFFFFFFFFFFF:
+        return _INT.pack(0x69, v)
+    return _encode_sized(0x49, str(v).encode('ascii'))
+
+
+def _encode_sized(tag, b):
+    return _SIZED.pack(tag, b.__len__()) + b
+
+
+def _encode_other(v):
+    return _encode_sized(0x6f, '{}:{!r}'.format(type(v).__name__, v).encode('utf-8', 'backslashreplace'))
+
+
+# typed encoders of the values of a key: a one byte tag, followed by a fixed width value or by a length and
+# the bytes of the value. Other types are encoded with their name and repr
+_ENCODERS = {
+    type(None): lambda v: b'N',
+    bool: lambda v: b'T' if v else b'F',
+    int: _encode_int,
+    float: lambda v: _FLOAT.pack(0x66, v + 0.0),  # -0.0 == 0.0
+    str: lambda v: _encode_sized(0x73, v.encode('utf-8', 'surrogatepass')),
+    bytes: lambda v: _encode_sized(0x62, v),
+    bytearray: lambda v: _encode_sized(0x62, bytes(v)),
+    memoryview: lambda v: _encode_sized(0x62, v.tobytes()),
+}
+
+
+# encode the values of a key as bytes. Two keys are the same when their encodings are equal.
+# The encoding does not depend on the process, so keys can be shared between runs and processes
+def encode_key(values) -> bytes:
+    if values.__len__() == 1:
+        v = values[0]
+        return _ENCODERS.get(type(v), _encode_other)(v)
+    return b''.join([_ENCODERS.get(type(v), _encode_other)(v) for v in values])
+
+
+# fixed-width 64-bit digest of an encoded key (blake2b-64), stable between runs and processes
+def key_digest(key: bytes) -> int:
+    return int.from_bytes(blake2b(key, digest_size=8).digest(), 'little')
+
+
+# positions in their array of the bytes of the keys at starts with lengths, one key after the other
+def key_positions(starts, lengths):
+    ends = np.cumsum(lengths, dtype=np.int64)
+    return np.arange(ends[-1] if ends.__len__() else 0, dtype=np.int64) + np.repeat(starts - (ends - lengths), lengths)
+
+
+class _KeyTable:
+    """Index of the keys of one (class, constraint) pair.
+
+    New entries are appended to compact buffers and merged into arrays sorted by digest
+    (stable, so the first inserted object version wins for repeated keys) the next time
+    the table is queried. The encoded keys are kept next to the digests, so lookups
+    compare them to resolve digest collisions exactly. Spilled arrays are merged block
+    by block into new memory-mapped files, with the keys in the order of their digests."""
+
+    _ARRAYS = ('digests', 'ov_ids', 'key_starts', 'key_lengths', 'keys')
+
+    def __init__(self, index, name):
+        self.index = index
+        self.name = name
+        # keys mapped to a new object version with KeyIndex.replace
+        self.replaced = dict()
+        self.spilled = False
+        self.generation = 0
+        self.digests = np.empty(0, dtype=np.uint64)
+        self.ov_ids = np.empty(0, dtype=np.int64)
+        self.key_starts = np.empty(0, dtype=np.int64)
+        self.key_lengths = np.empty(0, dtype=np.int64)
+        self.keys = np.empty(0, dtype=np.uint8)
+        self._reset_pending()
+
+    def _reset_pending(self):
+        self.p_digests = array('Q')
+        self.p_ov_ids = array('q')
+        self.p_key_starts = array('q')
+        self.p_key_lengths = array('q')
+        self.p_keys = bytearray()
+
+    def __len__(self):
+        return self.digests.__len__() + self.p_digests.__len__()
+
+    def pending_nbytes(self):
+        return (self.p_digests.__len__() * 32) + self.p_keys.__len__()
+
+    def nbytes(self):
+        if self.spilled:
+            return 0
+        return sum(getattr(self, a).nbytes for a in self._ARRAYS)
+
+    def add(self, key: bytes, digest: int, ov_id: int):
+        self.index.pending_bytes += 32 + key.__len__()
+        self.p_digests.append(digest)
+        self.p_ov_ids.append(ov_id)
+        self.p_key_starts.append(self.p_keys.__len__())
+        self.p_key_lengths.append(key.__len__())
+        self.p_keys.extend(key)
+
+    def seal(self):
+        if not self.p_digests:
+            return
+        self.index.pending_bytes -= self.pending_nbytes()
+        if self.spilled:
+            p_digests = np.frombuffer(self.p_digests, dtype=np.uint64)
+            order = np.argsort(p_digests, kind='stable')
+            pending = {
+                'digests': p_digests[order],
+                'ov_ids': np.frombuffer(self.p_ov_ids, dtype=np.int64)[order],
+                'key_starts': np.frombuffer(self.p_key_starts, dtype=np.int64)[order],
+                'key_lengths': np.frombuffer(self.p_key_lengths, dtype=np.int64)[order],
+                'keys': np.frombuffer(bytes(self.p_keys), dtype=np.uint8),
+            }
+            self._reset_pending()
+            self._merge_spilled(pending)
+        else:
+            digests = np.concatenate([self.digests, np.frombuffer(self.p_digests, dtype=np.uint64)])
+            order = np.argsort(digests, kind='stable')
+            p_key_starts = np.frombuffer(self.p_key_starts, dtype=np.int64) + self.keys.__len__()
+            self._set_arrays({
+                'digests': digests[order],
+                'ov_ids': np.concatenate([self.ov_ids, np.frombuffer(self.p_ov_ids, dtype=np.int64)])[order],
+                'key_starts': np.concatenate([self.key_starts, p_key_starts])[order],
+                'key_lengths': np.concatenate([self.key_lengths,
+                                               np.frombuffer(self.p_key_lengths, dtype=np.int64)])[order],
+                'keys': np.concatenate([self.keys, np.frombuffer(bytes(self.p_keys), dtype=np.uint8)]),
+            })
+            self._reset_pending()
+        self.index.check_budget()
+
+    def _set_arrays(self, arrays):
+        for a in self._ARRAYS:
+            setattr(self, a, arrays[a])
+
+    # merge the sorted pending entries with the sorted arrays into new memory-mapped files, one block at a time
+    # (existing entries go first for repeated digests). The keys are written in the order of their digests,
+    # so get_sorted reads them sequentially
+    def _merge_spilled(self, pending):
+        existing = {a: getattr(self, a) for a in self._ARRAYS}
+        old_files = [self._spill_file(a) for a in self._ARRAYS] if self.spilled else []
+        self.generation += 1
+        size = existing['digests'].__len__() + pending['digests'].__len__()
+        merged = {a: np.lib.format.open_memmap(self._spill_file(a), mode='w+', dtype=existing[a].dtype, shape=(size,))
+                  for a in ('digests', 'ov_ids', 'key_starts', 'key_lengths')}
+        sides = [(existing, pending['digests'], 'left'), (pending, existing['digests'], 'right')]
+
+        def blocks():
+            for arrays, other_digests, side in sides:
+                for start in range(0, arrays['digests'].__len__(), _BLOCK_SIZE):
+                    end = start + _BLOCK_SIZE
+                    digests = np.asarray(arrays['digests'][start:end])
+                    positions = np.arange(start, start + digests.__len__(), dtype=np.int64) + \
+                        np.searchsorted(other_digests, digests, side=side)
+                    yield arrays, start, end, digests, positions
+
+        for arrays, start, end, digests, positions in blocks():
+            merged['digests'][positions] = digests
+            merged['ov_ids'][positions] = arrays['ov_ids'][start:end]
+            merged['key_lengths'][positions] = arrays['key_lengths'][start:end]
+        offset = 0
+        for start in range(0, size, _BLOCK_SIZE):
+            lengths = np.asarray(merged['key_lengths'][start:start + _BLOCK_SIZE])
+            ends = np.cumsum(lengths, dtype=np.int64) + offset
+            merged['key_starts'][start:start + _BLOCK_SIZE] = ends - lengths
+            offset = int(ends[-1])
+        merged['keys'] = np.lib.format.open_memmap(self._spill_file('keys'), mode='w+', dtype=np.uint8, shape=(offset,))
+        for arrays, start, end, digests, positions in blocks():
+            lengths = np.asarray(arrays['key_lengths'][start:end])
+            merged['keys'][key_positions(np.asarray(merged['key_starts'][positions]), lengths)] = \
+                arrays['keys'][key_positions(np.asarray(arrays['key_starts'][start:end]), lengths)]
+
+        for a in self._ARRAYS:
+            merged[a].flush()
+        del merged
+        self._set_arrays({a: np.load(self._spill_file(a), mmap_mode='r') for a in self._ARRAYS})
+        for f in old_files:
+            os.remove(f)
+        self.spilled = True
+
+    def _spill_file(self, array_name):
+        return os.path.join(self.index.get_spill_dir(), '{}-{}-{}.npy'.format(self.name, array_name, self.generation))
+
+    def spill(self):
+        if not self.spilled:
+            self._merge_spilled({a: getattr(self, a)[:0] for a in self._ARRAYS})
+
+    # merge the replaced keys into the sorted arrays, dropping the entries they replace
+    def merge_replaced(self):
+        if not self.replaced:
+            return
+        self.seal()
+        keep = np.ones(self.digests.__len__(), dtype=bool)
+        replaced_digests = np.array([key_digest(k) for k in self.replaced], dtype=np.uint64)
+        for i in np.nonzero(np.isin(self.digests, replaced_digests))[0]:
+            start = self.key_starts[i]
+            if bytes(self.keys[start:start + self.key_lengths[i]]) in self.replaced:
+                keep[i] = False
+        # the bytes of the dropped keys stay in the keys array, unreferenced
+        self.digests = self.digests[keep]
+        self.ov_ids = self.ov_ids[keep]
+        self.key_starts = self.key_starts[keep]
+        self.key_lengths = self.key_lengths[keep]
+        for key, ov_id in self.replaced.items():
+            self.add(key, key_digest(key), ov_id)
+        self.replaced = dict()
+        self.seal()
+
+    # position of the first digest of the table greater than digest, from position start on. It gallops forward
+    # from start, so it only reads the digests between start and the position found (and as many after it)
+    def _search_forward(self, start, digest):
+        digests = self.digests
+        size = digests.__len__()
+        low, high = start, start + _BLOCK_SIZE
+        while high < size and digests[high - 1] <= digest:
+            low, high = high, high + 2 * (high - start)
+        high = min(high, size)
+        return low + int(np.searchsorted(digests[low:high], digest, side='right'))
+
+    # get the object version ids of keys sorted by digest, 0 for the ones not in the table. keys has the keys one
+    # after the other, at key_starts with key_lengths. Both sides are sorted, so they are merged: every block of
+    # keys is searched only in the window of the table between the digests of its first and its last key, and the
+    # windows only move forward. The arrays of the table, even when spilled, are read sequentially, once per call,
+    # and keys with a single candidate are compared a block at a time
+    def get_sorted(self, digests, keys, key_starts, key_lengths):
+        self.seal()
+        ov_ids = np.zeros(digests.__len__(), dtype=np.int64)
+        position = 0
+        for start in range(0, digests.__len__(), _BLOCK_SIZE):
+            block = digests[start:start + _BLOCK_SIZE]
+            starts = key_starts[start:start + _BLOCK_SIZE]
+            lengths = key_lengths[start:start + _BLOCK_SIZE]
+            end = self._search_forward(position, block[-1])
+            window = np.asarray(self.digests[position:end])
+            low = np.searchsorted(window, block, side='left') + position
+            high = np.searchsorted(window, block, side='right') + position
+            # the next block starts at the last digest of this one at the earliest
+            position = int(low[-1])
+            single = np.nonzero(high - low == 1)[0]
+            candidates = low[single]
+            same_length = np.asarray(self.key_lengths[candidates]) == lengths[single]
+            single, candidates = single[same_length], candidates[same_length]
+            single_lengths = lengths[single]
+            different = np.asarray(self.keys[key_positions(np.asarray(self.key_starts[candidates]), single_lengths)]) \
+                != keys[key_positions(starts[single], single_lengths)]
+            differences = np.concatenate([[0], np.cumsum(different, dtype=np.int64)])
+            ends = np.cumsum(single_lengths, dtype=np.int64)
+            equal = differences[ends] == differences[ends - single_lengths]
+            ov_ids[start + single[equal]] = self.ov_ids[candidates[equal]]
+            # digest collisions and repeated keys
+            for i in np.nonzero(high - low > 1)[0].tolist():
+                key = bytes(keys[starts[i]:starts[i] + lengths[i]])
+                for j in range(int(low[i]), int(high[i])):
+                    key_start = self.key_starts[j]
+                    if bytes(self.keys[key_start:key_start + self.key_lengths[j]]) == key:
+                        ov_ids[start + i] = self.ov_ids[j]
+                        break
+        if self.replaced:
+            for i, (key_start, length) in enumerate(zip(key_starts.tolist(), key_lengths.tolist())):
+                ov_id = self.replaced.get(bytes(keys[key_start:key_start + length]))
+                if ov_id is not None:
+                    ov_ids[i] = ov_id
+        return ov_ids
+
+    def get(self, key: bytes, digest: int):
+        ov_id = self.replaced.get(key)
+        if ov_id is not None:
+            return ov_id
+        self.seal()
+        digests = self.digests
+        i = int(np.searchsorted(digests, np.uint64(digest)))
+        while i < digests.__len__() and digests[i] == digest:
+            start = self.key_starts[i]
+            if bytes(self.keys[start:start + self.key_lengths[i]]) == key:
+                return int(self.ov_ids[i])
+            i += 1
+        return None
+
+
+class KeyIndex:
+    """Maps the key values of the objects of every (class, constraint) pair to the id of their
+    object version in the OpenSLEX mm. When the sorted arrays and the entries pending to be merged into them
+    use more than memory_budget bytes, the tables with the most pending entries are sealed and the biggest tables
+    are moved to memory-mapped files in a temporary directory under spill_dir."""
+
+    def __init__(self, spill_dir=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.spill_dir = spill_dir
+        self.memory_budget = memory_budget
+        self.tables = dict()
+        # bytes of the pending entries of all tables, and bytes of the budget left by their sorted arrays
+        self.pending_bytes = 0
+        self.free_bytes = memory_budget
+        self._tmp_dir = None
+
+    def get_spill_dir(self):
+        if not self._tmp_dir:
+            if self.spill_dir:
+                os.makedirs(self.spill_dir, exist_ok=True)
+            self._tmp_dir = tempfile.mkdtemp(prefix='key_index-', dir=self.spill_dir)
+        return self._tmp_dir
+
+    def _get_table(self, class_name, columns, create=False):
+        k = (class_name, tuple(columns))
+        t = self.tables.get(k)
+        if t is None and create:
+            t = _KeyTable(self, 't{}'.format(self.tables.__len__()))
+            self.tables[k] = t
+        return t
+
+    def add(self, class_name, columns, values, ov_id):
+        t = self._get_table(class_name, columns, create=True)
+        key = encode_key(values)
+        t.add(key, key_digest(key), ov_id)
+        if self.pending_bytes > self.free_bytes:
+            self.seal_pending()
+
+    # map the key to ov_id even if it is already in the index, e.g. for a new version of its object
+    def replace(self, class_name, columns, values, ov_id):
+        t = self._get_table(class_name, columns, create=True)
+        t.replaced[encode_key(values)] = ov_id
+
+    def get(self, class_name, columns, values):
+        return self.get_encoded(class_name, columns, encode_key(values))
+
+    # same as get, for keys already encoded with encode_key
+    def get_encoded(self, class_name, columns, key: bytes):
+        t = self._get_table(class_name, columns)
+        if t is None:
+            return None
+        return t.get(key, key_digest(key))
+
+    # get the object version ids of many encoded keys at once, sorted by their digests (see _KeyTable.get_sorted)
+    def get_sorted(self, class_name, columns, digests, keys, key_starts, key_lengths):
+        t = self._get_table(class_name, columns)
+        if t is None:
+            return np.zeros(digests.__len__(), dtype=np.int64)
+        return t.get_sorted(digests, keys, key_starts, key_lengths)
+
+    def nbytes(self):
+        return sum(t.nbytes() + t.pending_nbytes() for t in self.tables.values())
+
+    def _class_file(self, class_name, directory):
+        return os.path.join(directory, '{}.npz'.format(blake2b(class_name.encode('utf-8'), digest_size=8).hexdigest()))
+
+    # save the keys of class_name to a file in directory, so a later run can load them with load_class
+    def save_class(self, class_name, directory):
+        os.makedirs(directory, exist_ok=True)
+        columns = []
+        arrays = dict()
+        for (c, cols), t in self.tables.items():
+            if c != class_name:
+                continue
+            t.merge_replaced()
+            t.seal()
+            for a in _KeyTable._ARRAYS:
+                arrays['{}-{}'.format(columns.__len__(), a)] = getattr(t, a)
+            columns.append(list(cols))
+        arrays['columns'] = np.array(json.dumps(columns))
+        file_path = self._class_file(class_name, directory)
+        with open(file_path + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(file_path + '.tmp', file_path)
+
+    # load the keys of class_name saved with save_class. Returns False if they were not saved
+    def load_class(self, class_name, directory):
+        file_path = self._class_file(class_name, directory)
+        if not os.path.exists(file_path):
+            return False
+        with np.load(file_path) as data:
+            for i, cols in enumerate(json.loads(str(data['columns']))):
+                t = self._get_table(class_name, cols, create=True)
+                t._set_arrays({a: data['{}-{}'.format(i, a)] for a in _KeyTable._ARRAYS})
+                self.check_budget()
+        return True
+
+    # seal the tables with the most pending entries, spilling the biggest tables with check_budget, until the index
+    # with its pending entries fits in its memory budget
+    def seal_pending(self):
+        for t in sorted(self.tables.values(), key=lambda t: t.pending_nbytes(), reverse=True):
+            if self.nbytes() <= self.memory_budget or t.pending_nbytes() == 0:
+                break
+            t.seal()
+        self._update_free_bytes()
+
+    def _update_free_bytes(self):
+        self.free_bytes = self.memory_budget - sum(t.nbytes() for t in self.tables.values())
+
+    # spill the biggest in-memory tables until the index fits in its memory budget
+    def check_budget(self):
+        if self.nbytes() <= self.memory_budget:
+            self._update_free_bytes()
+            return
+        for t in sorted(self.tables.values(), key=lambda t: t.nbytes(), reverse=True):
+            if t.nbytes() == 0:
+                break
+            t.spill()
+            if self.nbytes() <= self.memory_budget:
+                break
+        self._update_free_bytes()
+
+    def close(self):
+        self.tables = dict()
+        self.pending_bytes = 0
+        self.free_bytes = self.memory_budget
+        if self._tmp_dir:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
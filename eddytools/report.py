@@ -0,0 +1,163 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+# counters kept for every class of a report, and the groups they are written in
+_ROWS_WRITTEN = ['object', 'object_version', 'attribute_value', 'relation']
+_TIMES = ['fetch', 'transform', 'write', 'sync']
+
+
+# peak resident set size of the process in bytes, or None where it is not available
+def get_peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # in bytes on macOS and in KiB elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# approximate size in bytes of the values of source rows: the length of strings and binary values
+# and 8 bytes for any other value
+def get_rows_size(rows):
+    size = 0
+    for row in rows:
+        for value in row:
+            if value is None:
+                continue
+            if value.__class__ is str or isinstance(value, (bytes, bytearray, memoryview)):
+                size += value.__len__()
+            else:
+                size += 8
+    return size
+
+
+class ExtractionReport:
+    """Statistics of an extraction, per class and per stage, to be saved in JSON next to the OpenSLEX mm.
+    For every class it counts the rows and bytes read from the source db and the rows written to each table
+    of the mm, and times fetching rows from the source, transforming them into objects, writing them to the mm
+    (executing the inserts and committing them) and syncing the caches of the extraction (buffering the objects,
+    registering their keys in the key index, the relation buffer or the staging tables, and saving checkpoints).
+    Rows read in parallel are timed in every reader thread, so the times of a class can add up to more than the
+    time of its stage. Relations resolved at the end of a single-pass extraction are counted per class, but
+    timed only in their stage. Counters can be added from several threads."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.started = datetime.now()
+        self.t_start = time.time()
+        self.stages = dict()
+        self.classes = dict()
+        self.rel_classes = dict()
+        self.options = dict()
+        self.lock = threading.Lock()
+
+    def _class(self, class_name):
+        stats = self.classes.get(class_name)
+        if stats is None:
+            stats = self.classes[class_name] = dict(rows_read=0, bytes_read=0, peak_rss=None,
+                                                    rows_written={t: 0 for t in _ROWS_WRITTEN},
+                                                    time={t: 0.0 for t in _TIMES})
+        return stats
+
+    # set the class of every relationship {(class_name, relationship_name): relationship_id}, to count
+    # the relations resolved for several classes at once
+    def set_relationships(self, rel_map):
+        self.rel_classes = {rel_id: class_name for (class_name, _), rel_id in rel_map.items()}
+
+    def read(self, class_name, rows, fetch_time=0.0):
+        if not self.enabled:
+            return
+        size = get_rows_size(rows)
+        with self.lock:
+            stats = self._class(class_name)
+            stats['rows_read'] += rows.__len__()
+            stats['bytes_read'] += size
+            stats['time']['fetch'] += fetch_time
+
+    def add_times(self, class_name, **times):
+        if not self.enabled:
+            return
+        with self.lock:
+            stats = self._class(class_name)['time']
+            for name, seconds in times.items():
+                stats[name] += seconds
+
+    def add_rows(self, class_name, **rows):
+        if not self.enabled:
+            return
+        with self.lock:
+            stats = self._class(class_name)['rows_written']
+            for table, num_rows in rows.items():
+                stats[table] += num_rows
+
+    # count relations {relationship_id: number of relations} of the classes set with set_relationships
+    def add_relations(self, rel_counts):
+        if not self.enabled:
+            return
+        with self.lock:
+            for rel_id, num_rels in rel_counts.items():
+                self._class(self.rel_classes.get(rel_id))['rows_written']['relation'] += num_rels
+
+    # record the peak resident set size of the process once the objects of class_name are written
+    def sample_rss(self, class_name):
+        if not self.enabled:
+            return
+        with self.lock:
+            self._class(class_name)['peak_rss'] = get_peak_rss()
+
+    # add the time spent in the block to one of the times of class_name (fetch, transform, write or sync)
+    @contextmanager
+    def timed(self, class_name, name):
+        t1 = time.time()
+        try:
+            yield
+        finally:
+            self.add_times(class_name, **{name: time.time() - t1})
+
+    # add the time spent in the block to a stage of the extraction
+    @contextmanager
+    def stage(self, name):
+        t1 = time.time()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                self.stages[name] = self.stages.get(name, 0.0) + time.time() - t1
+
+    def to_dict(self):
+        total_time = time.time() - self.t_start
+        rows_read = sum(stats['rows_read'] for stats in self.classes.values())
+        return {
+            'started': self.started.isoformat(),
+            'options': self.options,
+            'total_time': total_time,
+            'stages': self.stages,
+            'rows_read': rows_read,
+            'bytes_read': sum(stats['bytes_read'] for stats in self.classes.values()),
+            'rows_written': {t: sum(stats['rows_written'][t] for stats in self.classes.values())
+                             for t in _ROWS_WRITTEN},
+            'rows_per_second': rows_read / total_time if total_time else None,
+            'peak_rss': get_peak_rss(),
+            'classes': self.classes,
+        }
+
+    # write the report atomically, so a partial report is never read
+    def save(self, path):
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'wt') as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        os.replace(tmp_path, path)
+
+
+# report of the extractions run without one
+NO_REPORT = ExtractionReport(enabled=False)
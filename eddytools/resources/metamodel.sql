@@ -31,7 +31,7 @@ CREATE TABLE IF NOT EXISTS classifier (id INTEGER PRIMARY KEY AUTOINCREMENT, log
 CREATE TABLE IF NOT EXISTS event_attribute_name (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, type TEXT);
 
 -- Table: attribute_value
-CREATE TABLE IF NOT EXISTS attribute_value (id INTEGER PRIMARY KEY AUTOINCREMENT, object_version_id INTEGER REFERENCES object_version (id), attribute_name_id INTEGER REFERENCES attribute_name (id), value TEXT, type TEXT);
+CREATE TABLE IF NOT EXISTS attribute_value (id INTEGER PRIMARY KEY AUTOINCREMENT, object_version_id INTEGER REFERENCES object_version (id), attribute_name_id INTEGER REFERENCES attribute_name (id), value, type TEXT);
 
 -- Table: activity_to_process
 CREATE TABLE IF NOT EXISTS activity_to_process (process_id INTEGER REFERENCES process (id), activity_id INTEGER REFERENCES activity (id), PRIMARY KEY (process_id, activity_id));
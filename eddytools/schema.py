@@ -4,7 +4,12 @@ from sqlalchemy.schema import MetaData, Table, Column, ForeignKeyConstraint, Uni
 from sqlalchemy.sql.expression import select, and_, func, alias, text, tablesample
 from sqlalchemy.types import _Binary, CLOB, BLOB, Text, NullType
 import itertools
+import heapq
+import random
+import shutil
+import tempfile
 from collections import Counter
+from hashlib import blake2b
 from tqdm import tqdm
 import jellyfish
 import numpy as np
@@ -14,9 +19,26 @@ import json
 import pickle
 from fcache.cache import FileCache
 from datetime import datetime
+from decimal import Decimal
 
 SEED: int = 50
 
+# number of columns profiled by each aggregate query of profile_columns
+PROFILE_BATCH_COLUMNS: int = 64
+
+# number of rows streamed by has_duplicates looking for a duplicate before asking the db for one
+UNIQUENESS_PROBE_ROWS: int = 100000
+
+# data types (see get_data_type) whose values are equal in the db only if they are equal in Python. Strings are not,
+# as the collation of the db may ignore their case or trailing spaces
+EXACT_DATA_TYPES = ['integer', 'numeric', 'boolean', 'timestamp']
+
+# dialects whose tables are sampled with TABLESAMPLE. Tables of other dbs are sampled with a reservoir sample
+TABLESAMPLE_DIALECTS = ['postgresql', 'mssql']
+
+# number of sorted values of a column written to its file, and read from it, at once by discover_unary_inds
+IND_CHUNK_SIZE: int = 10000
+
 
 def get_python_type(col: Column):
     default = '-'
@@ -96,18 +118,22 @@ def retrieve_pks(metadata: MetaData, classes=None) -> dict:
     return pks
 
 
+def get_pk_candidate(t: Table, combination: set, idx: int):
+    return {
+        'table': t.name,
+        'schema': t.schema,
+        'fullname': t.fullname,
+        'pk_name': "{}_{}_{}_pk".format(t.name, combination.__len__(), idx),
+        'pk_columns': [c.name for c in combination],
+        'pk_columns_type': [str(get_col_type(c)) for c in combination],
+    }
+
+
 def check_uniqueness_comb(db_engine: Engine, metadata: MetaData, t: Table, combination: set, idx: int,
                           total_rows: int=None, sampling: int=0):
     isunique, total_rows2, unique_len = check_uniqueness(db_engine, t, combination, total_rows, sampling=sampling)
     if isunique:
-        cand = {
-            'table': t.name,
-            'schema': t.schema,
-            'fullname': t.fullname,
-            'pk_name': "{}_{}_{}_pk".format(t.name, combination.__len__(), idx),
-            'pk_columns': [c.name for c in combination],
-            'pk_columns_type': [str(get_col_type(c)) for c in combination],
-        }
+        cand = get_pk_candidate(t, combination, idx)
     else:
         cand = {}
     return isunique, total_rows2, unique_len, cand
@@ -135,8 +161,264 @@ def get_number_of_rows(db_engine: Engine, t: Table, sampling: int=0):
     return total_rows
 
 
+# profile the columns of a table with a few aggregate queries (one per PROFILE_BATCH_COLUMNS columns), each of them
+# scanning the table, or its sample, once. Returns the number of rows and the stats of every column
+# {col: {'isunique', 'num_rows', 'num_nulls', 'num_unique_vals'}}, where NULL counts as one more unique value,
+# as in check_uniqueness
+def profile_columns(db_engine: Engine, t: Table, columns=None, sampling: int=0,
+                    batch_size: int=PROFILE_BATCH_COLUMNS):
+    if columns is None:
+        columns = list(t.columns)
+    sampling = int(sampling)
+    if 100 > sampling > 0:
+        source = t.tablesample(sampling, name='alias', seed=text('{}'.format(SEED)))
+        checksum_method = None
+    else:
+        source = t
+        checksum_method = get_checksum_function(db_engine)
+    if not columns:
+        return get_number_of_rows(db_engine, t, sampling), {}
+    stats_cols = {}
+    for i in range(0, columns.__len__(), batch_size):
+        batch = columns[i:i + batch_size]
+        fields = [func.count().label('num')]
+        for j, col in enumerate(batch):
+            field = source.columns[col.name]
+            fields.append(func.count(field).label('num_{}'.format(j)))
+            if checksum_method:
+                fields.append(func.count(checksum_method(field).distinct()).label('num_unique_{}'.format(j)))
+            else:
+                fields.append(func.count(field.distinct()).label('num_unique_{}'.format(j)))
+        res: ResultProxy = db_engine.execute(select(fields).select_from(source))
+        row = res.first()
+        res.close()
+        total_rows = row['num']
+        for j, col in enumerate(batch):
+            num_nulls = total_rows - row['num_{}'.format(j)]
+            num_unique_vals = row['num_unique_{}'.format(j)]
+            # NULL is one of the rows of SELECT DISTINCT, but not one of the values counted by count(DISTINCT)
+            if num_nulls and not checksum_method:
+                num_unique_vals += 1
+            stats_cols[col] = {'isunique': total_rows == num_unique_vals,
+                               'num_rows': total_rows,
+                               'num_nulls': num_nulls,
+                               'num_unique_vals': num_unique_vals}
+    return total_rows, stats_cols
+
+
+# sampled value that can be compared in sets: binary values as bytes, arrays as tuples and documents as Json
+def _sample_value(value):
+    if isinstance(value, (memoryview, bytearray)):
+        return bytes(value)
+    if isinstance(value, list):
+        return tuple(_sample_value(v) for v in value)
+    if isinstance(value, dict):
+        return json.dumps(value, sort_keys=True, default=str)
+    return value
+
+
+class TableSampler:
+    """Samples of up to `sampling` rows of the tables of the source db, read once and saved as columns of values in
+    cache_dir (or in a temporary directory) for all the checks of the discovery of keys. Tables of dbs in
+    TABLESAMPLE_DIALECTS are sampled with TABLESAMPLE and a fixed seed. The rows of other dbs are read in the order
+    of their primary key and kept in a reservoir sample drawn with a fixed seed, so samples are the same in every
+    run. With reuse, samples already in cache_dir (of a discovery being resumed) are not read again."""
+
+    def __init__(self, db_engine: Engine, metadata: MetaData, sampling: int, cache_dir=None, reuse=False,
+                 batch_size=ex.DEFAULT_BATCH_SIZE):
+        self.db_engine = db_engine
+        self.metadata = metadata
+        self.sampling = int(sampling)
+        self.batch_size = batch_size
+        self.reuse = reuse
+        self.tmp_dir = None
+        if not cache_dir:
+            cache_dir = self.tmp_dir = tempfile.mkdtemp(prefix='eddytools-samples-')
+        self.cache_dir = cache_dir
+        self.sampled = set()
+        # only the sample of the last table read is kept in memory
+        self.last_sample = (None, None)
+
+    def _get_path(self, class_name):
+        return os.path.join(self.cache_dir, 'sample-{}-{}.pickle'.format(
+            self.sampling, blake2b(class_name.encode('utf-8'), digest_size=8).hexdigest()))
+
+    def _read_sample(self, t: Table):
+        columns = list(t.columns)
+        query = select(columns)
+        if self.db_engine.dialect.name in TABLESAMPLE_DIALECTS:
+            total_rows = get_number_of_rows(self.db_engine, t)
+            if total_rows > self.sampling:
+                sample_t = t.tablesample((self.sampling / total_rows) * 100, name='alias',
+                                         seed=text('{}'.format(SEED)))
+                query = select([sample_t.columns[col.name] for col in columns]).select_from(sample_t)
+        elif t.primary_key.columns:
+            query = query.order_by(*t.primary_key.columns)
+        rng = random.Random(SEED)
+        sample = []
+        num_rows = 0
+        with ex.SourceReader(self.db_engine, query, self.batch_size) as reader:
+            for rows in reader.batches():
+                for row in rows:
+                    num_rows += 1
+                    if sample.__len__() < self.sampling:
+                        sample.append(row)
+                    else:
+                        i = rng.randrange(num_rows)
+                        if i < self.sampling:
+                            sample[i] = row
+        return sample
+
+    # get the sample of a class: (number of rows, {column name: [values]})
+    def get_columns(self, class_name):
+        if self.last_sample[0] == class_name:
+            return self.last_sample[1]
+        path = self._get_path(class_name)
+        if (self.reuse or class_name in self.sampled) and os.path.exists(path):
+            with open(path, mode='rb') as f:
+                sample = pickle.load(f)
+        else:
+            t: Table = self.metadata.tables.get(class_name)
+            rows = self._read_sample(t)
+            sample = (rows.__len__(), {col.name: [_sample_value(row[i]) for row in rows]
+                                       for i, col in enumerate(t.columns)})
+            tmp_path = '{}.tmp'.format(path)
+            with open(tmp_path, mode='wb') as f:
+                pickle.dump(sample, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            self.sampled.add(class_name)
+        self.last_sample = (class_name, sample)
+        return sample
+
+    # get the sampled rows of a class, with the values of the columns in column_names
+    def get_rows(self, class_name, column_names):
+        num_rows, columns = self.get_columns(class_name)
+        if not column_names:
+            return [()] * num_rows
+        return list(zip(*[columns[c] for c in column_names]))
+
+    def close(self):
+        self.last_sample = (None, None)
+        if self.tmp_dir:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+# profile the columns of a table in its sample, as profile_columns does in the db
+def profile_sample_columns(sampler: TableSampler, t: Table, columns=None):
+    if columns is None:
+        columns = list(t.columns)
+    total_rows, values = sampler.get_columns(t.fullname)
+    stats_cols = {}
+    for col in columns:
+        col_values = values[col.name]
+        num_nulls = col_values.count(None)
+        # NULL is one more unique value, as in SELECT DISTINCT
+        num_unique_vals = set(col_values).__len__()
+        stats_cols[col] = {'isunique': total_rows == num_unique_vals,
+                           'num_rows': total_rows,
+                           'num_nulls': num_nulls,
+                           'num_unique_vals': num_unique_vals}
+    return total_rows, stats_cols
+
+
+# encode values as their integer codes in index {value: code}, adding the values not in it yet
+def _encode_values(index, values):
+    try:
+        new_values = set(values).difference(index)
+    except TypeError:
+        values = [_sample_value(v) for v in values]
+        new_values = set(values).difference(index)
+    for v in new_values:
+        index[v] = index.__len__()
+    return np.fromiter(map(index.__getitem__, values), dtype=np.int64, count=values.__len__())
+
+
+class StrippedPartitions:
+    """The columns of a table (or of its sample), read once and encoded as integer codes, to find its unique
+    combinations of columns in memory, as TANE does. The stripped partition of a combination of columns has the rows
+    in groups of equal values of more than one row, as arrays of (rows, group ids), so a combination is unique when
+    its stripped partition is empty. It is computed as the product of the partition of a subset of the combination
+    and the codes of the remaining column, only for the rows left in the partition of the subset.
+    Values are compared as in Python, and NULLs are equal as in SELECT DISTINCT. Unlike has_duplicates, strings are
+    not compared by the db, so with a collation that ignores their case or trailing spaces, combinations of string
+    columns can be found unique when the db has duplicates of them."""
+
+    def __init__(self, num_rows, codes, num_nulls):
+        self.num_rows = num_rows
+        self.codes = codes
+        self.num_nulls = num_nulls
+        self.cardinalities = {c: int(codes[c].max()) + 1 if num_rows else 0 for c in codes}
+        self.partitions = dict()
+
+    @classmethod
+    def from_columns(cls, num_rows, columns):
+        codes = dict()
+        num_nulls = dict()
+        for name, values in columns.items():
+            codes[name] = _encode_values(dict(), values)
+            num_nulls[name] = values.count(None)
+        return cls(num_rows, codes, num_nulls)
+
+    # read all the rows of a table once, encoding the values of every column as they are read
+    @classmethod
+    def from_table(cls, db_engine: Engine, t: Table, batch_size=ex.DEFAULT_BATCH_SIZE):
+        names = [col.name for col in t.columns]
+        indexes = [dict() for _ in names]
+        codes = [[] for _ in names]
+        num_rows = 0
+        with ex.SourceReader(db_engine, select(list(t.columns)), batch_size) as reader:
+            for rows in reader.batches():
+                num_rows += rows.__len__()
+                for i, values in enumerate(zip(*rows)):
+                    codes[i].append(_encode_values(indexes[i], values))
+        codes = {name: np.concatenate(c) if c else np.zeros(0, dtype=np.int64) for name, c in zip(names, codes)}
+        num_nulls = {name: int((codes[name] == index[None]).sum()) if None in index else 0
+                     for name, index in zip(names, indexes)}
+        return cls(num_rows, codes, num_nulls)
+
+    # stats of single columns, as the ones of profile_columns
+    def profile(self, columns):
+        return self.num_rows, {col: {'isunique': self.cardinalities[col.name] == self.num_rows,
+                                     'num_rows': self.num_rows,
+                                     'num_nulls': self.num_nulls[col.name],
+                                     'num_unique_vals': self.cardinalities[col.name]}
+                               for col in columns}
+
+    @staticmethod
+    def _strip(rows, keys):
+        _, groups, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        groups = groups.reshape(-1)
+        kept = counts[groups] > 1
+        return rows[kept], groups[kept]
+
+    def _get(self, names):
+        partition = self.partitions.get(names)
+        if partition is not None:
+            return partition
+        if names.__len__() == 1:
+            name, = names
+            partition = self._strip(np.arange(self.num_rows), self.codes[name])
+        else:
+            # the product of a subset with a known partition, if any, and the remaining column
+            subsets = [(names - {name}, name) for name in sorted(names)]
+            subset, name = next(((sub, name) for sub, name in subsets if sub in self.partitions), subsets[0])
+            rows, groups = self._get(subset)
+            partition = self._strip(rows, groups * self.cardinalities[name] + self.codes[name][rows])
+        self.partitions[names] = partition
+        return partition
+
+    def is_unique(self, comb):
+        return self._get(frozenset(col.name for col in comb))[0].__len__() == 0
+
+    # keep only the partitions of single columns and of the combinations in combs
+    def retain(self, combs):
+        names = {frozenset(col.name for col in comb) for comb in combs}
+        self.partitions = {k: v for k, v in self.partitions.items() if k.__len__() == 1 or k in names}
+
+
 def discover_pks(db_engine: Engine, metadata: MetaData, classes=None, max_fields=4, dump_tmp_dir: str=None,
-                 pks_suffix='_pks.json', precomputed_pks={}, sampling: int=0):
+                 pks_suffix='_pks.json', precomputed_pks={}, sampling: int=0, sampler: TableSampler=None,
+                 in_memory=False):
     candidates = precomputed_pks
     # For each class in classes:
     # Select candidate attributes sets
@@ -145,72 +427,86 @@ def discover_pks(db_engine: Engine, metadata: MetaData, classes=None, max_fields
     # Return smallest sets of attributes with unique values
     if classes is None:
         classes = metadata.tables.keys()
-    with tqdm(classes, desc='Discovering PKs') as tpb:
-        for c in tpb:
-            tpb.postfix = c
-            tpb.update()
-            tpb.refresh()
-
-            if c in candidates:
-                continue  # PKs for this table are precomputed (because of resume)
-
-            t: Table = metadata.tables.get(c)
-            total_rows = get_number_of_rows(db_engine, t)
-            if sampling > 0 and total_rows > 0:
-                sampling_perc = (min(sampling, total_rows) / total_rows) * 100
-                total_rows = get_number_of_rows(db_engine, t, sampling_perc)
-            else:
-                sampling_perc = 0
-            stats_cols = {}
-            candidates_t = []
-            unique_combs = set()
-            non_unique_columns = set()
-            for idx, col in tqdm(enumerate(t.columns), desc='Checking unique columns'):
-                isunique, num_rows, num_unique_vals, candidate =\
-                    check_uniqueness_comb(db_engine, metadata, t, {col}, idx,
-                                          total_rows=total_rows, sampling=sampling_perc)
-                stats_cols[col] = {'isunique': isunique,
-                                   'num_rows': num_rows,
-                                   'num_unique_vals': num_unique_vals}
-                if isunique:
-                    candidates_t.append(candidate)
-                    unique_combs.add(frozenset([col]))
+    # with sampling, the keys are checked in a sample of every table (see TableSampler).
+    # With in_memory, every table (or its sample) is read once and its keys found in memory (see StrippedPartitions),
+    # comparing strings in Python instead of with the collation of the db
+    own_sampler = sampler is None and sampling > 0
+    if own_sampler:
+        sampler = TableSampler(db_engine, metadata, sampling)
+    try:
+        with tqdm(classes, desc='Discovering PKs') as tpb:
+            for c in tpb:
+                tpb.postfix = c
+                tpb.update()
+                tpb.refresh()
+
+                if c in candidates:
+                    continue  # PKs for this table are precomputed (because of resume)
+
+                t: Table = metadata.tables.get(c)
+                # the uniqueness of every single column is found by profiling them all at once
+                partitions = None
+                if in_memory:
+                    if sampler:
+                        partitions = StrippedPartitions.from_columns(*sampler.get_columns(c))
+                    else:
+                        partitions = StrippedPartitions.from_table(db_engine, t)
+                    total_rows, stats_cols = partitions.profile(t.columns)
+                elif sampler:
+                    total_rows, stats_cols = profile_sample_columns(sampler, t)
                 else:
-                    non_unique_columns.add(col)
-            non_unique_combs = set([frozenset([col]) for col in non_unique_columns])
-            for n in tqdm(range(2, min(non_unique_columns.__len__(), max_fields)+1),
-                          desc='Exploring candidates of length'):
-                non_unique_combs_next = set()
-                checked_comb = set()
-                idx = 0
-                for comb_prev in tqdm(non_unique_combs, desc='Checking combinations'):
-                    comb = set([col for col in comb_prev])
-                    non_unique_columns_aux = set([col for col in non_unique_columns if col not in comb])
-                    for col in non_unique_columns_aux:
-                        comb_aux = set([col_comb for col_comb in comb])
-                        comb_aux.add(col)
-                        if comb_aux not in checked_comb:
-                            checked_comb.add(frozenset(comb_aux))
-                            if check_num_comb_stats(comb_aux, stats_cols, total_rows, sampling=sampling_perc):
-                                issubset = False
-                                for ucomb in unique_combs:
-                                    if ucomb.issubset(comb_aux):
-                                        issubset = True
-                                        break
-                                if not issubset:
-                                    idx = idx + 1
-                                    isunique, _, _, candidate =\
-                                        check_uniqueness_comb(db_engine, metadata, t, comb_aux, idx,
-                                                              total_rows=total_rows, sampling=sampling_perc)
-                                    if isunique:
-                                        candidates_t.append(candidate)
-                                        unique_combs.add(frozenset(comb_aux))
-                                    else:
-                                        non_unique_combs_next.add(frozenset(comb_aux))
-                non_unique_combs = non_unique_combs_next
-            candidates[c] = candidates_t
-            if dump_tmp_dir:
-                json.dump({c: candidates_t}, open('{}/{}{}'.format(dump_tmp_dir, c, pks_suffix), mode='wt'), indent=True)
+                    total_rows, stats_cols = profile_columns(db_engine, t)
+                candidates_t = []
+                unique_combs = set()
+                non_unique_columns = set()
+                for idx, col in enumerate(t.columns):
+                    if stats_cols[col]['isunique']:
+                        candidates_t.append(get_pk_candidate(t, {col}, idx))
+                        unique_combs.add(frozenset([col]))
+                    else:
+                        non_unique_columns.add(col)
+                non_unique_combs = set([frozenset([col]) for col in non_unique_columns])
+                for n in tqdm(range(2, min(non_unique_columns.__len__(), max_fields)+1),
+                              desc='Exploring candidates of length'):
+                    non_unique_combs_next = set()
+                    checked_comb = set()
+                    idx = 0
+                    for comb_prev in tqdm(non_unique_combs, desc='Checking combinations'):
+                        comb = set([col for col in comb_prev])
+                        non_unique_columns_aux = set([col for col in non_unique_columns if col not in comb])
+                        for col in non_unique_columns_aux:
+                            comb_aux = set([col_comb for col_comb in comb])
+                            comb_aux.add(col)
+                            if comb_aux not in checked_comb:
+                                checked_comb.add(frozenset(comb_aux))
+                                if check_num_comb_stats(comb_aux, stats_cols, total_rows):
+                                    issubset = False
+                                    for ucomb in unique_combs:
+                                        if ucomb.issubset(comb_aux):
+                                            issubset = True
+                                            break
+                                    if not issubset:
+                                        idx = idx + 1
+                                        if partitions:
+                                            isunique = partitions.is_unique(comb_aux)
+                                        else:
+                                            # most combinations are not unique, so they are refuted instead of counted
+                                            isunique = not has_duplicates(db_engine, t, comb_aux, sampler=sampler)
+                                        if isunique:
+                                            candidates_t.append(get_pk_candidate(t, comb_aux, idx))
+                                            unique_combs.add(frozenset(comb_aux))
+                                        else:
+                                            non_unique_combs_next.add(frozenset(comb_aux))
+                    non_unique_combs = non_unique_combs_next
+                    if partitions:
+                        # only the partitions of the combinations extended in the next level are needed
+                        partitions.retain(non_unique_combs)
+                candidates[c] = candidates_t
+                if dump_tmp_dir:
+                    json.dump({c: candidates_t}, open('{}/{}{}'.format(dump_tmp_dir, c, pks_suffix), mode='wt'), indent=True)
+    finally:
+        if own_sampler:
+            sampler.close()
     return candidates
 
 
@@ -298,6 +594,50 @@ def check_uniqueness(db_engine: Engine, table: Table, comb, total_rows: int=None
     return total_rows == unique_len, total_rows, unique_len
 
 
+# refute the uniqueness of a combination of columns: the first probe_rows rows are streamed and looked up in a set,
+# which finds a duplicate of most non-unique combinations without reading the whole table. Only if there is none,
+# the db is asked for one group of duplicates (GROUP BY ... HAVING count(*) > 1 LIMIT 1), which does not need the
+# count of distinct values of check_uniqueness. Values equal in Python are equal in the db too, and NULLs are
+# grouped together as in SELECT DISTINCT, so the result is the opposite of the one of check_uniqueness.
+# The reverse is not true of strings, so combinations with columns not in EXACT_DATA_TYPES are only found unique
+# by the db, even when the probe read all their rows.
+# With a sampler, the duplicates are looked for in the sample of the table, comparing the values in Python
+def has_duplicates(db_engine: Engine, table: Table, comb, sampling: int=0, probe_rows: int=UNIQUENESS_PROBE_ROWS,
+                   sampler: TableSampler=None):
+    if sampler:
+        rows = sampler.get_rows(table.fullname, [c.name for c in comb])
+        return set(rows).__len__() < rows.__len__()
+    sampling = int(sampling)
+    if 100 > sampling > 0:
+        source = table.tablesample(sampling, name='alias', seed=text('{}'.format(SEED)))
+    else:
+        source = table
+    fields = [source.columns[c.name] for c in comb]
+    if probe_rows > 0:
+        seen = set()
+        try:
+            with ex.SourceReader(db_engine, select(fields).select_from(source).limit(probe_rows),
+                                 min(probe_rows, ex.DEFAULT_BATCH_SIZE)) as reader:
+                for rows in reader.batches():
+                    for row in rows:
+                        row = tuple(row)
+                        if row in seen:
+                            return True
+                        seen.add(row)
+            if seen.__len__() < probe_rows and all(ex.get_data_type(c) in EXACT_DATA_TYPES for c in comb):
+                # all rows were read
+                return False
+        except TypeError:
+            # values that cannot be hashed are compared by the db
+            pass
+    query = select([func.count().label('num')]).select_from(source).group_by(*fields)\
+        .having(func.count() > 1).limit(1)
+    res: ResultProxy = db_engine.execute(query)
+    duplicate = res.first() is not None
+    res.close()
+    return duplicate
+
+
 def retrieve_fks(metadata: MetaData, classes=None) -> dict:
     # Get existing FKs in schema
 
@@ -327,7 +667,8 @@ def retrieve_fks(metadata: MetaData, classes=None) -> dict:
 
 
 def discover_fks(db_engine: Engine, metadata: MetaData, pk_candidates, classes=None, max_fields=4, dump_tmp_dir=None,
-                 fks_suffix='_fks.json', precomputed_fks={}, sampling: int=0, cache_dir=None):
+                 fks_suffix='_fks.json', precomputed_fks={}, sampling: int=0, cache_dir=None,
+                 sampler: TableSampler=None, unary_inds=False):
     candidates = precomputed_fks
     inclusion_cache = {}
     cached_values = {}
@@ -337,61 +678,186 @@ def discover_fks(db_engine: Engine, metadata: MetaData, pk_candidates, classes=N
     # Return valid pairs
     if classes is None:
         classes = metadata.tables.keys()
-    with tqdm(classes, desc='Discovering FKs') as tpb:
-        for c in tpb:
-            tpb.postfix = c
-            tpb.update()
-            tpb.refresh()
+    # with sampling, the values of the foreign keys are checked in a sample of every table (see TableSampler).
+    # With unary_inds, the inclusions of single columns are all found at once first (see discover_unary_inds)
+    own_sampler = sampler is None and sampling > 0
+    if own_sampler:
+        sampler = TableSampler(db_engine, metadata, sampling)
+    try:
+        if unary_inds:
+            inclusion_cache = discover_unary_inds(db_engine, metadata, pk_candidates,
+                                                  classes=[c for c in classes if c not in candidates],
+                                                  sampler=sampler, cache_dir=cache_dir)
+        with tqdm(classes, desc='Discovering FKs') as tpb:
+            for c in tpb:
+                tpb.postfix = c
+                tpb.update()
+                tpb.refresh()
+
+                if c in candidates:
+                    continue  # FKs for this table are precomputed (because of resume)
+
+                t: Table = metadata.tables.get(c)
+
+                candidates_t = []
+                for n in tqdm(range(1, min(t.columns.__len__(), max_fields)+1), desc='Exploring candidates of length'):
+                    combinations = itertools.combinations(t.columns, n)
+                    for idx_comb, comb in tqdm(enumerate(combinations), desc='Checking combinations'):
+                        for idx_pkcand, candidate_pk_ref in tqdm(enumerate(
+                                get_candidate_pks_ref(pk_candidates,
+                                                      [str(get_col_type(col)) for col in comb])), desc='Checking candidates'):
+                            for idx_mapping, mapping in enumerate(
+                                    check_inclusion(db_engine, metadata, t, comb, candidate_pk_ref, inclusion_cache,
+                                                    cached_values, cache_dir, sampler=sampler)):
+                                cand_fk = {
+                                    'table': t.name,
+                                    'schema': t.schema,
+                                    'fullname': t.fullname,
+                                    'fk_name': "{}_{}_{}_{}_{}_fk".format(t.name, n, idx_comb, idx_pkcand, idx_mapping),
+                                    'fk_ref_pk': candidate_pk_ref['pk_name'],
+                                    'fk_ref_table': candidate_pk_ref['table'],
+                                    'fk_ref_table_fullname': candidate_pk_ref['fullname'],
+                                    'fk_columns': [c.name for c in comb],
+                                    'fk_columns_type': [str(get_col_type(c)) for c in comb],
+                                    'fk_ref_columns': mapping,
+                                }
+                                candidates_t.append(cand_fk)
+                candidates[c] = candidates_t
+                if dump_tmp_dir:
+                    json.dump({c: candidates_t}, open('{}/{}{}'.format(dump_tmp_dir, c, fks_suffix), mode='wt'), indent=True)
+    finally:
+        if own_sampler:
+            sampler.close()
+    return candidates
 
-            if c in candidates:
-                continue  # FKs for this table are precomputed (because of resume)
 
-            t: Table = metadata.tables.get(c)
+# key sorting the values of columns of all types in one order, where numbers of any type are compared by value
+def _ind_sort_key(value):
+    if isinstance(value, (int, float, Decimal)):
+        return 0, '', value
+    return 1, value.__class__.__name__, value
+
+
+def _write_sorted_values(path, values):
+    keys = sorted(_ind_sort_key(v) for v in values)
+    with open(path, mode='wb') as f:
+        for i in range(0, keys.__len__(), IND_CHUNK_SIZE):
+            pickle.dump(keys[i:i + IND_CHUNK_SIZE], f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _read_sorted_values(path, stream_id):
+    with open(path, mode='rb') as f:
+        while True:
+            try:
+                keys = pickle.load(f)
+            except EOFError:
+                return
+            for key in keys:
+                yield key, stream_id
+
+
+# get the distinct values of the columns of a table, read in one scan, or of its sample
+def _get_distinct_values(db_engine: Engine, metadata: MetaData, table: str, columns: list, sampler=None,
+                         batch_size=ex.DEFAULT_BATCH_SIZE):
+    if sampler:
+        _, sampled = sampler.get_columns(table)
+        return [set(sampled[c]) for c in columns]
+    t: Table = metadata.tables.get(table)
+    values = [set() for _ in columns]
+    with ex.SourceReader(db_engine, select([t.columns[c] for c in columns]), batch_size) as reader:
+        for rows in reader.batches():
+            for col_values, batch_values in zip(values, zip(*rows)):
+                try:
+                    col_values.update(batch_values)
+                except TypeError:
+                    col_values.update(_sample_value(v) for v in batch_values)
+    return values
+
 
-            total_rows = get_number_of_rows(db_engine, t)
-            if sampling > 0 and total_rows > 0:
-                sampling_perc = (min(sampling, total_rows) / total_rows) * 100
-                total_rows = get_number_of_rows(db_engine, t, sampling_perc)
+# discover the unary inclusion dependencies between the columns of the classes (with the values of their sample,
+# if there is a sampler) and the columns of the candidate PKs of the same type (with the values of the whole tables)
+# in one pass, as SPIDER does: the sorted distinct values of every column are written once to a file, and all the
+# dependencies are tested at once in a merge of the files, where every dependent column keeps the referenced
+# columns that have all of its values. Returns them in the format of the inclusion_cache of check_inclusion_in_db
+# {fk table: {pk table: {fk column: {pk column: included}}}}. As in is_included_server_side, dependent columns
+# with NULLs are not included in any column. Columns whose values cannot be sorted are left to check_inclusion.
+# Strings are compared in Python, not with the collation of the db, so values that differ only in case or trailing
+# spaces are different, even if the db finds them equal
+def discover_unary_inds(db_engine: Engine, metadata: MetaData, pk_candidates, classes=None,
+                        sampler: TableSampler=None, cache_dir=None, batch_size=ex.DEFAULT_BATCH_SIZE):
+    if classes is None:
+        classes = metadata.tables.keys()
+    referenced = sorted({(pk['fullname'], col, col_type) for pks in pk_candidates.values() for pk in pks
+                         for col, col_type in zip(pk['pk_columns'], pk['pk_columns_type'])})
+    ref_types = {col_type for _, _, col_type in referenced}
+    dependent = [(c, col.name, str(get_col_type(col))) for c in classes for col in metadata.tables.get(c).columns
+                 if str(get_col_type(col)) in ref_types]
+    # streams of sorted values (table, column, sampled). Without a sampler, dependent and referenced columns share them
+    sampled = sampler is not None
+    dep_streams = {(t, c): (t, c, sampled) for t, c, _ in dependent}
+    streams = sorted(set(dep_streams.values()) | {(t, c, False) for t, c, _ in referenced})
+    table_streams = dict()
+    for t, c, is_sampled in streams:
+        table_streams.setdefault((t, is_sampled), []).append((t, c, is_sampled))
+
+    inclusions = dict()
+    with tempfile.TemporaryDirectory(prefix='eddytools-inds-', dir=cache_dir) as tmp_dir:
+        paths = {stream: os.path.join(tmp_dir, '{}.pickle'.format(i)) for i, stream in enumerate(streams)}
+        with_nulls = set()
+        unsorted = set()
+        for (t, is_sampled), t_streams in tqdm(table_streams.items(), desc='Sorting column values'):
+            values = _get_distinct_values(db_engine, metadata, t, [c for _, c, _ in t_streams],
+                                          sampler if is_sampled else None, batch_size=batch_size)
+            for stream, col_values in zip(t_streams, values):
+                if None in col_values:
+                    with_nulls.add(stream)
+                    col_values.discard(None)
+                try:
+                    _write_sorted_values(paths[stream], col_values)
+                except TypeError:
+                    unsorted.add(stream)
+
+        refs = dict()
+        for t, c, col_type in dependent:
+            dep = dep_streams[(t, c)]
+            if dep in unsorted or dep in with_nulls:
+                refs[dep] = set()
             else:
-                sampling_perc = 0
-
-            candidates_t = []
-            for n in tqdm(range(1, min(t.columns.__len__(), max_fields)+1), desc='Exploring candidates of length'):
-                combinations = itertools.combinations(t.columns, n)
-                for idx_comb, comb in tqdm(enumerate(combinations), desc='Checking combinations'):
-                    for idx_pkcand, candidate_pk_ref in tqdm(enumerate(
-                            get_candidate_pks_ref(pk_candidates,
-                                                  [str(get_col_type(col)) for col in comb])), desc='Checking candidates'):
-                        for idx_mapping, mapping in enumerate(
-                                check_inclusion(db_engine, metadata, t, comb, candidate_pk_ref, inclusion_cache,
-                                                cached_values, cache_dir, sampling=sampling_perc)):
-                            cand_fk = {
-                                'table': t.name,
-                                'schema': t.schema,
-                                'fullname': t.fullname,
-                                'fk_name': "{}_{}_{}_{}_{}_fk".format(t.name, n, idx_comb, idx_pkcand, idx_mapping),
-                                'fk_ref_pk': candidate_pk_ref['pk_name'],
-                                'fk_ref_table': candidate_pk_ref['table'],
-                                'fk_ref_table_fullname': candidate_pk_ref['fullname'],
-                                'fk_columns': [c.name for c in comb],
-                                'fk_columns_type': [str(get_col_type(c)) for c in comb],
-                                'fk_ref_columns': mapping,
-                            }
-                            candidates_t.append(cand_fk)
-            candidates[c] = candidates_t
-            if dump_tmp_dir:
-                json.dump({c: candidates_t}, open('{}/{}{}'.format(dump_tmp_dir, c, fks_suffix), mode='wt'), indent=True)
-    return candidates
+                refs[dep] = {(rt, rc, False) for rt, rc, rt_type in referenced
+                             if rt_type == col_type and (rt, rc) != (t, c) and (rt, rc, False) not in unsorted}
+        active = {dep for dep, dep_refs in refs.items() if dep_refs}
+        merged = heapq.merge(*[_read_sorted_values(paths[stream], stream)
+                               for stream in sorted(active.union(*[refs[dep] for dep in active]))])
+        with tqdm(desc='Merging column values') as tpb:
+            for _, entries in itertools.groupby(merged, key=lambda entry: entry[0]):
+                # the columns with this value
+                present = {stream for _, stream in entries}
+                for dep in present & active:
+                    refs[dep] &= present
+                    if not refs[dep]:
+                        active.discard(dep)
+                if not active:
+                    break
+                tpb.update()
+
+    for t, c, col_type in dependent:
+        dep = dep_streams[(t, c)]
+        if dep in unsorted:
+            continue
+        for rt, rc, rt_type in referenced:
+            if rt_type == col_type and (rt, rc) != (t, c) and (rt, rc, False) not in unsorted:
+                inclusions.setdefault(t, {}).setdefault(rt, {}).setdefault(c, {})[rc] = (rt, rc, False) in refs[dep]
+    return inclusions
 
 
 def check_inclusion(db_engine: Engine, metadata: MetaData, table: Table, comb, candidate_pk, inclusion_cache={},
-                    cached_values=None, cache_dir=None, sampling=0):
+                    cached_values=None, cache_dir=None, sampling=0, sampler: TableSampler=None):
     return check_inclusion_in_db(db_engine, metadata, table, comb, candidate_pk, inclusion_cache, cached_values,
-                                 cache_dir, sampling)
+                                 cache_dir, sampling, sampler=sampler)
 
 
 def check_inclusion_in_db(db_engine: Engine, metadata: MetaData, table: Table, comb, candidate_pk, inclusion_cache={},
-                    cached_values=None, cache_dir=None, sampling=0):
+                    cached_values=None, cache_dir=None, sampling=0, sampler: TableSampler=None):
     if comb.__len__() == 0:
         return False
     field_names_fk = [c.name for c in comb]
@@ -421,7 +887,7 @@ def check_inclusion_in_db(db_engine: Engine, metadata: MetaData, table: Table, c
                 if fn_pk not in inclusion_map[fn_fk]:
                     included = is_included_server_side(db_engine, metadata, table.fullname, [fn_fk],
                                                        pk_tbfullname=candidate_pk['fullname'],
-                                                       pk_field_names=[fn_pk], sampling=sampling)
+                                                       pk_field_names=[fn_pk], sampling=sampling, sampler=sampler)
                 else:
                     included = inclusion_map[fn_fk][fn_pk]
                 inclusion_map[fn_fk][fn_pk] = included
@@ -433,15 +899,18 @@ def check_inclusion_in_db(db_engine: Engine, metadata: MetaData, table: Table, c
     valid_mappings = []
 
     for m in tqdm(possible_mappings, desc='Checking mappings'):
-        if is_included_server_side(db_engine, metadata, table.fullname, field_names_fk,
-                       pk_tbfullname=candidate_pk['fullname'], pk_field_names=m, sampling=sampling):
+        # the mappings of a single column are the inclusions already checked for the inclusion map
+        if field_names_fk.__len__() == 1 or \
+                is_included_server_side(db_engine, metadata, table.fullname, field_names_fk,
+                                        pk_tbfullname=candidate_pk['fullname'], pk_field_names=m, sampling=sampling,
+                                        sampler=sampler):
             valid_mappings.append(m)
 
     return valid_mappings
 
 
 def check_inclusion_in_mem(db_engine: Engine, metadata: MetaData, table: Table, comb, candidate_pk, inclusion_cache={},
-                    cached_values=None, cache_dir=None, sampling=0):
+                    cached_values=None, cache_dir=None, sampling=0, sampler: TableSampler=None):
     if comb.__len__() == 0:
         return False
     field_names_fk = [c.name for c in comb]
@@ -459,7 +928,8 @@ def check_inclusion_in_mem(db_engine: Engine, metadata: MetaData, table: Table,
     inclusion_map_for_k = {}
 
     for fn_fk, ft_fk in zip(field_names_fk, field_types_fk):
-        values_fn_fk = set(get_sample_values_fields(db_engine, metadata, table.fullname, [fn_fk], sampling=sampling))
+        values_fn_fk = set(get_sample_values_fields(db_engine, metadata, table.fullname, [fn_fk], sampling=sampling,
+                                                    sampler=sampler))
         if fn_fk not in inclusion_map:
             inclusion_map[fn_fk] = {}
         if fn_fk not in inclusion_map_for_k:
@@ -483,7 +953,8 @@ def check_inclusion_in_mem(db_engine: Engine, metadata: MetaData, table: Table,
 
     valid_mappings = []
 
-    values_fk = set(get_sample_values_fields(db_engine, metadata, table.fullname, field_names_fk, sampling=sampling))
+    values_fk = set(get_sample_values_fields(db_engine, metadata, table.fullname, field_names_fk, sampling=sampling,
+                                             sampler=sampler))
     for m in tqdm(possible_mappings, desc='Checking mappings'):
         if is_included(db_engine, metadata, cached_values, cache_dir, table.fullname, field_names_fk,
                        pk_name=candidate_pk['pk_name'], pk_tbfullname=candidate_pk['fullname'],
@@ -507,7 +978,10 @@ def is_included(db_engine: Engine, metadata: MetaData, cached_values, cache_dir,
 
 
 def is_included_server_side(db_engine: Engine, metadata: MetaData, fk_tbfullname, fk_field_names, pk_tbfullname,
-                            pk_field_names, sampling=0):
+                            pk_field_names, sampling=0, sampler: TableSampler=None):
+    if sampler:
+        return is_included_sample(db_engine, metadata, sampler, fk_tbfullname, fk_field_names, pk_tbfullname,
+                                  pk_field_names)
     tb_fk: Table = metadata.tables[fk_tbfullname]
     tb_pk: Table = metadata.tables[pk_tbfullname]
     tb_fk = tb_fk.alias('A')
@@ -528,6 +1002,27 @@ def is_included_server_side(db_engine: Engine, metadata: MetaData, fk_tbfullname
     return not_included
 
 
+# check the inclusion of the values of the fk columns in the sample of their table in the pk columns of the whole
+# pk table, looking the distinct sampled values up in the pk table in chunks. As in the join of
+# is_included_server_side, a sampled row with a NULL in the fk columns is not included
+def is_included_sample(db_engine: Engine, metadata: MetaData, sampler: TableSampler, fk_tbfullname, fk_field_names,
+                       pk_tbfullname, pk_field_names):
+    values = set(sampler.get_rows(fk_tbfullname, fk_field_names))
+    if any(None in v for v in values):
+        return False
+    tb_pk: Table = metadata.tables[pk_tbfullname]
+    pk_fields = [tb_pk.columns[col] for col in pk_field_names]
+    values = list(values)
+    for chunk in ex.get_chunks(values, 500):
+        res: ResultProxy = db_engine.execute(
+            select(pk_fields).distinct().where(ex.get_keys_clause(tb_pk, pk_field_names, chunk)))
+        found = set(tuple(r) for r in res)
+        res.close()
+        if not all(v in found for v in chunk):
+            return False
+    return True
+
+
 def load_cached_values(cache: dict, keyname):
     f = cache[keyname]
     values = pickle.load(open(f, mode='rb'))
@@ -563,7 +1058,10 @@ def generate_mappings(field_names_fk, inclusion_map, mapping):
 #     return values
 
 
-def get_sample_values_fields(db_engine: Engine, metadata: MetaData, table: str, fields: list, sampling: int=0):
+def get_sample_values_fields(db_engine: Engine, metadata: MetaData, table: str, fields: list, sampling: int=0,
+                             sampler: TableSampler=None):
+    if sampler:
+        return sampler.get_rows(table, fields)
     tb = metadata.tables.get(table)
     if 100 > sampling > 0:
         sample_t = tb.tablesample(sampling, seed=text('{}'.format(SEED)))
@@ -740,7 +1238,10 @@ def full_discovery(connection_params, dump_dir='output/dumps/',
 
 def full_discovery_from_engine(db_engine, dump_dir='output/dumps/', classes=None,
                                classes_for_pk=None, schemas=None, classes_for_fk=None,
-                               max_fields_key=4, resume=False, sampling: int = 0):
+                               max_fields_key=4, resume=False, sampling: int = 0,
+                               metadata_jobs=1, metadata_cache=None, in_memory=False,
+                               unary_inds=False):
+    sampler = None
     try:
 
         dump_tmp = '{}/tmp/'.format(dump_dir)
@@ -780,7 +1281,7 @@ def full_discovery_from_engine(db_engine, dump_dir='output/dumps/', classes=None
         if resume and exists(metadata_fname):
             metadata = pickle.load(open(metadata_fname, mode='rb'))
         else:
-            metadata = ex.get_metadata(db_engine, schemas=schemas)
+            metadata = ex.get_metadata(db_engine, schemas=schemas, jobs=metadata_jobs, cache_dir=metadata_cache)
             pickle.dump(metadata, open(metadata_fname, mode='wb'))
 
         if resume and exists(tables_def_fname):
@@ -820,6 +1321,10 @@ def full_discovery_from_engine(db_engine, dump_dir='output/dumps/', classes=None
         if not classes_for_pk:
             classes_for_pk = all_classes
 
+        if sampling > 0:
+            # the sample of every table is read once for the discovery of PKs and FKs, and kept for a resume
+            sampler = TableSampler(db_engine, metadata, sampling, cache_dir=dump_tmp_cache, reuse=resume)
+
         if resume and exists(discovered_pks_fname):
             discovered_pks = json.load(open(discovered_pks_fname, mode='rt'))
         else:
@@ -831,7 +1336,8 @@ def full_discovery_from_engine(db_engine, dump_dir='output/dumps/', classes=None
             pk_start_time = datetime.now()
             discovered_pks = discover_pks(db_engine, metadata, classes=classes_for_pk, max_fields=max_fields_key,
                                           dump_tmp_dir=dump_tmp_pks, pks_suffix=pks_suffix,
-                                          precomputed_pks=precomputed_pks, sampling=sampling)
+                                          precomputed_pks=precomputed_pks, sampling=sampling, sampler=sampler,
+                                          in_memory=in_memory)
             pk_end_time = datetime.now()
             # json.dump(discovered_pks, open(discovered_pks_fname, mode='wt'), indent=True) FIXME
 
@@ -873,7 +1379,8 @@ def full_discovery_from_engine(db_engine, dump_dir='output/dumps/', classes=None
             discovered_fks = discover_fks(db_engine, metadata, filtered_pks, classes=classes_for_fk,
                                           max_fields=max_fields_key, dump_tmp_dir=dump_tmp_fks,
                                           fks_suffix=fks_suffix, precomputed_fks=precomputed_fks,
-                                          sampling=sampling, cache_dir=dump_tmp_cache)
+                                          sampling=sampling, cache_dir=dump_tmp_cache, sampler=sampler,
+                                          unary_inds=unary_inds)
             fk_end_time = datetime.now()
             # json.dump(discovered_fks, open(discovered_fks_fname, mode='wt'), indent=True) FIXME
 
@@ -915,6 +1422,9 @@ def full_discovery_from_engine(db_engine, dump_dir='output/dumps/', classes=None
         return True
     except Exception as e:
         raise e
+    finally:
+        if sampler:
+            sampler.close()
 
 
 def load_list_classes(file):
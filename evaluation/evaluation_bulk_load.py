@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+import tempfile
+
+from eddytools import extraction as edex
+
+
+# load num_objects synthetic objects with 3 attribute values each into a new OpenSLEX mm with two secondary
+# indexes on attribute_value, committing every batch_size objects. Returns the seconds it took
+def synthetic_load(mm_file_path, bulk_load, num_objects=200000, batch_size=2000):
+    edex.create_mm(mm_file_path, overwrite=True)
+    mm_engine = edex.create_mm_engine(mm_file_path, bulk_load=bulk_load)
+    mm_engine.execute('CREATE INDEX attribute_value_ov ON attribute_value (object_version_id, attribute_name_id)')
+    mm_engine.execute('CREATE INDEX attribute_value_value ON attribute_value (value)')
+
+    t1 = time.time()
+    deferred_indexes = edex.begin_mm_bulk_load(mm_engine) if bulk_load else None
+    mm_conn = mm_engine.connect()
+    writer = edex.ObjectBatchWriter(mm_conn, batch_size)
+    to_integer = edex.ATTRIBUTE_CONVERTERS['integer']
+    to_string = edex.ATTRIBUTE_CONVERTERS['string']
+    trans = mm_conn.begin()
+    for i in range(num_objects):
+        # (attribute_id, value, type) as the extraction passes them
+        writer.add_object(1, [(1,) + to_integer(i), (2,) + to_string('value {}'.format(i * 7919 % num_objects)),
+                              (3,) + to_integer(i % 13)])
+        if (i + 1) % batch_size == 0:
+            writer.flush()
+            trans.commit()
+            trans = mm_conn.begin()
+    writer.close()
+    trans.commit()
+    mm_conn.close()
+    if bulk_load:
+        edex.end_mm_bulk_load(mm_engine, deferred_indexes)
+    mm_engine.dispose()
+    return time.time() - t1
+
+
+def evaluate_bulk_load(output_dir=None, num_objects=200000):
+    output_dir = output_dir or tempfile.mkdtemp(prefix='bulk_load-')
+    default_time = synthetic_load(os.path.join(output_dir, 'mm-default.slexmm'), False, num_objects)
+    bulk_time = synthetic_load(os.path.join(output_dir, 'mm-bulk-load.slexmm'), True, num_objects)
+    print('Objects: {}'.format(num_objects))
+    print('Default settings: {:.2f}s'.format(default_time))
+    print('Bulk load: {:.2f}s'.format(bulk_time))
+    print('Speedup: {:.2f}x'.format(default_time / bulk_time))
+    return default_time, bulk_time
+
+
+if __name__ == '__main__':
+    evaluate_bulk_load(*sys.argv[1:2])
@@ -2,6 +2,10 @@ import eddytools.extraction as ex
 import eddytools.schema as es
 import sqlalchemy as sq
 from sqlalchemy.sql.expression import text
+import sqlite3
+import json
+from datetime import datetime
+from decimal import Decimal
 import pytest
 
 connection_params = {
@@ -83,6 +87,544 @@ def test_custom_metadata_extraction():
     assert check_mm(openslex_file_path, connection_params, metadata=metadata)
 
 
+def create_sqlite_source(path, n=50):
+    conn = sqlite3.connect(str(path))
+    conn.executescript('''
+        CREATE TABLE customer (id INTEGER PRIMARY KEY, name VARCHAR(50), created TIMESTAMP, photo BLOB);
+        CREATE TABLE orders (id INTEGER PRIMARY KEY, customer_id INTEGER, status VARCHAR(10),
+                             amount NUMERIC(10, 2), notes TEXT,
+                             CONSTRAINT orders_customer_fk FOREIGN KEY (customer_id) REFERENCES customer (id));
+        CREATE TABLE tag (name VARCHAR(20), val INTEGER);
+    ''')
+    for i in range(1, n + 1):
+        conn.execute('INSERT INTO customer VALUES (?, ?, ?, ?)',
+                     (i, 'customer {}'.format(i), '2019-01-{:02d} 10:00:00'.format(i % 28 + 1), b'\x00' * 10))
+    for i in range(1, 3 * n + 1):
+        conn.execute('INSERT INTO orders VALUES (?, ?, ?, ?, ?)',
+                     (i, (i % n) + 1 if i % 10 else None, ['new', 'paid', 'sent'][i % 3], i * 1.5, 'note'))
+    for i in range(20):
+        conn.execute('INSERT INTO tag VALUES (?, ?)', ('t{}'.format(i % 7), i % 3))
+    conn.commit()
+    conn.close()
+
+
+def dump_mm(openslex_file_path):
+    conn = sqlite3.connect(str(openslex_file_path))
+    dump = {t: conn.execute('SELECT * FROM {} ORDER BY id'.format(t)).fetchall()
+            for t in ['object', 'object_version', 'attribute_value', 'relation']}
+    conn.close()
+    return dump
+
+
+# content of an mm independent of the ids assigned to its objects
+def canonical_mm(openslex_file_path):
+    conn = sqlite3.connect(str(openslex_file_path))
+    objs = {}
+    for ov_id, cl_name in conn.execute('SELECT OV.id, CL.name FROM object_version AS OV, object AS O, class AS CL '
+                                       'WHERE OV.object_id = O.id AND O.class_id = CL.id'):
+        objs[ov_id] = [cl_name]
+    for ov_id, at_name, value in conn.execute('SELECT AV.object_version_id, AN.name, AV.value '
+                                              'FROM attribute_value AS AV, attribute_name AS AN '
+                                              'WHERE AV.attribute_name_id = AN.id ORDER BY AN.name'):
+        objs[ov_id].append((at_name, value))
+    objs = {ov_id: tuple(o) for ov_id, o in objs.items()}
+    rels = [(objs[s], objs[t], rs_name) for s, t, rs_name in
+            conn.execute('SELECT R.source_object_version_id, R.target_object_version_id, RS.name '
+                         'FROM relation AS R, relationship AS RS WHERE R.relationship_id = RS.id')]
+    conn.close()
+    return sorted(objs.values()), sorted(rels)
+
+
+def extract_sqlite_source(tmp_path, name, **kwargs):
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    metadata = ex.get_metadata(db_engine)
+    mm_path = tmp_path / name / 'mm.slexmm'
+    ex.extraction_from_db(mm_path, str(tmp_path / name), db_engine, overwrite=True,
+                          metadata=metadata, **kwargs)
+    return mm_path
+
+
+def test_batched_extraction(tmp_path):
+    create_sqlite_source(tmp_path / 'source.db')
+    reference = dump_mm(extract_sqlite_source(tmp_path, 'batch_1', batch_size=1))
+    assert reference['object'].__len__() == 50 + 150 + 20
+    assert reference['relation'].__len__() == 135
+    for batch_size in [7, ex.DEFAULT_BATCH_SIZE]:
+        assert dump_mm(extract_sqlite_source(tmp_path, 'batch_{}'.format(batch_size),
+                                             batch_size=batch_size)) == reference
+
+
+def test_single_pass_extraction(tmp_path):
+    create_sqlite_source(tmp_path / 'source.db')
+    reference = dump_mm(extract_sqlite_source(tmp_path, 'two_pass'))
+    assert dump_mm(extract_sqlite_source(tmp_path, 'single_pass', single_pass=True)) == reference
+    # spilling the foreign key buffer and the key index to disk
+    assert dump_mm(extract_sqlite_source(tmp_path, 'single_pass_spill', single_pass=True,
+                                         batch_size=16, index_memory=1024)) == reference
+
+
+def test_parallel_extraction(tmp_path):
+    create_sqlite_source(tmp_path / 'source.db')
+    reference = canonical_mm(extract_sqlite_source(tmp_path, 'sequential'))
+    assert canonical_mm(extract_sqlite_source(tmp_path, 'parallel', jobs=3, batch_size=16)) == reference
+
+
+def test_partitioned_extraction(tmp_path):
+    create_sqlite_source(tmp_path / 'source.db')
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    metadata = ex.get_metadata(db_engine)
+    ranges = ex.get_key_ranges(db_engine, metadata.tables['main.orders'], 4)
+    assert ranges.__len__() == 4
+    assert ex.get_key_ranges(db_engine, metadata.tables['main.tag'], 4) is None
+
+    reference = canonical_mm(extract_sqlite_source(tmp_path, 'sequential'))
+    first = extract_sqlite_source(tmp_path, 'partitioned1', jobs=3, partitions=4, batch_size=16)
+    second = extract_sqlite_source(tmp_path, 'partitioned2', jobs=2, partitions=4, batch_size=5)
+    assert canonical_mm(first) == reference
+    # ids of objects and attribute values do not depend on the order in which ranges are read
+    first, second = dump_mm(first), dump_mm(second)
+    for t in ['object', 'object_version', 'attribute_value']:
+        assert first[t] == second[t]
+
+
+def test_staged_relations(tmp_path):
+    create_sqlite_source(tmp_path / 'source.db')
+    reference = canonical_mm(extract_sqlite_source(tmp_path, 'lookup'))
+    for name, kwargs in [('staged', {}), ('staged_batch', {'batch_size': 7}),
+                         ('staged_parallel', {'jobs': 3, 'partitions': 4, 'batch_size': 16})]:
+        mm_path = extract_sqlite_source(tmp_path, name, staged_relations=True, **kwargs)
+        assert canonical_mm(mm_path) == reference
+        # the staging tables are dropped once the relations are inserted
+        conn = sqlite3.connect(str(mm_path))
+        assert conn.execute("SELECT count(*) FROM sqlite_master WHERE name LIKE 'relation_staging%'").fetchone() == (0,)
+        conn.close()
+
+
+def test_merged_relations(tmp_path):
+    create_sqlite_source(tmp_path / 'source.db')
+    reference = canonical_mm(extract_sqlite_source(tmp_path, 'lookup'))
+    # spilling the sorted runs of foreign keys and the key index to disk
+    for name, kwargs in [('merged', {}), ('merged_spill', {'batch_size': 16, 'index_memory': 1024}),
+                         ('merged_parallel', {'jobs': 3, 'partitions': 4, 'index_memory': 1024})]:
+        assert canonical_mm(extract_sqlite_source(tmp_path, name, merge_relations=True, **kwargs)) == reference
+
+
+def test_bulk_load(tmp_path):
+    create_sqlite_source(tmp_path / 'source.db')
+    reference = dump_mm(extract_sqlite_source(tmp_path, 'default', bulk_load=False))
+    mm_path = extract_sqlite_source(tmp_path, 'bulk_load', bulk_load=True)
+    assert dump_mm(mm_path) == reference
+    conn = sqlite3.connect(str(mm_path))
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+    assert conn.execute('SELECT count(*) FROM sqlite_stat1').fetchone()[0] > 0
+    conn.close()
+
+    # secondary indexes are dropped during the load and created again at the end
+    mm_engine = ex.create_mm_engine(mm_path, bulk_load=True)
+    mm_engine.execute('CREATE INDEX object_class ON object (class_id)')
+    deferred_indexes = ex.begin_mm_bulk_load(mm_engine)
+    assert deferred_indexes == ['CREATE INDEX object_class ON object (class_id)']
+    assert mm_engine.execute("SELECT count(*) FROM sqlite_master WHERE name = 'object_class'").scalar() == 0
+    # a bulk load resumed after a failure still creates the indexes dropped by the failed one
+    assert ex.get_deferred_indexes(mm_engine) == deferred_indexes
+    assert ex.begin_mm_bulk_load(mm_engine) == deferred_indexes
+    ex.end_mm_bulk_load(mm_engine, deferred_indexes)
+    assert mm_engine.execute("SELECT count(*) FROM sqlite_master WHERE name = 'object_class'").scalar() == 1
+    assert ex.get_deferred_indexes(mm_engine) == []
+    mm_engine.dispose()
+
+
+# queries with the joins of the event and case notion discovery
+MM_QUERIES = [
+    'SELECT t1.attribute_name_id, t2.attribute_name_id, count(t2.value) '
+    'FROM attribute_value AS t1 JOIN attribute_value AS t2 ON t1.object_version_id = t2.object_version_id '
+    'WHERE t1.attribute_name_id IN (1, 2) AND t2.attribute_name_id IN (3, 4) GROUP BY 1, 2',
+    'SELECT t2.value FROM attribute_value AS t1 '
+    'JOIN relation AS r ON t1.object_version_id = r.source_object_version_id '
+    'JOIN attribute_value AS t2 ON r.target_object_version_id = t2.object_version_id '
+    'WHERE t1.attribute_name_id IN (1, 2) AND r.relationship_id IN (1) AND t2.attribute_name_id IN (3, 4)',
+    'SELECT event_id FROM event_to_object_version WHERE object_version_id = 5',
+]
+
+
+def explain_mm_queries(openslex_file_path):
+    conn = sqlite3.connect(str(openslex_file_path))
+    plans = [[r[3] for r in conn.execute('EXPLAIN QUERY PLAN {}'.format(q)) if not r[3].startswith('USE TEMP')]
+             for q in MM_QUERIES]
+    conn.close()
+    return plans
+
+
+def test_mm_indexes(tmp_path):
+    create_sqlite_source(tmp_path / 'source.db')
+    mm_path = extract_sqlite_source(tmp_path, 'mm')
+    mm_engine = ex.create_mm_engine(mm_path)
+    assert ex.get_missing_mm_indexes(mm_engine) == [name for name, _, _ in ex.MM_INDEXES]
+    assert all(any(step.startswith('SCAN') for step in plan) for plan in explain_mm_queries(mm_path))
+
+    assert ex.create_mm_indexes(mm_engine) == [name for name, _, _ in ex.MM_INDEXES]
+    assert ex.get_missing_mm_indexes(mm_engine) == []
+    for plan in explain_mm_queries(mm_path):
+        assert all(step.startswith('SEARCH') and 'USING COVERING INDEX' in step for step in plan)
+
+    mm_engine.execute('DROP INDEX relation_rs_source')
+    ex.check_mm_indexes(mm_engine)
+    assert ex.get_missing_mm_indexes(mm_engine) == []
+    mm_engine.dispose()
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'single_pass': True}, {'jobs': 2}, {'staged_relations': True},
+                                    {'bulk_load': True}])
+def test_resume_extraction(tmp_path, kwargs):
+    create_sqlite_source(tmp_path / 'source.db')
+    reference = dump_mm(extract_sqlite_source(tmp_path, 'reference'))
+
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    metadata = ex.get_metadata(db_engine)
+    mm_path = tmp_path / 'resumed' / 'mm.slexmm'
+    db_engine.execute('ALTER TABLE tag RENAME TO tag_tmp')
+    with pytest.raises((sqlite3.OperationalError, sq.exc.OperationalError)):
+        ex.extraction_from_db(mm_path, str(tmp_path / 'resumed'), db_engine, overwrite=True,
+                              metadata=metadata, **kwargs)
+    conn = sqlite3.connect(str(mm_path))
+    checkpoints = dict(conn.execute('SELECT class_name, phase FROM extraction_checkpoint').fetchall())
+    if kwargs.get('bulk_load'):
+        # as if the failed bulk load had dropped an index
+        conn.execute("INSERT INTO extraction_deferred_index VALUES ('object_class', "
+                     "'CREATE INDEX object_class ON object (class_id)')")
+        conn.commit()
+    conn.close()
+    if kwargs.get('jobs'):
+        # classes read in parallel with tag may have failed with it
+        assert set(checkpoints.items()) <= {('main.customer', 'objects'), ('main.orders', 'objects')}
+    else:
+        assert checkpoints == {'main.customer': 'objects', 'main.orders': 'objects'}
+        # completed tables are not read again
+        db_engine.execute('ALTER TABLE customer RENAME TO customer_tmp')
+
+    db_engine.execute('ALTER TABLE tag_tmp RENAME TO tag')
+    ex.extraction_from_db(mm_path, str(tmp_path / 'resumed'), db_engine, overwrite=True,
+                          metadata=metadata, resume=True, **kwargs)
+    if kwargs.get('jobs') or kwargs.get('staged_relations'):
+        # relations are not inserted in the same order
+        assert canonical_mm(mm_path) == canonical_mm(tmp_path / 'reference' / 'mm.slexmm')
+    else:
+        assert dump_mm(mm_path) == reference
+    # the keys are kept for incremental extractions
+    assert (tmp_path / 'resumed' / 'mm.slexmm.keys').is_dir()
+    conn = sqlite3.connect(str(mm_path))
+    assert conn.execute("SELECT count(*) FROM sqlite_master WHERE name = 'object_class'").fetchone()[0] == \
+        bool(kwargs.get('bulk_load'))
+    assert not conn.execute("SELECT name FROM sqlite_master WHERE name = 'extraction_deferred_index'").fetchall()
+    conn.close()
+
+
+def test_incremental_extraction(tmp_path):
+    create_sqlite_source(tmp_path / 'source.db')
+    watermarks = {'main.customer': 'created', 'main.orders': 'id'}
+    mm_path = extract_sqlite_source(tmp_path, 'mm', watermarks=watermarks)
+    reference = dump_mm(mm_path)
+
+    conn = sqlite3.connect(str(tmp_path / 'source.db'))
+    conn.execute("UPDATE customer SET name = 'changed', created = '2019-02-01 00:00:00' WHERE id = 5")
+    conn.execute("INSERT INTO customer VALUES (51, 'customer 51', '2019-02-02 00:00:00', NULL)")
+    conn.execute("INSERT INTO orders VALUES (151, 5, 'new', 1.0, 'note'), (152, 51, 'new', 2.0, 'note')")
+    conn.commit()
+    conn.close()
+
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    metadata = ex.get_metadata(db_engine)
+    ex.incremental_extraction_from_db(mm_path, str(tmp_path / 'mm'), db_engine, metadata, watermarks)
+    dump = dump_mm(mm_path)
+    assert dump['object'].__len__() == reference['object'].__len__() + 3
+    assert dump['object_version'].__len__() == reference['object_version'].__len__() + 4
+
+    conn = sqlite3.connect(str(mm_path))
+    versions = conn.execute("SELECT OV.start_timestamp, OV.end_timestamp, AV.value "
+                            "FROM object_version AS OV, attribute_value AS AV, attribute_name AS AN "
+                            "WHERE AV.object_version_id = OV.id AND AV.attribute_name_id = AN.id "
+                            "AND AN.name = 'name' AND OV.object_id = (SELECT object_id FROM object_version "
+                            "WHERE id = (SELECT object_version_id FROM attribute_value WHERE value = 'changed')) "
+                            "ORDER BY OV.id").fetchall()
+    timestamp = versions[1][0]
+    assert timestamp > 0
+    assert versions == [(-2, timestamp, 'customer 5'), (timestamp, -1, 'changed')]
+    # the 3 orders of customer 5 are related to its new version, and the 2 new orders to their customers
+    rels = conn.execute('SELECT start_timestamp, end_timestamp, count(*) FROM relation '
+                        'GROUP BY 1, 2 ORDER BY 1, 2').fetchall()
+    assert rels == [(-2, -1, 132), (-2, timestamp, 3), (timestamp, -1, 5)]
+    assert dict(conn.execute('SELECT class_name, value FROM extraction_watermark').fetchall()) == \
+        {'main.customer': '2019-02-02 00:00:00', 'main.orders': '152'}
+    conn.close()
+
+    # without changes, nothing is extracted. The watermarks default to the ones stored in the mm
+    ex.incremental_extraction_from_db(mm_path, str(tmp_path / 'mm'), db_engine, metadata)
+    assert dump_mm(mm_path) == dump
+    # which must have been extracted with watermarks
+    mm_path = extract_sqlite_source(tmp_path, 'no_watermarks')
+    with pytest.raises(Exception, match='No watermarks'):
+        ex.incremental_extraction_from_db(mm_path, str(tmp_path / 'no_watermarks'), db_engine, metadata)
+
+
+def test_class_query(tmp_path):
+    create_sqlite_source(tmp_path / 'source.db')
+    mm_path = extract_sqlite_source(tmp_path, 'mm')
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    metadata = ex.get_metadata(db_engine)
+    mm_engine = ex.create_mm_engine(mm_path)
+    mm_conn = mm_engine.connect()
+    _, attr_map, rel_map = ex.get_metadata_maps(mm_conn, [])
+    mm_conn.close()
+    mm_engine.dispose()
+    # the binary column, not mapped to an attribute, is not read
+    query = ex.get_class_query(metadata.tables['main.customer'], 'main.customer', attr_map, rel_map)
+    assert [col.name for col in query.columns] == ['id', 'name', 'created']
+    query = ex.get_class_query(metadata.tables['main.orders'], 'main.orders', attr_map, rel_map)
+    assert [col.name for col in query.columns] == ['id', 'customer_id', 'status', 'amount', 'notes']
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'jobs': 2, 'partitions': 2}])
+@pytest.mark.parametrize('fk_closure', [False, True])
+def test_filtered_extraction(tmp_path, kwargs, fk_closure):
+    create_sqlite_source(tmp_path / 'source.db')
+    filters = {'main.orders': {'where': "status = 'paid'"},
+               'main.customer': {'column': 'created', 'start': '2019-01-10', 'end': '2019-01-15'}}
+    mm_path = extract_sqlite_source(tmp_path, 'mm', filters=filters, fk_closure=fk_closure, **kwargs)
+
+    conn = sqlite3.connect(str(tmp_path / 'source.db'))
+    customers = "created >= '2019-01-10' AND created < '2019-01-15'"
+    if fk_closure:
+        customers += " OR id IN (SELECT customer_id FROM orders WHERE status = 'paid')"
+    expected = {
+        'main.customer': conn.execute('SELECT count(*) FROM customer WHERE {}'.format(customers)).fetchone()[0],
+        'main.orders': 50,
+        'main.tag': 20,
+    }
+    expected_rels = conn.execute("SELECT count(*) FROM orders WHERE status = 'paid' AND customer_id IN "
+                                 "(SELECT id FROM customer WHERE {})".format(customers)).fetchone()[0]
+    conn.close()
+
+    conn = sqlite3.connect(str(mm_path))
+    counts = dict(conn.execute('SELECT CL.name, count(*) FROM object AS O, class AS CL '
+                               'WHERE O.class_id = CL.id GROUP BY CL.name').fetchall())
+    assert counts == expected
+    assert conn.execute('SELECT count(*) FROM relation').fetchone()[0] == expected_rels
+    conn.close()
+    if fk_closure:
+        # every paid order with a customer is related to it
+        assert expected_rels == 45
+
+
+@pytest.mark.parametrize('roots, size, expected', [
+    # the orders of the first 3 customers
+    (['main.customer'], 3, {'main.customer': 3, 'main.orders': 6}),
+    # the customers of the first 5 orders, without their other orders
+    (['main.orders'], 5, {'main.customer': 5, 'main.orders': 5}),
+    (None, 3, {'main.customer': 4, 'main.orders': 7, 'main.tag': 3}),
+])
+def test_sample_extraction(tmp_path, roots, size, expected):
+    create_sqlite_source(tmp_path / 'source.db')
+    mm_path = extract_sqlite_source(tmp_path, 'mm', sample=size, sample_roots=roots)
+    conn = sqlite3.connect(str(mm_path))
+    counts = dict(conn.execute('SELECT CL.name, count(*) FROM object AS O, class AS CL '
+                               'WHERE O.class_id = CL.id GROUP BY CL.name').fetchall())
+    assert counts == expected
+    # every order with a customer is related to it
+    assert conn.execute("SELECT count(*) FROM relation").fetchone()[0] == expected['main.orders']
+    conn.close()
+
+
+def test_typed_attribute_values(tmp_path):
+    create_sqlite_source(tmp_path / 'source.db')
+    mm_path = extract_sqlite_source(tmp_path, 'mm')
+    conn = sqlite3.connect(str(mm_path))
+    values = conn.execute("SELECT CL.name || '.' || AN.name, AV.value, AV.type "
+                          "FROM attribute_value AS AV, attribute_name AS AN, class AS CL "
+                          "WHERE AV.attribute_name_id = AN.id AND AN.class_id = CL.id "
+                          "AND AV.object_version_id IN (1, 52)").fetchall()
+    conn.close()
+    created = int(datetime(2019, 1, 2, 10).timestamp() * 1000)
+    # the type is only stored for values that do not have the type of their attribute
+    assert sorted(values) == [
+        ('main.customer.created', created, None),
+        ('main.customer.id', 1, None),
+        ('main.customer.name', 'customer 1', None),
+        ('main.orders.amount', 3, None),
+        ('main.orders.customer_id', 3, None),
+        ('main.orders.id', 2, None),
+        ('main.orders.notes', 'note', None),
+        ('main.orders.status', 'sent', None),
+    ]
+    assert ex.ATTRIBUTE_CONVERTERS['timestamp']('2019-01-02 10:00:00') == (created, None)
+    assert ex.ATTRIBUTE_CONVERTERS['timestamp']('soon') == ('soon', 'string')
+    assert ex.ATTRIBUTE_CONVERTERS['integer']('12') == (12, None)
+    assert ex.ATTRIBUTE_CONVERTERS['integer'](1 << 64) == (str(1 << 64), 'string')
+    assert ex.ATTRIBUTE_CONVERTERS['numeric'](Decimal('1.50')) == (1.5, None)
+    assert ex.ATTRIBUTE_CONVERTERS['numeric'](float('nan')) == ('nan', 'string')
+
+    # events are built from the timestamps stored in epoch millis
+    import eddytools.events as ev
+    mm_engine = ex.create_mm_engine(mm_path)
+    ts_id = mm_engine.execute("SELECT id FROM attribute_name WHERE name = 'created'").scalar()
+    ev.compute_events(mm_engine, ex.get_mm_meta(mm_engine), [(ts_id, None, None, 'created', None, None)])
+    assert mm_engine.execute('SELECT min(timestamp), count(*) FROM event').first() == \
+        (int(datetime(2019, 1, 1, 10).timestamp() * 1000), 50)
+    mm_engine.dispose()
+
+
+def test_dictionary_extraction(tmp_path):
+    create_sqlite_source(tmp_path / 'source.db')
+    reference_path = extract_sqlite_source(tmp_path, 'inline')
+    mm_path = extract_sqlite_source(tmp_path, 'dictionary', dictionary=True)
+    # attribute_value is a view on the encoded values with the same content
+    assert dump_mm(mm_path) == dump_mm(reference_path)
+    conn = sqlite3.connect(str(mm_path))
+    assert conn.execute("SELECT D.value FROM attribute_value_dictionary AS D, attribute_name AS AN "
+                        "WHERE D.attribute_name_id = AN.id AND AN.name = 'status' "
+                        "ORDER BY D.value").fetchall() == [('new',), ('paid',), ('sent',)]
+    # encoded strings are not stored inline
+    assert conn.execute("SELECT count(*) FROM attribute_value_data WHERE value = 'paid'").fetchone() == (0,)
+    conn.close()
+    assert canonical_mm(extract_sqlite_source(tmp_path, 'dictionary_parallel', dictionary=True, jobs=3,
+                                              partitions=4, batch_size=16)) == canonical_mm(reference_path)
+
+    # the features of the activity identifiers are computed on the encoded values
+    from eddytools.events import activity_identifier_feature_functions as evff
+    from eddytools.events.activity_identifier_discovery import ActivityIdentifierDiscoverer, CT_IN_TABLE, CT_LOOKUP
+    features = [evff.nr_values_where_timestamp, evff.text_length_mean_std_cv]
+    feature_values = []
+    for path in [reference_path, mm_path]:
+        mm_engine = ex.create_mm_engine(path)
+        aid = ActivityIdentifierDiscoverer(mm_engine, ex.get_mm_meta(mm_engine), model=None)
+        timestamp_attrs = aid.get_timestamp_attributes()
+        candidates = aid.generate_candidates(timestamp_attrs, [CT_IN_TABLE, CT_LOOKUP])
+        feature_values.append(aid.compute_features(candidates, features=features, filter_=False))
+        mm_engine.dispose()
+    assert feature_values[0] == feature_values[1]
+    assert any(fv['text_length_mean'] > 0 for fv in feature_values[1])
+
+
+def test_lookup_activity_features(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'source.db'))
+    conn.executescript('''
+        CREATE TABLE customer (id INTEGER PRIMARY KEY, code INTEGER, name VARCHAR(50));
+        CREATE TABLE orders (id INTEGER PRIMARY KEY, customer_id INTEGER, created TIMESTAMP,
+                             CONSTRAINT orders_customer_fk FOREIGN KEY (customer_id) REFERENCES customer (id));
+    ''')
+    for i in range(1, 6):
+        conn.execute('INSERT INTO customer VALUES (?, ?, ?)', (i, 100 + i, 'customer {}'.format(i)))
+    for i in range(1, 21):
+        conn.execute('INSERT INTO orders VALUES (?, ?, ?)', (i, i % 5 + 1, '2019-01-{:02d} 10:00:00'.format(i)))
+    conn.commit()
+    conn.close()
+    mm_path = extract_sqlite_source(tmp_path, 'mm')
+
+    # integer attributes of the objects looked up are activity identifier candidates too
+    from eddytools.events.activity_identifier_discovery import ActivityIdentifierDiscoverer, CT_LOOKUP
+    mm_engine = ex.create_mm_engine(mm_path)
+    aid = ActivityIdentifierDiscoverer(mm_engine, ex.get_mm_meta(mm_engine), model=None)
+    candidates = aid.generate_candidates(aid.get_timestamp_attributes(), [CT_LOOKUP])
+    feature_values = aid.compute_features(candidates, filter_=False)
+    mm_engine.dispose()
+    fractions = {fv['data_type']: fv['alphabetic_fraction'] for fv in feature_values}
+    assert fractions['integer'] == 0
+    assert 0 < fractions['string'] < 1
+
+
+def test_typed_activity_names(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'source.db'))
+    conn.executescript('''
+        CREATE TABLE orders (id INTEGER PRIMARY KEY, created TIMESTAMP, amount NUMERIC(10, 2), paid BOOLEAN,
+                             status VARCHAR(10));
+        INSERT INTO orders VALUES (1, '2019-01-01 10:00:00', 1.50, 1, 'new');
+    ''')
+    conn.close()
+    mm_path = extract_sqlite_source(tmp_path, 'mm')
+
+    # activity names have the values as stored in the mm: numbers without the scale of their column
+    # and booleans as 1 or 0
+    from eddytools.events import compute_events
+    mm_engine = ex.create_mm_engine(mm_path)
+    mm_meta = ex.get_mm_meta(mm_engine)
+    attr_ids = dict(mm_engine.execute('SELECT name, id FROM attribute_name').fetchall())
+    compute_events(mm_engine, mm_meta, [(attr_ids['created'], attr_ids[name], None, 'created', name, None)
+                                        for name in ['amount', 'paid', 'status']])
+    names = sorted(name for name, in mm_engine.execute('SELECT name FROM activity').fetchall())
+    mm_engine.dispose()
+    assert names == ['main.orders.amount.1.5', 'main.orders.paid.1', 'main.orders.status.new']
+
+
+def test_parallel_extraction_error(tmp_path):
+    create_sqlite_source(tmp_path / 'source.db')
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    metadata = ex.get_metadata(db_engine)
+    db_engine.execute('DROP TABLE tag')
+    with pytest.raises(sqlite3.OperationalError):
+        ex.extraction_from_db(tmp_path / 'mm.slexmm', str(tmp_path), db_engine, overwrite=True,
+                              metadata=metadata, jobs=2, batch_size=4)
+
+
+def test_source_reader(tmp_path):
+    create_sqlite_source(tmp_path / 'source.db')
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    metadata = ex.get_metadata(db_engine)
+    orders = metadata.tables['main.orders']
+    with ex.SourceReader(db_engine, orders.select(), batch_size=7) as reader:
+        batches = list(reader.batches())
+    assert max(b.__len__() for b in batches) == 7
+    assert sum(b.__len__() for b in batches) == 150
+    assert reader.columns == [col.name for col in orders.columns]
+    assert batches[0][0][reader.index['status']] == 'paid'
+
+
+def describe_metadata(metadata):
+    return {t.fullname: ([(c.name, str(c.type), c.primary_key) for c in t.columns],
+                         sorted((fk.parent.name, fk.target_fullname) for fk in t.foreign_keys))
+            for t in metadata.tables.values()}
+
+
+def test_cached_metadata(tmp_path):
+    create_sqlite_source(tmp_path / 'source.db')
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    reference = describe_metadata(ex.get_metadata(db_engine))
+    assert describe_metadata(ex.get_metadata(db_engine, jobs=2)) == reference
+    cache_dir = tmp_path / 'cache'
+    assert describe_metadata(ex.get_metadata(db_engine, cache_dir=str(cache_dir))) == reference
+    snapshots = list(cache_dir.iterdir())
+    assert snapshots.__len__() == 1
+    # loaded from the snapshot and bound to the engine
+    metadata = ex.get_metadata(db_engine, cache_dir=str(cache_dir))
+    assert describe_metadata(metadata) == reference
+    assert metadata.bind is db_engine
+    assert list(cache_dir.iterdir()) == snapshots
+    # a schema change invalidates the snapshot
+    db_engine.execute('ALTER TABLE tag ADD COLUMN extra INTEGER')
+    metadata = ex.get_metadata(db_engine, cache_dir=str(cache_dir))
+    assert 'extra' in metadata.tables['main.tag'].columns
+    assert list(cache_dir.iterdir()).__len__() == 2
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'single_pass': True}, {'jobs': 2, 'partitions': 2, 'bulk_load': True},
+                                    {'staged_relations': True}, {'merge_relations': True}])
+def test_extraction_report(tmp_path, kwargs):
+    create_sqlite_source(tmp_path / 'source.db')
+    mm_path = extract_sqlite_source(tmp_path, 'report', report=True, **kwargs)
+    with open(ex.get_report_path(mm_path)) as f:
+        report = json.load(f)
+    dump = dump_mm(mm_path)
+    assert report['rows_written'] == {t: dump[t].__len__() for t in report['rows_written']}
+    assert report['classes']['main.orders']['rows_written']['relation'] == 135
+    assert report['classes']['main.customer']['rows_written']['object'] == 50
+    # tables with foreign keys are read twice in two-pass extractions
+    rows_read = 150 if kwargs else 300
+    assert report['classes']['main.orders']['rows_read'] == rows_read
+    assert report['classes']['main.customer']['bytes_read'] > 0
+    assert {'metadata', 'objects', 'relations'} <= set(report['stages'])
+    assert ('indexes' in report['stages']) == kwargs.get('bulk_load', False)
+    assert report['options']['jobs'] == kwargs.get('jobs', 1)
+    assert all(t >= 0 for c in report['classes'].values() for t in c['time'].values())
+
+
 if __name__ == '__main__':
     test_ds2()
     #test_custom_metadata_extraction()
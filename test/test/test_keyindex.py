@@ -0,0 +1,175 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from eddytools import keyindex
+from eddytools.keyindex import KeyIndex
+
+
+def fill_index(key_index, n=1000):
+    for i in range(n):
+        key_index.add('public.orders', ('id',), (i,), i + 1)
+        key_index.add('public.line', ('order_id', 'lineno'), (i // 3, i % 3), i + 1)
+    # repeated keys resolve to the first object version inserted
+    key_index.add('public.orders', ('id',), (5,), 99999)
+
+
+def check_index(key_index, n=1000):
+    for i in range(n):
+        assert key_index.get('public.orders', ('id',), (i,)) == i + 1
+        assert key_index.get('public.line', ('order_id', 'lineno'), (i // 3, i % 3)) == i + 1
+    assert key_index.get('public.orders', ('id',), (n,)) is None
+    assert key_index.get('public.orders', ('id',), ('5',)) is None
+    assert key_index.get('public.orders', ('code',), (5,)) is None
+    assert key_index.get('public.unknown', ('id',), (5,)) is None
+
+
+def test_key_index():
+    key_index = KeyIndex()
+    fill_index(key_index)
+    check_index(key_index)
+    key_index.close()
+
+
+def test_key_index_spill(tmp_path):
+    key_index = KeyIndex(spill_dir=str(tmp_path), memory_budget=4096)
+    fill_index(key_index)
+    check_index(key_index)
+    assert all(t.spilled for t in key_index.tables.values())
+    # keep adding after spilling
+    key_index.add('public.orders', ('id',), (-1,), -1)
+    assert key_index.get('public.orders', ('id',), (-1,)) == -1
+    check_index(key_index)
+    key_index.close()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_key_index_pending_budget(tmp_path):
+    # the pending entries of all the tables count against the budget
+    key_index = KeyIndex(spill_dir=str(tmp_path), memory_budget=4096)
+    for i in range(1000):
+        for t in range(5):
+            key_index.add('public.t{}'.format(t), ('id',), (i,), i + 1)
+            assert key_index.nbytes() <= 4096
+            assert key_index.pending_bytes == sum(t.pending_nbytes() for t in key_index.tables.values())
+    assert all(key_index.get('public.t{}'.format(t), ('id',), (i,)) == i + 1 for t in range(5) for i in range(1000))
+    key_index.close()
+
+
+def test_key_index_collisions(monkeypatch):
+    monkeypatch.setattr(keyindex, 'key_digest', lambda key: 42)
+    key_index = KeyIndex()
+    fill_index(key_index, n=100)
+    check_index(key_index, n=100)
+    key_index.close()
+
+
+def test_key_encoding():
+    keys = [(5,), (5.0,), ('5',), (b'5',), (True,), (None,), (2 ** 70,), ('a', 'bc'), ('ab', 'c'), ('',), ()]
+    encoded = [keyindex.encode_key(k) for k in keys]
+    assert encoded.__len__() == set(encoded).__len__()
+    assert keyindex.encode_key((memoryview(b'5'),)) == keyindex.encode_key((b'5',))
+    assert keyindex.encode_key((-0.0,)) == keyindex.encode_key((0.0,))
+
+
+def test_key_digest_stable():
+    # digests do not depend on the hash seed of the process
+    code = 'from eddytools import keyindex; print(keyindex.key_digest(keyindex.encode_key((1, "a", None))))'
+    digests = {subprocess.check_output([sys.executable, '-c', code], env=dict(os.environ, PYTHONHASHSEED=seed))
+               for seed in ['1', '2']}
+    assert digests == {'{}\n'.format(keyindex.key_digest(keyindex.encode_key((1, 'a', None)))).encode()}
+
+
+def test_key_index_save_class(tmp_path):
+    key_index = KeyIndex()
+    fill_index(key_index)
+    key_index.save_class('public.orders', str(tmp_path))
+    key_index.save_class('public.line', str(tmp_path))
+    key_index.close()
+
+    loaded = KeyIndex(spill_dir=str(tmp_path / 'spill'), memory_budget=4096)
+    assert loaded.load_class('public.orders', str(tmp_path))
+    assert loaded.load_class('public.line', str(tmp_path))
+    assert not loaded.load_class('public.unknown', str(tmp_path))
+    check_index(loaded)
+    loaded.close()
+
+
+def test_key_index_replace(tmp_path):
+    key_index = KeyIndex()
+    fill_index(key_index)
+    key_index.replace('public.orders', ('id',), (5,), 5000)
+    key_index.replace('public.orders', ('id',), (1000,), 5001)
+    assert key_index.get('public.orders', ('id',), (5,)) == 5000
+    key_index.save_class('public.orders', str(tmp_path))
+    key_index.close()
+
+    loaded = KeyIndex()
+    assert loaded.load_class('public.orders', str(tmp_path))
+    # the replaced entries are dropped, including the repeated key
+    assert loaded.get('public.orders', ('id',), (5,)) == 5000
+    assert loaded.get('public.orders', ('id',), (1000,)) == 5001
+    assert loaded.get('public.orders', ('id',), (6,)) == 7
+    assert loaded.tables[('public.orders', ('id',))].__len__() == 1001
+    loaded.close()
+
+
+def sorted_keys(keys):
+    encoded = [keyindex.encode_key(k) for k in keys]
+    digests = np.array([keyindex.key_digest(k) for k in encoded], dtype=np.uint64)
+    order = np.argsort(digests, kind='stable')
+    lengths = np.array([encoded[i].__len__() for i in order], dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    data = np.frombuffer(b''.join(encoded[i] for i in order), dtype=np.uint8)
+    return order, digests[order], data, starts, lengths
+
+
+@pytest.mark.parametrize('memory_budget', [keyindex.DEFAULT_MEMORY_BUDGET, 4096])
+def test_key_index_get_sorted(tmp_path, monkeypatch, memory_budget):
+    monkeypatch.setattr(keyindex, '_BLOCK_SIZE', 64)
+    key_index = KeyIndex(spill_dir=str(tmp_path), memory_budget=memory_budget)
+    fill_index(key_index)
+    # merged with the spilled arrays in the next lookup
+    key_index.add('public.orders', ('id',), (-1,), -1)
+    keys = [(i,) for i in range(-2, 1010)] + [('5',), (5,), (5,)]
+    order, digests, data, starts, lengths = sorted_keys(keys)
+    ov_ids = key_index.get_sorted('public.orders', ('id',), digests, data, starts, lengths)
+    assert [int(ov_ids[j]) or None for j in np.argsort(order)] == \
+        [key_index.get('public.orders', ('id',), k) for k in keys]
+    assert ov_ids.nonzero()[0].__len__() == 1001 + 2
+    assert not key_index.get_sorted('public.unknown', ('id',), digests, data, starts, lengths).any()
+    if memory_budget == 4096:
+        assert all(t.spilled for t in key_index.tables.values())
+        # spilled keys are in the order of their digests
+        t = key_index.tables[('public.orders', ('id',))]
+        assert (np.diff(t.key_starts) == t.key_lengths[:-1]).all()
+    check_index(key_index)
+    key_index.close()
+
+
+def test_key_index_get_sorted_collisions(monkeypatch):
+    monkeypatch.setattr(keyindex, 'key_digest', lambda key: 42)
+    key_index = KeyIndex()
+    fill_index(key_index, n=100)
+    keys = [(i,) for i in range(105)]
+    order, digests, data, starts, lengths = sorted_keys(keys)
+    ov_ids = key_index.get_sorted('public.orders', ('id',), digests, data, starts, lengths)
+    assert [int(ov_ids[j]) for j in np.argsort(order)] == [i + 1 for i in range(100)] + [0] * 5
+    key_index.close()
+
+
+def test_key_table_search_forward(monkeypatch):
+    monkeypatch.setattr(keyindex, '_BLOCK_SIZE', 4)
+    key_index = KeyIndex()
+    fill_index(key_index, n=200)
+    t = key_index.tables[('public.orders', ('id',))]
+    t.seal()
+    digests = np.asarray(t.digests)
+    for start in [0, 1, 50, 199, 200]:
+        for digest in [0, digests[start - 1] if start else 0, digests[min(start + 70, 199)], np.uint64(2 ** 64 - 1)]:
+            assert t._search_forward(start, np.uint64(digest)) == \
+                max(start, int(np.searchsorted(digests, np.uint64(digest), side='right')))
+    key_index.close()
@@ -1,4 +1,9 @@
+from eddytools import extraction as ex
 from eddytools import schema as es
+import itertools
+import os
+import sqlite3
+import pytest
 
 
 def test_disc_ds2(resume=False):
@@ -18,6 +23,187 @@ def test_disc_ds2(resume=False):
                       max_fields_key=2, resume=resume, sampling=5000)
 
 
+def create_sqlite_keys_source(path, n=30):
+    conn = sqlite3.connect(str(path))
+    conn.executescript('''
+        CREATE TABLE item (id INTEGER, code VARCHAR(10), tag VARCHAR(10), grp INTEGER, pos INTEGER);
+        CREATE TABLE empty (id INTEGER, name VARCHAR(10));
+        CREATE TABLE line (item_id INTEGER, grp INTEGER, pos INTEGER, qty INTEGER);
+    ''')
+    for i in range(n):
+        # code has a single NULL, so it is still unique. tag has two NULLs. (grp, pos) is unique
+        conn.execute('INSERT INTO item VALUES (?, ?, ?, ?, ?)',
+                     (i, 'c{}'.format(i) if i else None, 't{}'.format(i) if i > 1 else None, i // 5, i % 5))
+        conn.execute('INSERT INTO line VALUES (?, ?, ?, ?)', (i % 20, i % 6, (i + 1) % 5, 100 + i))
+    conn.commit()
+    conn.close()
+
+
+@pytest.mark.parametrize('batch_size', [2, es.PROFILE_BATCH_COLUMNS])
+def test_profile_columns(tmp_path, batch_size):
+    create_sqlite_keys_source(tmp_path / 'source.db')
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    metadata = ex.get_metadata(db_engine)
+    t = metadata.tables['main.item']
+    total_rows, stats_cols = es.profile_columns(db_engine, t, batch_size=batch_size)
+    assert total_rows == 30
+    for col in t.columns:
+        isunique, num_rows, num_unique_vals = es.check_uniqueness(db_engine, t, {col})
+        assert (stats_cols[col]['isunique'], stats_cols[col]['num_rows'], stats_cols[col]['num_unique_vals']) == \
+            (isunique, num_rows, num_unique_vals)
+    assert {col.name: stats_cols[col]['num_nulls'] for col in t.columns} == \
+        {'id': 0, 'code': 1, 'tag': 2, 'grp': 0, 'pos': 0}
+    total_rows, stats_cols = es.profile_columns(db_engine, metadata.tables['main.empty'])
+    assert total_rows == 0 and all(s['isunique'] for s in stats_cols.values())
+
+
+@pytest.mark.parametrize('probe_rows', [0, 7, 30, es.UNIQUENESS_PROBE_ROWS])
+def test_has_duplicates(tmp_path, probe_rows):
+    create_sqlite_keys_source(tmp_path / 'source.db')
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    metadata = ex.get_metadata(db_engine)
+    for t in metadata.tables.values():
+        for n in range(1, 3):
+            for comb in itertools.combinations(t.columns, n):
+                assert es.has_duplicates(db_engine, t, set(comb), probe_rows=probe_rows) == \
+                    (not es.check_uniqueness(db_engine, t, set(comb))[0])
+
+
+def test_has_duplicates_collation(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'source.db'))
+    conn.executescript('''
+        CREATE TABLE code (id INTEGER, name VARCHAR(10) COLLATE NOCASE);
+        INSERT INTO code VALUES (1, 'a'), (2, 'A');
+    ''')
+    conn.close()
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    t = ex.get_metadata(db_engine).tables['main.code']
+    # the values differ in Python, but not in the db
+    assert es.has_duplicates(db_engine, t, {t.c['name']})
+    assert not es.check_uniqueness(db_engine, t, {t.c['name']})[0]
+    assert not es.has_duplicates(db_engine, t, {t.c['id']})
+
+
+def test_discover_pks(tmp_path):
+    create_sqlite_keys_source(tmp_path / 'source.db')
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    metadata = ex.get_metadata(db_engine)
+    pks = es.discover_pks(db_engine, metadata, classes=['main.item'], max_fields=2, precomputed_pks={})
+    assert sorted(sorted(pk['pk_columns']) for pk in pks['main.item']) == \
+        [['code'], ['grp', 'pos'], ['id'], ['pos', 'tag']]
+
+
+@pytest.mark.parametrize('sampling', [0, 8])
+def test_stripped_partitions(tmp_path, sampling):
+    create_sqlite_keys_source(tmp_path / 'source.db')
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    metadata = ex.get_metadata(db_engine)
+    sampler = es.TableSampler(db_engine, metadata, sampling) if sampling else None
+    for t in metadata.tables.values():
+        if sampler:
+            partitions = es.StrippedPartitions.from_columns(*sampler.get_columns(t.fullname))
+            assert partitions.profile(t.columns) == es.profile_sample_columns(sampler, t)
+        else:
+            partitions = es.StrippedPartitions.from_table(db_engine, t, batch_size=7)
+            assert partitions.profile(t.columns) == es.profile_columns(db_engine, t)
+        for n in range(1, 4):
+            for comb in itertools.combinations(t.columns, n):
+                assert partitions.is_unique(comb) == (not es.has_duplicates(db_engine, t, comb, sampler=sampler))
+    if sampler:
+        sampler.close()
+
+
+@pytest.mark.parametrize('sampling', [0, 8])
+def test_in_memory_discover_pks(tmp_path, sampling):
+    create_sqlite_keys_source(tmp_path / 'source.db')
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    metadata = ex.get_metadata(db_engine)
+    assert es.discover_pks(db_engine, metadata, max_fields=3, precomputed_pks={}, sampling=sampling,
+                           in_memory=True) == \
+        es.discover_pks(db_engine, metadata, max_fields=3, precomputed_pks={}, sampling=sampling)
+
+
+def test_table_sampler(tmp_path):
+    create_sqlite_keys_source(tmp_path / 'source.db')
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    metadata = ex.get_metadata(db_engine)
+    sampler = es.TableSampler(db_engine, metadata, 10, cache_dir=str(tmp_path))
+    rows = sampler.get_rows('main.item', ['id', 'code'])
+    assert rows.__len__() == 10 and rows.__len__() == set(rows).__len__()
+    assert set(rows) <= {(i, 'c{}'.format(i) if i else None) for i in range(30)}
+    assert sampler.get_columns('main.empty') == (0, {'id': [], 'name': []})
+    # samples are the same in every run, and reused when resuming
+    db_engine.execute('DELETE FROM item')
+    assert es.TableSampler(db_engine, metadata, 10, cache_dir=str(tmp_path), reuse=True)\
+        .get_rows('main.item', ['id', 'code']) == rows
+    assert sampler.get_rows('main.item', ['id', 'code']) == rows
+    assert es.TableSampler(db_engine, metadata, 10, cache_dir=str(tmp_path)).get_rows('main.item', ['id']) == []
+    sampler = es.TableSampler(db_engine, metadata, 10)
+    sampler.get_rows('main.item', ['id'])
+    sampler.close()
+    assert not os.path.exists(sampler.cache_dir)
+
+
+def test_sampled_discovery(tmp_path):
+    create_sqlite_keys_source(tmp_path / 'source.db')
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    metadata = ex.get_metadata(db_engine)
+    classes = ['main.item', 'main.line']
+    pks = es.discover_pks(db_engine, metadata, classes=classes, max_fields=2, precomputed_pks={})
+    fks = es.discover_fks(db_engine, metadata, pks, classes=classes, max_fields=2, precomputed_fks={})
+    assert ['item_id'] in [fk['fk_columns'] for fk in fks['main.line']]
+    # a sample of all the rows finds the same keys
+    sampler = es.TableSampler(db_engine, metadata, 100)
+    assert es.discover_pks(db_engine, metadata, classes=classes, max_fields=2, precomputed_pks={},
+                           sampler=sampler) == pks
+    assert es.discover_fks(db_engine, metadata, pks, classes=classes, max_fields=2, precomputed_fks={},
+                           sampler=sampler) == fks
+    sampler.close()
+    # and smaller samples find more candidates
+    sampled_pks = es.discover_pks(db_engine, metadata, classes=classes, max_fields=2, precomputed_pks={}, sampling=8)
+    assert all(pk in sampled_pks[c] for c in classes for pk in pks[c] if pk['pk_columns'].__len__() == 1)
+    sampled_fks = es.discover_fks(db_engine, metadata, pks, classes=classes, max_fields=2, precomputed_fks={},
+                                  sampling=8)
+    assert all(fk in sampled_fks[c] for c in classes for fk in fks[c])
+
+
+@pytest.mark.parametrize('sampling', [0, 8])
+def test_unary_inds(tmp_path, sampling):
+    create_sqlite_keys_source(tmp_path / 'source.db')
+    db_engine = ex.create_db_engine_from_url('sqlite:///{}'.format(tmp_path / 'source.db'))
+    metadata = ex.get_metadata(db_engine)
+    classes = ['main.item', 'main.line']
+    pks = es.discover_pks(db_engine, metadata, classes=classes, max_fields=2, precomputed_pks={})
+    sampler = es.TableSampler(db_engine, metadata, sampling) if sampling else None
+    inds = es.discover_unary_inds(db_engine, metadata, pks, classes=classes, sampler=sampler)
+    num_pairs = 0
+    for t, pk_tables in inds.items():
+        for pk_t, columns in pk_tables.items():
+            for fk_col, pk_cols in columns.items():
+                for pk_col, included in pk_cols.items():
+                    num_pairs += 1
+                    assert included == es.is_included_server_side(db_engine, metadata, t, [fk_col], pk_t, [pk_col],
+                                                                  sampler=sampler)
+    assert num_pairs > 10
+    assert inds['main.line']['main.item']['item_id']['id']
+    assert not inds['main.line']['main.item']['qty']['id']
+    # the FK discovery finds the same FKs without checking single columns again
+    fks = es.discover_fks(db_engine, metadata, pks, classes=classes, max_fields=2, precomputed_fks={},
+                          sampler=sampler)
+    calls = []
+    is_included_server_side = es.is_included_server_side
+    es.is_included_server_side = lambda *args, **kwargs: calls.append(args) or is_included_server_side(*args,
+                                                                                                       **kwargs)
+    try:
+        assert es.discover_fks(db_engine, metadata, pks, classes=classes, max_fields=2, precomputed_fks={},
+                               sampler=sampler, unary_inds=True) == fks
+    finally:
+        es.is_included_server_side = is_included_server_side
+    assert all(args[3].__len__() > 1 for args in calls)
+    if sampler:
+        sampler.close()
+
+
 if __name__ == '__main__':
     test_disc_ds2(resume=False)
     #test_disc_ds2(resume=True)